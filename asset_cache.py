@@ -0,0 +1,344 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class _Flight:
+    # A download in progress that concurrent callers for the same key wait on
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AssetCache:
+    """
+    Tiered cache of S3 course assets (slides, quiz files, certificate templates).
+
+    Lookups go to a bounded in-memory LRU first, then to a size-capped on-disk cache
+    directory, then to S3. Cached copies older than revalidate_seconds are revalidated
+    with a conditional GET (If-None-Match) so unchanged assets are not downloaded again.
+    Concurrent misses for the same key share a single S3 request.
+
+    Attributes:
+    s3 (S3FileManager): The S3 file manager used for downloads.
+    memory_max_bytes (int): The maximum size of the in-memory tier.
+    disk_dir (str): The on-disk cache directory, or None to disable the disk tier.
+    disk_max_bytes (int): The maximum size of the on-disk tier.
+    revalidate_seconds (int): The age after which a cached copy is revalidated against S3.
+    """
+    def __init__(self, s3, memory_max_mb=128, disk_dir="data/asset_cache", disk_max_mb=2048, revalidate_seconds=300):
+        """
+        The constructor for the AssetCache class.
+        """
+        self.s3 = s3
+        self.memory_max_bytes = memory_max_mb * 1024 * 1024
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_mb * 1024 * 1024
+        self.revalidate_seconds = revalidate_seconds
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._flights = {}
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "not_modified": 0, "downloads": 0, "errors": 0, "coalesced": 0}
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_files())
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    # In-memory tier
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key, content, etag, checked_at):
+        size = len(content)
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old["content"])
+            # Skip assets that would take over most of the memory tier, the disk tier still holds them
+            if size > self.memory_max_bytes // 4:
+                return
+            self._memory[key] = {"content": content, "etag": etag, "checked_at": checked_at}
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_max_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted["content"])
+
+    # On-disk tier
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def local_copy(self, key, etag=None):
+        """
+        Function to get the on-disk copy of an asset without reading it, e.g. to stream it.
+
+        Args:
+        key (str): The S3 key.
+        etag (str): The current ETag in S3. If given, a copy with this ETag is returned and
+            marked as revalidated; otherwise only a copy revalidated recently is returned.
+
+        Returns:
+        dict: The path, etag and size of the copy, or None if there is no usable copy.
+        """
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            return None
+
+        if etag is not None:
+            if meta.get("etag") != etag:
+                return None
+            self._touch_disk(key, time.time())
+        elif time.time() - meta.get("checked_at", 0) >= self.revalidate_seconds:
+            return None
+        self._count("disk_hits")
+        return {"path": path, "etag": meta.get("etag"), "size": size}
+
+    def _disk_files(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".json") or name.startswith("."):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+            with open(path, "rb") as f:
+                content = f.read()
+            # The modification time orders the disk tier for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return {"content": content, "etag": meta.get("etag"), "checked_at": meta.get("checked_at", 0)}
+
+    def _disk_put(self, key, content, etag, checked_at):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            # Write to a temporary file and rename it so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            with self._disk_lock:
+                previous = os.path.getsize(path) if os.path.exists(path) else 0
+                os.replace(tmp_path, path)
+                with open(path + ".json", "w") as f:
+                    json.dump({"key": key, "etag": etag, "checked_at": checked_at}, f)
+                self._disk_bytes += len(content) - previous
+                self._evict_disk()
+        except OSError as e:
+            logging.error(f"Error in writing {key} to the asset cache: {e}")
+
+    def _touch_disk(self, key, checked_at):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+            meta["checked_at"] = checked_at
+            with open(path + ".json", "w") as f:
+                json.dump(meta, f)
+        except (OSError, ValueError):
+            pass
+
+    def _evict_disk(self):
+        # Called with the disk lock held
+        if self._disk_bytes <= self.disk_max_bytes:
+            return
+        for _, path, size in sorted(self._disk_files()):
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                if os.path.exists(path + ".json"):
+                    os.remove(path + ".json")
+                self._disk_bytes -= size
+            except OSError:
+                continue
+
+    # Lookups
+
+    def get(self, key):
+        """
+        Function to get an asset.
+
+        Args:
+        key (str): The S3 key.
+
+        Returns:
+        bytes: The asset content, or False if it could not be fetched.
+        """
+        entry = self._memory_get(key)
+        if entry is not None and time.time() - entry["checked_at"] < self.revalidate_seconds:
+            self._count("memory_hits")
+            return entry["content"]
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            self._count("coalesced")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._fetch(key, entry)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    async def aget(self, key):
+        """
+        Async version of get, S3 requests run in a worker thread.
+
+        Args:
+        key (str): The S3 key.
+
+        Returns:
+        bytes: The asset content, or False if it could not be fetched.
+        """
+        entry = self._memory_get(key)
+        if entry is not None and time.time() - entry["checked_at"] < self.revalidate_seconds:
+            self._count("memory_hits")
+            return entry["content"]
+        return await asyncio.to_thread(self.get, key)
+
+    def _fetch(self, key, entry):
+        if entry is None:
+            entry = self._disk_get(key)
+            if entry is not None and time.time() - entry["checked_at"] < self.revalidate_seconds:
+                self._count("disk_hits")
+                self._memory_put(key, entry["content"], entry["etag"], entry["checked_at"])
+                return entry["content"]
+
+        etag = entry["etag"] if entry is not None else None
+        result = self.s3.get_object_if_modified(key, etag)
+        now = time.time()
+
+        if result is False:
+            self._count("errors")
+            if entry is not None:
+                # Serve the stale copy rather than failing while S3 is unreachable
+                logging.warning(f"Serving a stale copy of {key}, revalidation failed")
+                return entry["content"]
+            return False
+
+        if result["not_modified"]:
+            self._count("not_modified")
+            self._memory_put(key, entry["content"], etag, now)
+            self._touch_disk(key, now)
+            return entry["content"]
+
+        self._count("downloads")
+        self._memory_put(key, result["content"], result["etag"], now)
+        self._disk_put(key, result["content"], result["etag"], now)
+        return result["content"]
+
+    def invalidate(self, key):
+        """
+        Function to drop an asset from both tiers.
+
+        Args:
+        key (str): The S3 key.
+        """
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory_bytes -= len(entry["content"])
+        if self.disk_dir:
+            path = self._disk_path(key)
+            with self._disk_lock:
+                try:
+                    self._disk_bytes -= os.path.getsize(path)
+                    os.remove(path)
+                    os.remove(path + ".json")
+                except OSError:
+                    pass
+
+    def stats(self):
+        """
+        Function to get the cache statistics.
+
+        Returns:
+        dict: The hits per tier, revalidations, downloads and hit ratio.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_mb"] = round(self._memory_bytes / (1024 * 1024), 2)
+            stats["memory_entries"] = len(self._memory)
+        stats["disk_mb"] = round(self._disk_bytes / (1024 * 1024), 2)
+        served = stats["memory_hits"] + stats["disk_hits"] + stats["not_modified"]
+        lookups = served + stats["downloads"] + stats["errors"]
+        stats["hit_ratio"] = served / lookups if lookups else 0.0
+        return stats
+
+
+def create_asset_cache(s3):
+    """
+    Function to create the asset cache configured by the ASSET_CACHE_* environment variables.
+
+    Args:
+    s3 (S3FileManager): The S3 file manager used for downloads.
+
+    Returns:
+    AssetCache: The asset cache.
+    """
+    disk_dir = os.environ.get("ASSET_CACHE_DIR", "data/asset_cache")
+    return AssetCache(
+        s3,
+        memory_max_mb=int(os.environ.get("ASSET_CACHE_MEMORY_MB", 128)),
+        disk_dir=disk_dir if disk_dir.lower() != "none" else None,
+        disk_max_mb=int(os.environ.get("ASSET_CACHE_DISK_MB", 2048)),
+        revalidate_seconds=int(os.environ.get("ASSET_CACHE_REVALIDATE_SECONDS", 300)),
+    )
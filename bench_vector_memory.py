@@ -0,0 +1,119 @@
+"""
+This script measures the memory used by each worker process when every worker loads the course vector indexes,
+to compare FAISS.load_local ("memory") with the memory-mapped layout written by vector_index.py ("mmap").
+
+Each worker loads every index, runs searches so the index pages are touched, then reports its RSS and
+PSS while all workers are alive. PSS splits shared pages between the processes mapping them, so the sum of
+the PSS of the workers is the memory the workers actually cost the host.
+
+Usage:
+python bench_vector_memory.py --workers 4 --mode mmap [hybrid_db directories...]
+
+Author: Shreyas Nikam
+"""
+
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+from vector_index import load_vector_store, find_vector_store_dirs
+
+
+def memory_usage():
+    """
+    Get the RSS and PSS of the current process in MB, from /proc (Linux only)
+
+    Returns:
+    usage: dict - rss_mb and pss_mb, None when not available
+    """
+    usage = {"rss_mb": None, "pss_mb": None}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    usage[f"{name.lower()}_mb"] = round(int(value.split()[0]) / 1024, 2)
+    except OSError:
+        pass
+    return usage
+
+
+def worker(mode, paths, searches, barrier, results):
+    baseline = memory_usage()
+    start = time.perf_counter()
+    vector_stores = [load_vector_store(path, None, mode=mode) for path in paths]
+    load_seconds = time.perf_counter() - start
+
+    rng = np.random.default_rng(os.getpid())
+    start = time.perf_counter()
+    for vector_store in vector_stores:
+        for _ in range(searches):
+            query = rng.standard_normal((1, vector_store.index.d)).astype(np.float32)
+            vector_store.index.search(query, 5)
+    search_seconds = time.perf_counter() - start
+
+    # Measure once every worker has loaded, so the shared pages are split between all of them
+    barrier.wait()
+    usage = memory_usage()
+    results.put({
+        "pid": os.getpid(),
+        "load_seconds": round(load_seconds, 3),
+        "search_ms": round(search_seconds * 1000 / max(len(vector_stores) * searches, 1), 3),
+        "rss_mb": usage["rss_mb"],
+        "pss_mb": usage["pss_mb"],
+        "index_rss_mb": round(usage["rss_mb"] - baseline["rss_mb"], 2) if usage["rss_mb"] is not None else None,
+    })
+    barrier.wait()
+
+
+def run_benchmark(mode, paths, workers=4, searches=50):
+    """
+    Load the vector indexes in several worker processes and report their memory
+
+    Args:
+    mode: str - "mmap" or "memory"
+    paths: list - the vector store directories
+    workers: int - number of worker processes
+    searches: int - number of searches per index and worker
+
+    Returns:
+    report: dict - the measures of each worker and their totals
+    """
+    # Spawn fresh interpreters, like separate uvicorn workers, instead of forking this process
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(mode, paths, searches, barrier, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measures = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    def total(name):
+        values = [measure[name] for measure in measures if measure[name] is not None]
+        return round(sum(values), 2) if values else None
+
+    return {
+        "mode": mode,
+        "indexes": len(paths),
+        "workers": measures,
+        "total_rss_mb": total("rss_mb"),
+        "total_pss_mb": total("pss_mb"),
+        "total_index_rss_mb": total("index_rss_mb"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory used per worker by the course vector indexes")
+    parser.add_argument("paths", nargs="*", help="vector store directories, defaults to every course index")
+    parser.add_argument("--mode", choices=["mmap", "memory"], default="mmap")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--searches", type=int, default=50)
+    args = parser.parse_args()
+
+    print(json.dumps(run_benchmark(args.mode, args.paths or find_vector_store_dirs(), args.workers, args.searches), indent=2))
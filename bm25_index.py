@@ -0,0 +1,431 @@
+"""
+This script converts the pickled BM25 retrievers of the course indexes into the native BM25 index format.
+
+The native format keeps the postings, document lengths and idf weights of a corpus in numpy arrays
+that are memory-mapped at load time, so loading a course does not unpickle Python lists of tokenized
+documents and every worker process shares the same pages. Scores are the BM25Okapi scores computed
+by rank_bm25, evaluated with vectorized numpy operations over the postings of each query term.
+
+Files of an index directory (bm25_index/ next to bm25_retriever.pkl):
+meta.json           k1, b, avgdl, k and the number of documents
+terms.json          vocabulary, the position of a term is its id
+idf.npy             idf weight of each term
+term_offsets.npy    start of the postings of each term, CSR layout
+postings_docs.npy   document id of each posting
+postings_tf.npy     term frequency of each posting
+doc_len.npy         number of tokens of each document
+docs.bin            page content and metadata of each document, see document_store.py
+docs_offsets.npy    start of each record in docs.bin
+
+Usage:
+python bm25_index.py [retriever directories...]
+
+Author: Shreyas Nikam
+"""
+
+
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import logging
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from document_store import DocumentStore, write_documents
+
+
+INDEX_DIR_NAME = "bm25_index"
+FORMAT_VERSION = 1
+
+
+def default_preprocessing_func(text):
+    # Same tokenization as the default of langchain's BM25Retriever
+    return text.split()
+
+
+class BM25Index:
+    """
+    Memory-mapped BM25 index of a course corpus.
+
+    Attributes:
+    k1 (float): The term frequency saturation.
+    b (float): The document length normalization.
+    avgdl (float): The average document length.
+    k (int): The number of documents returned by default.
+    """
+    def __init__(self, path, meta, terms, idf, term_offsets, postings_docs, postings_tf, doc_len, docs):
+        """
+        The constructor for the BM25Index class, use BM25Index.load to open an index.
+        """
+        self.path = path
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+        self.avgdl = meta["avgdl"]
+        self.k = meta.get("k", 4)
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.idf = idf
+        self.term_offsets = term_offsets
+        self.postings_docs = postings_docs
+        self.postings_tf = postings_tf
+        self.doc_len = doc_len
+        self.docs = docs
+        # Length normalization of every document, the only part of the score that does not depend on the query
+        self._norm = self.k1 * (1 - self.b + self.b * doc_len.astype(np.float64) / self.avgdl)
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Function to open an index, memory-mapping its arrays.
+
+        Args:
+        path (str): The index directory.
+
+        Returns:
+        BM25Index: The index.
+        """
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index format {meta.get('format_version')} in {path}")
+        with open(os.path.join(path, "terms.json"), "r", encoding="utf-8") as f:
+            terms = json.load(f)
+
+        def array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        return cls(
+            path, meta, terms,
+            idf=array("idf"),
+            term_offsets=array("term_offsets"),
+            postings_docs=array("postings_docs"),
+            postings_tf=array("postings_tf"),
+            doc_len=array("doc_len"),
+            docs=DocumentStore.load(path),
+        )
+
+    @staticmethod
+    def build(path, tokenized_docs, documents, k1=1.5, b=0.75, idf=None, k=4):
+        """
+        Function to build an index and save it.
+
+        Args:
+        path (str): The index directory, replaced if it exists.
+        tokenized_docs (list): The tokens of each document.
+        documents (list): The langchain Document of each document.
+        k1 (float): The term frequency saturation.
+        b (float): The document length normalization.
+        idf (dict): The idf of each term, computed as in BM25Okapi with epsilon 0.25 if not given.
+        k (int): The number of documents returned by default.
+        """
+        n_docs = len(tokenized_docs)
+        doc_len = np.array([len(tokens) for tokens in tokenized_docs], dtype=np.int32)
+        avgdl = float(doc_len.sum()) / n_docs if n_docs else 0.0
+
+        postings = {}
+        for doc_id, tokens in enumerate(tokenized_docs):
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc_id, count))
+
+        terms = sorted(postings)
+        if idf is None:
+            idf = _okapi_idf({term: len(postings[term]) for term in terms}, n_docs)
+
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for i, term in enumerate(terms):
+            term_offsets[i + 1] = term_offsets[i] + len(postings[term])
+        postings_docs = np.empty(term_offsets[-1], dtype=np.int32)
+        postings_tf = np.empty(term_offsets[-1], dtype=np.int32)
+        for i, term in enumerate(terms):
+            start, end = term_offsets[i], term_offsets[i + 1]
+            postings_docs[start:end] = [doc_id for doc_id, _ in postings[term]]
+            postings_tf[start:end] = [count for _, count in postings[term]]
+
+        # Write into a temporary directory and rename it so a loading process never sees a partial index
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"format_version": FORMAT_VERSION, "k1": k1, "b": b, "avgdl": avgdl, "k": k, "n_docs": n_docs}, f)
+        with open(os.path.join(tmp_path, "terms.json"), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        np.save(os.path.join(tmp_path, "idf.npy"), np.array([idf.get(term, 0.0) for term in terms], dtype=np.float64))
+        np.save(os.path.join(tmp_path, "term_offsets.npy"), term_offsets)
+        np.save(os.path.join(tmp_path, "postings_docs.npy"), postings_docs)
+        np.save(os.path.join(tmp_path, "postings_tf.npy"), postings_tf)
+        np.save(os.path.join(tmp_path, "doc_len.npy"), doc_len)
+        write_documents(tmp_path, documents)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def get_scores(self, tokens):
+        """
+        Function to score every document for a tokenized query.
+
+        Args:
+        tokens (list): The query tokens, repeated tokens count again as in BM25Okapi.
+
+        Returns:
+        np.ndarray: The score of each document.
+        """
+        scores = np.zeros(len(self.doc_len), dtype=np.float64)
+        for token in tokens:
+            term_id = self.term_ids.get(token)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            doc_ids = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end].astype(np.float64)
+            # Documents without the term score 0 for it, so only its postings are touched
+            scores[doc_ids] += self.idf[term_id] * (tf * (self.k1 + 1) / (tf + self._norm[doc_ids]))
+        return scores
+
+    def top_k(self, tokens, k=None):
+        """
+        Function to get the ids and scores of the best documents for a tokenized query.
+
+        Args:
+        tokens (list): The query tokens.
+        k (int): The number of documents, defaults to the k of the index.
+
+        Returns:
+        list: The (document id, score) pairs, best first.
+        """
+        k = min(k or self.k, len(self.doc_len))
+        if k <= 0:
+            return []
+        scores = self.get_scores(tokens)
+        # Same ranking as BM25Okapi.get_top_n, including the order of tied documents, which decides the
+        # chunks passed to the reranker when few documents match. Sorting is cheap next to the scoring
+        ranked = np.argsort(scores)[::-1][:k]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in ranked]
+
+    def document(self, doc_id):
+        """
+        Function to read a document of the index.
+
+        Args:
+        doc_id (int): The document id.
+
+        Returns:
+        Document: The langchain document.
+        """
+        return self.docs.document(doc_id)
+
+
+def _okapi_idf(document_frequencies, n_docs, epsilon=0.25):
+    # Same idf as rank_bm25.BM25Okapi: negative idfs are floored at epsilon times the average idf
+    idf = {}
+    negative = []
+    for term, freq in document_frequencies.items():
+        idf[term] = float(np.log(n_docs - freq + 0.5) - np.log(freq + 0.5))
+        if idf[term] < 0:
+            negative.append(term)
+    average_idf = sum(idf.values()) / len(idf) if idf else 0.0
+    for term in negative:
+        idf[term] = epsilon * average_idf
+    return idf
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """
+    LangChain retriever over a BM25Index, a drop-in replacement for a loaded BM25Retriever.
+    """
+    index: Any
+    k: int = 4
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_path(cls, path, k=None):
+        """
+        Function to create the retriever of an index directory.
+
+        Args:
+        path (str): The index directory.
+        k (int): The number of documents returned, defaults to the k saved with the index.
+
+        Returns:
+        BM25IndexRetriever: The retriever.
+        """
+        index = BM25Index.load(path)
+        return cls(index=index, k=k or index.k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        tokens = default_preprocessing_func(query)
+        return [self.index.document(doc_id) for doc_id, _ in self.index.top_k(tokens, self.k)]
+
+
+def index_path(retriever_db_path):
+    """
+    Get the native BM25 index directory of a retriever directory
+
+    Args:
+    retriever_db_path: str - the retriever directory
+
+    Returns:
+    path: str - the index directory
+    """
+    return os.path.join(retriever_db_path, INDEX_DIR_NAME)
+
+
+def _load_memory(kind, path, queries):
+    # Runs in a fresh interpreter so the memory of one format is not mixed with the other
+    from bench_vector_memory import memory_usage
+
+    if kind == "pickle":
+        # Import the classes of the pickle first so only the index itself is measured
+        import rank_bm25  # noqa: F401
+        import langchain_community.retrievers.bm25  # noqa: F401
+
+    baseline = memory_usage()
+    if kind == "pickle":
+        with open(path, "rb") as f:
+            retriever = pickle.load(f)
+        for query in queries:
+            retriever.vectorizer.get_scores(query)
+    else:
+        index = BM25Index.load(path)
+        # Touch the mapped pages the queries read, as the searches of a worker would
+        for query in queries:
+            for doc_id, _ in index.top_k(query):
+                index.document(doc_id)
+    usage = memory_usage()
+    return {
+        name: round(usage[name] - baseline[name], 2) if usage[name] is not None else None
+        for name in ("rss_mb", "pss_mb")
+    }
+
+
+def measure_load(kind, path, queries):
+    """
+    Measure the memory added to a process by loading a BM25 index and running queries on it
+
+    Args:
+    kind: str - "pickle" for a bm25_retriever.pkl file or "native" for an index directory
+    path: str - the pickle file or index directory
+    queries: list - tokenized queries to run after loading
+
+    Returns:
+    usage: dict - rss_mb and pss_mb added by the load, None when not available
+    """
+    # Spawn a fresh interpreter, like a new uvicorn worker, instead of forking this process
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_load_memory, kind, path, queries).result()
+
+
+def convert_pickle(retriever_db_path):
+    """
+    Convert the pickled BM25Retriever of a retriever directory into a native BM25 index
+
+    Args:
+    retriever_db_path: str - the retriever directory holding bm25_retriever.pkl
+
+    Returns:
+    report: dict - load times, memory and size of both formats, and whether their scores and rankings agree
+    """
+    pickle_path = os.path.join(retriever_db_path, "bm25_retriever.pkl")
+    start = time.perf_counter()
+    with open(pickle_path, "rb") as f:
+        bm25_retriever = pickle.load(f)
+    pickle_seconds = time.perf_counter() - start
+
+    vectorizer = bm25_retriever.vectorizer
+    if getattr(bm25_retriever.preprocess_func, "__name__", "") != "default_preprocessing_func":
+        logging.warning(f"{pickle_path} uses a custom preprocess_func, queries are tokenized with str.split")
+
+    # Rebuild the postings from the per document term frequencies held by BM25Okapi
+    tokenized_docs = []
+    for doc_freqs in vectorizer.doc_freqs:
+        tokens = []
+        for term, count in doc_freqs.items():
+            tokens.extend([term] * count)
+        tokenized_docs.append(tokens)
+
+    path = index_path(retriever_db_path)
+    BM25Index.build(
+        path, tokenized_docs, bm25_retriever.docs,
+        k1=vectorizer.k1, b=vectorizer.b, idf=vectorizer.idf, k=bm25_retriever.k,
+    )
+
+    start = time.perf_counter()
+    index = BM25Index.load(path)
+    native_seconds = time.perf_counter() - start
+
+    # Check the native scores and rankings against BM25Okapi on queries made of the corpus's own terms,
+    # and on a query matching no document, where every document is tied
+    queries = [list(doc_freqs)[:5] for doc_freqs in vectorizer.doc_freqs[:20]] + [["\x00"]]
+    agree, ranking_agree = True, True
+    for query in queries:
+        expected = np.asarray(vectorizer.get_scores(query))
+        if not np.allclose(index.get_scores(query), expected):
+            agree = False
+        expected_ids = [int(doc_id) for doc_id in np.argsort(expected)[::-1][:bm25_retriever.k]]
+        if [doc_id for doc_id, _ in index.top_k(query, bm25_retriever.k)] != expected_ids:
+            ranking_agree = False
+
+    pickle_memory = measure_load("pickle", pickle_path, queries)
+    native_memory = measure_load("native", path, queries)
+
+    report = {
+        "path": path,
+        "documents": len(index),
+        "terms": len(index.term_ids),
+        "pickle_load_seconds": round(pickle_seconds, 4),
+        "native_load_seconds": round(native_seconds, 4),
+        "pickle_rss_mb": pickle_memory["rss_mb"],
+        "native_rss_mb": native_memory["rss_mb"],
+        "pickle_pss_mb": pickle_memory["pss_mb"],
+        "native_pss_mb": native_memory["pss_mb"],
+        "pickle_bytes": os.path.getsize(pickle_path),
+        "native_bytes": sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)),
+        "scores_match": agree,
+        "rankings_match": ranking_agree,
+    }
+    logging.info(f"Converted {pickle_path}: {report}")
+    return report
+
+
+def find_retriever_dirs(roots=("chatbot", "data/indexes")):
+    """
+    Find the retriever directories holding a pickled BM25 retriever
+
+    Args:
+    roots: tuple - directories to search
+
+    Returns:
+    paths: list - the retriever directories
+    """
+    paths = []
+    for root in roots:
+        for directory, _, files in os.walk(root):
+            if "bm25_retriever.pkl" in files:
+                paths.append(directory)
+    return sorted(paths)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    retriever_dirs = sys.argv[1:] or find_retriever_dirs()
+    for retriever_dir in retriever_dirs:
+        try:
+            print(json.dumps(convert_pickle(retriever_dir)))
+        except Exception as e:
+            logging.error(f"Error in converting {retriever_dir}: {e}")
@@ -0,0 +1,259 @@
+import os
+import cv2
+import json
+import time
+import datetime
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def render_certificate(template, user_name, recorded_on):
+    """
+    Draw the user name and the completion date on a decoded certificate template
+
+    Args:
+    template: np.ndarray - decoded certificate template, left untouched
+    user_name: str - the name of the user
+    recorded_on: str - the completion date, formatted as %Y-%m-%d
+
+    Returns:
+    certificate: bytes - the JPEG encoded certificate
+    """
+    certificate = template.copy()
+
+    # add user name to certificate
+    font = cv2.FONT_HERSHEY_COMPLEX
+    fontScale = 3
+    cv2.putText(certificate, user_name, (
+        145, 800), font, fontScale, (0, 0, 0), thickness=3)
+
+    # add the completion date
+    cv2.putText(certificate,
+                           "Recorded on: " + recorded_on,
+                           (1630, 1095), font, 0.7, (0, 0, 0), thickness=1)
+
+    # Encode the modified image to send back to client
+    _, buffer = cv2.imencode('.jpg', certificate)
+    return buffer.tobytes()
+
+
+def decode_template(image_content):
+    """
+    Decode an encoded certificate template
+
+    Args:
+    image_content: bytes - the encoded template
+
+    Returns:
+    template: np.ndarray - the decoded template
+    """
+    image_np = np.frombuffer(image_content, dtype=np.uint8)
+    return cv2.imdecode(image_np, cv2.IMREAD_COLOR)
+
+
+# Where the bulk job stores pre-rendered certificates: "local", "s3" or "none"
+PRERENDERED_STORE = os.environ.get("CERTIFICATE_PRERENDERED_STORE", "none").lower()
+PRERENDERED_DIR = os.environ.get("CERTIFICATE_PRERENDERED_DIR", "data/certificates")
+# How long a manifest (or its absence) is trusted before it is read again, in seconds
+MANIFEST_TTL_SECONDS = int(os.environ.get("CERTIFICATE_MANIFEST_TTL_SECONDS", 300))
+
+
+def prerendered_path(app_code, user_id, recorded_on, directory=None):
+    """
+    Path of a pre-rendered certificate on the local disk
+
+    Args:
+    app_code: str - the course app code
+    user_id: str - the user _id
+    recorded_on: str - the completion date drawn on the certificate
+    directory: str - the certificates directory
+
+    Returns:
+    path: str - the certificate path
+    """
+    return os.path.join(directory or PRERENDERED_DIR, app_code, f"{user_id}_{recorded_on}.jpg")
+
+
+def prerendered_key(course_config, user_id, recorded_on):
+    """
+    S3 key of a pre-rendered certificate
+
+    Args:
+    course_config: dict - the config_list.json entry of the course
+    user_id: str - the user _id
+    recorded_on: str - the completion date drawn on the certificate
+
+    Returns:
+    key: str - the certificate key
+    """
+    return f"{course_config['S3_BUCKET_PREFIX']}/certificates/{user_id}_{recorded_on}.jpg"
+
+
+def manifest_path(app_code, directory=None):
+    """
+    Path of the manifest of the certificates pre-rendered for a course on the local disk
+
+    Args:
+    app_code: str - the course app code
+    directory: str - the certificates directory
+
+    Returns:
+    path: str - the manifest path
+    """
+    return os.path.join(directory or PRERENDERED_DIR, app_code, "manifest.json")
+
+
+def manifest_key(course_config):
+    """
+    S3 key of the manifest of the certificates pre-rendered for a course
+
+    Args:
+    course_config: dict - the config_list.json entry of the course
+
+    Returns:
+    key: str - the manifest key
+    """
+    return f"{course_config['S3_BUCKET_PREFIX']}/certificates/manifest.json"
+
+
+class CertificateRenderer:
+    """
+    Renders course certificates from decoded templates kept in memory, and caches the
+    rendered certificates by user, course and completion date.
+
+    Attributes:
+    asset_cache (AssetCache): The cache the encoded templates are read from.
+    max_rendered (int): The number of rendered certificates kept.
+    """
+    def __init__(self, asset_cache, max_rendered=None):
+        """
+        The constructor for the CertificateRenderer class.
+        """
+        if max_rendered is None:
+            max_rendered = int(os.environ.get("CERTIFICATE_CACHE_ENTRIES", 512))
+        self.asset_cache = asset_cache
+        self.max_rendered = max_rendered
+
+        self._lock = threading.Lock()
+        self._template_lock = threading.Lock()
+        self._templates = {}
+        self._rendered = OrderedDict()
+        self._manifests = {}
+
+    def template(self, template_path):
+        """
+        Function to get the decoded template, decoding it again only when it changed in S3.
+
+        Args:
+        template_path (str): The S3 key of the template.
+
+        Returns:
+        np.ndarray: The decoded template, or None if it could not be fetched.
+        """
+        image_content = self.asset_cache.get(template_path)
+        if image_content is False or image_content is None:
+            return None
+
+        with self._template_lock:
+            cached = self._templates.get(template_path)
+            # The asset cache hands back the same bytes object while the template is unchanged
+            if cached is not None and (cached[0] is image_content or cached[0] == image_content):
+                return cached[1]
+            template = decode_template(image_content)
+            self._templates[template_path] = (image_content, template)
+            logging.info(f"Decoded certificate template {template_path}")
+            return template
+
+    def _manifest(self, app_code, course_config):
+        # The manifest is read again at most every MANIFEST_TTL_SECONDS, a missing one included,
+        # so certificates that were not pre-rendered cost no lookup on the request path
+        now = time.monotonic()
+        with self._lock:
+            cached = self._manifests.get(app_code)
+            if cached is not None and now - cached[0] < MANIFEST_TTL_SECONDS:
+                return cached[1]
+
+        manifest = {}
+        try:
+            if PRERENDERED_STORE == "local":
+                path = manifest_path(app_code)
+                if os.path.exists(path):
+                    with open(path, "r") as f:
+                        manifest = json.load(f)
+            elif PRERENDERED_STORE == "s3":
+                content = self.asset_cache.get(manifest_key(course_config))
+                if content:
+                    manifest = json.loads(content)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error in reading the certificate manifest of {app_code}: {e}")
+
+        with self._lock:
+            self._manifests[app_code] = (now, manifest)
+        return manifest
+
+    def prerendered(self, app_code, course_config, user_id, user_name):
+        """
+        Function to get a certificate pre-rendered by render_certificates.py.
+
+        Args:
+        app_code (str): The course app code.
+        course_config (dict): The config_list.json entry of the course.
+        user_id (str): The user _id.
+        user_name (str): The current name of the user, a certificate drawn with another name is not used.
+
+        Returns:
+        bytes: The JPEG encoded certificate, or None if it was not pre-rendered.
+        """
+        if PRERENDERED_STORE not in ("local", "s3"):
+            return None
+        entry = self._manifest(app_code, course_config).get(user_id)
+        if entry is None or entry.get("name") != user_name:
+            return None
+
+        if PRERENDERED_STORE == "local":
+            try:
+                with open(prerendered_path(app_code, user_id, entry["recorded_on"]), "rb") as f:
+                    return f.read()
+            except OSError:
+                return None
+        certificate = self.asset_cache.get(prerendered_key(course_config, user_id, entry["recorded_on"]))
+        return certificate or None
+
+    def render(self, template_path, user_id, user_name, recorded_on=None):
+        """
+        Function to get the certificate of a user, rendering it on a cache miss.
+
+        Args:
+        template_path (str): The S3 key of the template.
+        user_id (str): The user _id.
+        user_name (str): The name drawn on the certificate.
+        recorded_on (str): The completion date, defaults to today.
+
+        Returns:
+        bytes: The JPEG encoded certificate, or None if the template could not be fetched.
+        """
+        if recorded_on is None:
+            recorded_on = datetime.datetime.now().strftime("%Y-%m-%d")
+        key = (user_id, template_path, recorded_on, user_name)
+
+        with self._lock:
+            certificate = self._rendered.get(key)
+            if certificate is not None:
+                self._rendered.move_to_end(key)
+                return certificate
+
+        template = self.template(template_path)
+        if template is None:
+            return None
+        certificate = render_certificate(template, user_name, recorded_on)
+
+        with self._lock:
+            self._rendered[key] = certificate
+            while len(self._rendered) > self.max_rendered:
+                self._rendered.popitem(last=False)
+        return certificate
@@ -0,0 +1,543 @@
+import os
+import re
+import copy
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import secrets
+import sqlite3
+import logging
+import datetime
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from langchain_core.prompts import PromptTemplate
+
+from llm import LLM
+from retry_policy import LLM_RETRY_POLICY
+from request_metrics import request_metrics
+from tokens import count_tokens, truncate_tokens
+
+load_dotenv()
+
+# Session ids are issued by the server as uuid4().hex followed by its HMAC, so ids the server
+# did not issue are rejected without a lookup
+SESSION_ID_PATTERN = re.compile(r"([0-9a-f]{32})\.([0-9a-f]{32})")
+# Shared by every worker and kept across restarts, otherwise the ids issued by another process are rejected
+SESSION_SECRET = os.environ.get("CHAT_SESSION_SECRET") or secrets.token_hex(32)
+# Attempts to save a session when another request updated it concurrently
+SAVE_ATTEMPTS = 3
+
+# Summaries are written after the answer is sent, off the request path
+_compaction_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CHAT_COMPACTION_WORKERS", 4)), thread_name_prefix="chat-compaction"
+)
+
+
+def format_turns(turns):
+    """
+    Function to format turns the way the chat history is written in the chat prompts.
+
+    Args:
+    turns (list): The turns, each with a question and an answer.
+
+    Returns:
+    str: The formatted turns.
+    """
+    return "\n".join(f"User: {turn['question']}\nYou: {turn['answer']}" for turn in turns)
+
+
+def new_session(key, course_id, session_id):
+    return {
+        "_id": key,
+        "course_id": course_id,
+        "session_id": session_id,
+        "summary": "",
+        "summary_tokens": 0,
+        "summarized_turns": 0,
+        "turns": [],
+        "version": 0,
+    }
+
+
+class MemorySessionBackend:
+    """
+    In-process LRU backend, sessions are lost on restart and not shared between workers.
+
+    Attributes:
+    max_sessions (int): The maximum number of sessions kept.
+    """
+    blocking = False
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def load(self, key):
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                return None
+            session, expires_at = entry
+            if expires_at < time.time():
+                del self._sessions[key]
+                return None
+            self._sessions.move_to_end(key)
+            return copy.deepcopy(session)
+
+    def save(self, session, expected_version, ttl):
+        with self._lock:
+            entry = self._sessions.get(session["_id"])
+            version = entry[0]["version"] if entry is not None else 0
+            if version != expected_version:
+                return False
+            self._sessions[session["_id"]] = (copy.deepcopy(session), time.time() + ttl)
+            self._sessions.move_to_end(session["_id"])
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+
+class SQLiteSessionBackend:
+    """
+    On-disk SQLite backend, shared by every worker process on the host.
+
+    Attributes:
+    path (str): The path of the SQLite database.
+    """
+    blocking = True
+
+    def __init__(self, path="data/chat_sessions.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, version INTEGER NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS chat_sessions_expires_at ON chat_sessions (expires_at)")
+
+    def load(self, key):
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value FROM chat_sessions WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save(self, session, expected_version, ttl):
+        now = time.time()
+        value = json.dumps(session)
+        with self._lock, self._connection:
+            if expected_version == 0:
+                # Expired sessions are removed when new ones are created
+                self._connection.execute("DELETE FROM chat_sessions WHERE expires_at < ?", (now,))
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO chat_sessions (key, value, version, expires_at) VALUES (?, ?, ?, ?)",
+                    (session["_id"], value, session["version"], now + ttl),
+                )
+            else:
+                cursor = self._connection.execute(
+                    "UPDATE chat_sessions SET value = ?, version = ?, expires_at = ? WHERE key = ? AND version = ?",
+                    (value, session["version"], now + ttl, session["_id"], expected_version),
+                )
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM chat_sessions WHERE key = ?", (key,))
+
+
+class MongoSessionBackend:
+    """
+    Mongo backend, shared by every instance of the API. Expired sessions are removed by
+    a TTL index on expires_at.
+
+    Attributes:
+    collection: The pymongo collection holding the sessions.
+    """
+    blocking = True
+
+    def __init__(self, collection_name="chatsessions"):
+        from pymongo_client import AtlasClient
+
+        self.collection = AtlasClient().get_collection(collection_name)
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def load(self, key):
+        session = self.collection.find_one({"_id": key}, {"expires_at": 0})
+        return session
+
+    def save(self, session, expected_version, ttl):
+        from pymongo.errors import DuplicateKeyError
+
+        document = {**session, "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)}
+        if expected_version == 0:
+            try:
+                self.collection.insert_one(document)
+            except DuplicateKeyError:
+                return False
+            return True
+        result = self.collection.replace_one({"_id": session["_id"], "version": expected_version}, document)
+        return result.matched_count == 1
+
+    def delete(self, key):
+        self.collection.delete_one({"_id": key})
+
+
+class ChatSessions:
+    """
+    Server-side chat sessions. The turns of a session are kept verbatim until the history goes over
+    its token budget, then the oldest turns are folded into a running summary so the history sent
+    to the chat prompts stays bounded however long the conversation gets.
+
+    Sessions are updated with optimistic concurrency: every save checks the version that was loaded,
+    so a summary written in the background never drops a turn added in the meantime.
+
+    Attributes:
+    backend: The storage backend (MemorySessionBackend, SQLiteSessionBackend or MongoSessionBackend).
+    ttl (int): The time a session is kept after its last update, in seconds.
+    pending_ttl (int): The time a session with a single turn is kept, in seconds. Clients that never send
+    the issued session id back only leave short-lived sessions behind.
+    history_budget (int): The maximum number of tokens of the history, summary included.
+    summary_budget (int): The maximum number of tokens of the summary.
+    min_recent_turns (int): The number of most recent turns never folded into the summary.
+    """
+    def __init__(self, backend, ttl=7 * 24 * 3600, pending_ttl=3600, history_budget=1500, summary_budget=300,
+                 min_recent_turns=2):
+        """
+        The constructor for the ChatSessions class.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.history_budget = history_budget
+        self.summary_budget = summary_budget
+        self.min_recent_turns = min_recent_turns
+        self._summary_prompt = PromptTemplate(
+            template=json.load(open("data/prompts.json", "r"))["HISTORY_SUMMARY_PROMPT"],
+            input_variables=["summary", "conversation", "max_words"],
+        )
+        self._lock = threading.Lock()
+        self._compacting = set()
+        self._stats = {"turns": 0, "compactions": 0, "folded_turns": 0, "failed_compactions": 0, "conflicts": 0}
+
+    @staticmethod
+    def _key(course_id, session_id):
+        # Sessions are scoped to a course, the same id in another course is another conversation
+        return f"{course_id}:{session_id}"
+
+    def _load(self, course_id, session_id):
+        key = self._key(course_id, session_id)
+        try:
+            session = self.backend.load(key)
+        except Exception as e:
+            logging.error(f"Error in loading the chat session {key}: {e}")
+            session = None
+        return session if session is not None else new_session(key, course_id, session_id)
+
+    def _save(self, session, ttl=None):
+        # Returns False when the session was updated since it was loaded
+        expected_version = session["version"]
+        saved = {**session, "version": expected_version + 1}
+        if not self.backend.save(saved, expected_version, ttl or self.ttl):
+            with self._lock:
+                self._stats["conflicts"] += 1
+            return False
+        session["version"] = saved["version"]
+        return True
+
+    def render_history(self, session):
+        """
+        Function to write the history of a session for the chat prompts, within the token budget.
+
+        Args:
+        session (dict): The session.
+
+        Returns:
+        tuple: The history and the number of turns included verbatim.
+        """
+        remaining = self.history_budget - session["summary_tokens"]
+        recent = []
+        for turn in reversed(session["turns"]):
+            if turn["tokens"] > remaining:
+                # Turns not folded into the summary yet are left out rather than going over the budget
+                break
+            recent.append(turn)
+            remaining -= turn["tokens"]
+        recent.reverse()
+
+        parts = []
+        if session["summary"]:
+            parts.append(f"Summary of the earlier conversation: {session['summary']}")
+        if recent:
+            parts.append(format_turns(recent))
+        elif session["turns"]:
+            # The last turn alone is over the budget, keep its beginning
+            parts.append(truncate_tokens(format_turns(session["turns"][-1:]), max(remaining, 0)))
+        return "\n".join(parts), len(recent)
+
+    def history(self, course_id, session_id):
+        """
+        Function to get the history of a session for the chat prompts.
+
+        Args:
+        course_id (str): The app code of the course.
+        session_id (str): The session id.
+
+        Returns:
+        str: The history, empty for a new session.
+        """
+        session = self._load(course_id, session_id)
+        history, verbatim_turns = self.render_history(session)
+        request_metrics.record(
+            "chat_session", stage="history", history_tokens=count_tokens(history), verbatim_turns=verbatim_turns,
+            pending_turns=len(session["turns"]) - verbatim_turns, summarized_turns=session["summarized_turns"],
+        )
+        return history
+
+    def add_turn(self, course_id, session_id, question, answer, seed_history=None):
+        """
+        Function to add a turn to a session, and fold the oldest turns into the summary in the
+        background if the history went over its budget.
+
+        Args:
+        course_id (str): The app code of the course.
+        session_id (str): The session id.
+        question (str): The question of the user.
+        answer (str): The answer sent back.
+        seed_history (str): The history sent by the client, kept as the summary of a new session.
+
+        Returns:
+        bool: Whether the turn was saved.
+        """
+        turn = {"id": uuid.uuid4().hex, "question": question, "answer": answer}
+        turn["tokens"] = count_tokens(format_turns([turn])) + 1
+        try:
+            for _ in range(SAVE_ATTEMPTS):
+                session = self._load(course_id, session_id)
+                is_new = session["version"] == 0
+                if is_new and seed_history:
+                    # The conversation the client had before the session started, its most recent part
+                    # within the summary budget so the history budget still applies
+                    session["summary"] = truncate_tokens(str(seed_history), self.summary_budget, keep_end=True)
+                    session["summary_tokens"] = count_tokens(session["summary"])
+                session["turns"].append(turn)
+                if self._save(session, self.pending_ttl if is_new else self.ttl):
+                    break
+            else:
+                logging.error(f"Error in saving the chat session {session['_id']}: too many concurrent updates")
+                return False
+        except Exception as e:
+            logging.error(f"Error in saving the chat session {self._key(course_id, session_id)}: {e}")
+            return False
+
+        with self._lock:
+            self._stats["turns"] += 1
+        if self._turns_to_fold(session):
+            # The compaction runs in a copy of the request context so its metrics keep the request id
+            _compaction_executor.submit(contextvars.copy_context().run, self.compact, course_id, session_id)
+        return True
+
+    def _turns_to_fold(self, session):
+        turns = session["turns"]
+        if session["summary_tokens"] + sum(turn["tokens"] for turn in turns) <= self.history_budget:
+            return []
+        # Keep the newest turns that fit next to a full summary, and at least min_recent_turns
+        recent_budget = self.history_budget - self.summary_budget
+        kept, kept_tokens = 0, 0
+        for turn in reversed(turns):
+            if kept >= self.min_recent_turns and kept_tokens + turn["tokens"] > recent_budget:
+                break
+            kept += 1
+            kept_tokens += turn["tokens"]
+        return turns[:len(turns) - kept]
+
+    def _summarize(self, summary, turns):
+        llm = LLM("chatgpt")
+        inputs = {
+            "summary": summary or "(none)",
+            "conversation": format_turns(turns),
+            "max_words": int(self.summary_budget * 0.7),
+        }
+        response = LLM_RETRY_POLICY.run(
+            lambda previous_error: llm.get_response(self._summary_prompt, inputs=inputs), name="Chat history summary"
+        )
+        return truncate_tokens(response.strip(), self.summary_budget)
+
+    def _fold(self, course_id, session_id):
+        # Returns the session once the oldest turns are folded into its summary, or None if there was nothing to fold
+        key = self._key(course_id, session_id)
+        session = self._load(course_id, session_id)
+        folded = self._turns_to_fold(session)
+        if not folded:
+            return None
+        start = time.perf_counter()
+        summary = self._summarize(session["summary"], folded)
+        folded_ids = [turn["id"] for turn in folded]
+
+        for _ in range(SAVE_ATTEMPTS):
+            # Turns may have been added while summarizing, only the folded ones are removed
+            if [turn["id"] for turn in session["turns"][:len(folded)]] != folded_ids:
+                logging.warning(f"The chat session {key} changed while it was being summarized")
+                return None
+            session["summary"] = summary
+            session["summary_tokens"] = count_tokens(summary)
+            session["summarized_turns"] += len(folded)
+            session["turns"] = session["turns"][len(folded):]
+            if self._save(session):
+                break
+            session = self._load(course_id, session_id)
+        else:
+            return None
+
+        with self._lock:
+            self._stats["compactions"] += 1
+            self._stats["folded_turns"] += len(folded)
+        request_metrics.record(
+            "chat_session", stage="compaction", folded_turns=len(folded), summary_tokens=session["summary_tokens"],
+            latency_ms=round((time.perf_counter() - start) * 1000, 2),
+        )
+        return session
+
+    def compact(self, course_id, session_id):
+        """
+        Function to fold the oldest turns of a session into its summary. The summary is generated from the
+        previous summary and the folded turns only, so its cost does not grow with the conversation.
+        Turns added while summarizing are folded in the next round.
+
+        Args:
+        course_id (str): The app code of the course.
+        session_id (str): The session id.
+
+        Returns:
+        bool: Whether the session was compacted.
+        """
+        key = self._key(course_id, session_id)
+        with self._lock:
+            if key in self._compacting:
+                return False
+            self._compacting.add(key)
+
+        compacted = False
+        try:
+            while True:
+                session = self._fold(course_id, session_id)
+                if session is None:
+                    break
+                compacted = True
+                if not self._turns_to_fold(session):
+                    break
+        except Exception as e:
+            logging.error(f"Error in summarizing the chat session {key}: {e}")
+            with self._lock:
+                self._stats["failed_compactions"] += 1
+        finally:
+            with self._lock:
+                self._compacting.discard(key)
+        return compacted
+
+    def delete(self, course_id, session_id):
+        """
+        Function to delete a session.
+
+        Args:
+        course_id (str): The app code of the course.
+        session_id (str): The session id.
+        """
+        try:
+            self.backend.delete(self._key(course_id, session_id))
+        except Exception as e:
+            logging.error(f"Error in deleting the chat session {self._key(course_id, session_id)}: {e}")
+
+    def stats(self):
+        """
+        Function to get the session statistics.
+
+        Returns:
+        dict: The backend, budgets, turns added and compactions.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["backend"] = type(self.backend).__name__
+        stats["history_budget"] = self.history_budget
+        stats["summary_budget"] = self.summary_budget
+        return stats
+
+
+def _sign(value):
+    return hmac.new(SESSION_SECRET.encode(), value.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def new_session_id():
+    """
+    Function to issue the id of a new chat session.
+
+    Returns:
+    str: The session id, a random id and its signature.
+    """
+    value = uuid.uuid4().hex
+    return f"{value}.{_sign(value)}"
+
+
+def valid_session_id(session_id):
+    """
+    Function to check a session id sent by a client.
+
+    Args:
+    session_id: The session id.
+
+    Returns:
+    bool: True if the session id was issued by new_session_id with the same CHAT_SESSION_SECRET.
+    """
+    if not isinstance(session_id, str):
+        return False
+    match = SESSION_ID_PATTERN.fullmatch(session_id)
+    return match is not None and hmac.compare_digest(match.group(2), _sign(match.group(1)))
+
+
+def create_chat_sessions():
+    """
+    Function to create the chat sessions configured by CHAT_SESSION_BACKEND ("memory", "sqlite", "mongo"
+    or "none", the default), CHAT_SESSION_SECRET, CHAT_SESSION_TTL_SECONDS, CHAT_SESSION_PENDING_TTL_SECONDS,
+    CHAT_HISTORY_TOKEN_BUDGET, CHAT_SUMMARY_TOKEN_BUDGET and CHAT_MIN_RECENT_TURNS.
+
+    Returns:
+    ChatSessions: The sessions, or None if server-side sessions are disabled.
+    """
+    backend_name = os.environ.get("CHAT_SESSION_BACKEND", "none").lower()
+    if backend_name == "none":
+        return None
+    if not os.environ.get("CHAT_SESSION_SECRET"):
+        logging.warning("CHAT_SESSION_SECRET is not set, session ids are only valid in this process until it restarts")
+    try:
+        if backend_name == "mongo":
+            backend = MongoSessionBackend()
+        elif backend_name == "memory":
+            backend = MemorySessionBackend(int(os.environ.get("CHAT_SESSION_MAX_SESSIONS", 10000)))
+        else:
+            backend = SQLiteSessionBackend(os.environ.get("CHAT_SESSION_PATH", "data/chat_sessions.sqlite"))
+    except Exception as e:
+        logging.error(f"Error in creating the {backend_name} chat session store, falling back to memory: {e}")
+        backend = MemorySessionBackend(int(os.environ.get("CHAT_SESSION_MAX_SESSIONS", 10000)))
+    return ChatSessions(
+        backend,
+        ttl=int(os.environ.get("CHAT_SESSION_TTL_SECONDS", 7 * 24 * 3600)),
+        pending_ttl=int(os.environ.get("CHAT_SESSION_PENDING_TTL_SECONDS", 3600)),
+        history_budget=int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", 1500)),
+        summary_budget=int(os.environ.get("CHAT_SUMMARY_TOKEN_BUDGET", 300)),
+        min_recent_turns=int(os.environ.get("CHAT_MIN_RECENT_TURNS", 2)),
+    )
+
+
+chat_sessions = create_chat_sessions()
@@ -0,0 +1,96 @@
+import re
+import json
+
+
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "/": "/", "\\": "\\", '"': '"'}
+
+
+class AnswerStreamExtractor:
+    """
+    Extracts the value of one string field from a JSON object while the object is being streamed,
+    so the answer can be shown token by token before the whole response can be parsed.
+
+    Attributes:
+    key (str): The field to extract.
+    done (bool): Whether the end of the value was reached.
+    """
+    def __init__(self, key="answer"):
+        """
+        The constructor for the AnswerStreamExtractor class.
+        """
+        self.key = key
+        self.done = False
+        self._pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(key))
+        self._in_value = False
+        self._buffer = ""
+
+    def feed(self, chunk):
+        """
+        Function to feed the next chunk of the streamed response.
+
+        Args:
+        chunk (str): The chunk.
+
+        Returns:
+        str: The decoded text of the field found in this chunk, possibly empty.
+        """
+        if self.done:
+            return ""
+        self._buffer += chunk
+        if not self._in_value:
+            match = self._pattern.search(self._buffer)
+            if match is None:
+                return ""
+            self._buffer = self._buffer[match.end():]
+            self._in_value = True
+
+        text = []
+        buffer = self._buffer
+        i = 0
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char != "\\":
+                text.append(char)
+                i += 1
+                continue
+            # Escape sequences split across chunks wait for the next chunk
+            if i + 1 >= len(buffer):
+                break
+            escape = buffer[i + 1]
+            if escape != "u":
+                text.append(_ESCAPES.get(escape, escape))
+                i += 2
+                continue
+            if i + 6 > len(buffer):
+                break
+            code = int(buffer[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # High surrogate, decode it together with the low surrogate that follows
+                if i + 12 > len(buffer):
+                    break
+                low = int(buffer[i + 8:i + 12], 16)
+                text.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                i += 12
+            else:
+                text.append(chr(code))
+                i += 6
+        self._buffer = buffer[i:]
+        return "".join(text)
+
+
+def sse_event(event, data):
+    """
+    Function to format a server-sent event.
+
+    Args:
+    event (str): The event name.
+    data: The JSON serializable payload.
+
+    Returns:
+    str: The event in the text/event-stream format.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
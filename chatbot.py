@@ -7,9 +7,58 @@ from dotenv import load_dotenv
 import logging
 from langchain.output_parsers import StructuredOutputParser, ResponseSchema
 import json
+import time
+import asyncio
+import difflib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from retry_policy import CHAT_RETRY_POLICY, ParseError, RetryError, AttemptRecord, PARSE
+from structured_output import parse_structured, openai_json_kwargs, retry_stats
+from request_metrics import request_metrics
+from chat_stream import AnswerStreamExtractor
 
 load_dotenv()
 
+# Retrieval on the raw question while its ambiguity is being resolved, "false" runs the stages in sequence
+SPECULATIVE_RETRIEVAL = os.environ.get("CHAT_SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+# Similarity above which the resolved question reuses the retrieval of the raw question
+SPECULATION_THRESHOLD = float(os.environ.get("CHAT_SPECULATION_THRESHOLD", 0.9))
+
+# Answer returned when no well-formed answer could be generated
+CHAT_ERROR_ANSWER = "Something went wrong! Please try again!"
+
+_speculation_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CHAT_SPECULATION_WORKERS", 8)), thread_name_prefix="chat-speculation"
+)
+
+
+def _normalize_question(question):
+    return " ".join(question.lower().split()).strip(" ?.!")
+
+
+def questions_match(question, resolved_question, threshold=SPECULATION_THRESHOLD):
+    """
+    Function to check whether a resolved question is close enough to the raw question to reuse its context.
+
+    Args:
+    question (str): The raw question.
+    resolved_question (str): The question returned by the ambiguity resolution.
+    threshold (float): The minimum similarity ratio.
+
+    Returns:
+    bool: True if the questions are (near-)identical.
+    """
+    question, resolved_question = _normalize_question(question), _normalize_question(resolved_question)
+    if question == resolved_question:
+        return True
+    return difflib.SequenceMatcher(None, question, resolved_question).ratio() >= threshold
+
+
+def _record_stage(stage, start, **fields):
+    elapsed = time.perf_counter() - start
+    request_metrics.record("chat", stage=stage, latency_ms=round(elapsed * 1000, 2), **fields)
+    return elapsed
+
 class ChatBot:
     """
     Class to handle the chatbot functionality.
@@ -74,22 +123,68 @@ class ChatBot:
         output = llm(_input.to_messages())
         return output.content
 
-    def get_response(self, history, question):
+    def _timed_context(self, question):
+        start = time.perf_counter()
+        context = self.get_question_context(question)
+        return context, time.perf_counter() - start
+
+    def resolve_and_retrieve(self, history, question):
         """
-        Function to get the response to the given question.
+        Function to resolve the question and get its context. Without history there is nothing to
+        resolve. Otherwise the context of the raw question is retrieved while the question is being
+        resolved, and kept if the resolved question is (near-)identical to it.
 
         Args:
+        history (str): The chat history.
         question (str): The question.
 
         Returns:
-        dict: The response to the question.
+        tuple: The resolved question and its context.
         """
-        print(f"Getting the response for the question: {question}")
-        # Resolve the question
-        question = self.resolve_question(history, question)
-        print(f"Resolved question: {question}")
+        start = time.perf_counter()
+        if not history:
+            context = self.get_question_context(question)
+            _record_stage("retrieval", start, resolution="skipped")
+            return question, context
+
+        if not SPECULATIVE_RETRIEVAL:
+            resolved_question = self.resolve_question(history, question)
+            _record_stage("resolution", start)
+            retrieval_start = time.perf_counter()
+            context = self.get_question_context(resolved_question)
+            _record_stage("retrieval", retrieval_start, speculative=False)
+            return resolved_question, context
+
+        # The speculative retrieval runs in a copy of the request context so its metrics keep the request id
+        speculation = _speculation_executor.submit(contextvars.copy_context().run, self._timed_context, question)
+        resolved_question = self.resolve_question(history, question)
+        resolution_seconds = _record_stage("resolution", start)
+
+        if questions_match(question, resolved_question):
+            context, retrieval_seconds = speculation.result()
+            # The retrieval overlapped the resolution instead of following it
+            _record_stage("retrieval", start, speculative=True, reused=True,
+                          saved_ms=round(min(retrieval_seconds, resolution_seconds) * 1000, 2))
+            return resolved_question, context
+
+        retrieval_start = time.perf_counter()
+        context = self.get_question_context(resolved_question)
+        _record_stage("retrieval", retrieval_start, speculative=True, reused=False, saved_ms=0)
+        return resolved_question, context
+
+    def _answer_prompts(self, history, context, question):
+        """
+        Function to build the answer prompt and the error prompt used when an answer cannot be parsed.
+
+        Args:
+        history (str): The chat history.
+        context (str): The context of the question.
+        question (str): The resolved question.
 
-        # Create the output parser
+        Returns:
+        tuple: The formatted answer prompt and the error prompt.
+        """
+        # The output parser only provides the format instructions, answers are parsed with parse_structured
         response_schemas = [
                 ResponseSchema(name="answer", description="Your answer to the given question in markdown format", type = 'markdown'),
                 ResponseSchema(name="follow_up_questions", description="A list of 3 follow-up questions that the user may have based on the question.", type = 'list')
@@ -97,8 +192,6 @@ class ChatBot:
         output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
         format_instructions = output_parser.get_format_instructions()
 
-        # Get the context
-        context = self.get_question_context(question)
         print(f"Context: {context}")
         print(f"Context for the question {question}: {context}")
         # Get the response prompt
@@ -119,50 +212,119 @@ class ChatBot:
 
         print(f"Input: {_input.to_messages()}")
 
-        # Get the response
-        output = self.chat_model(_input.to_messages())
+        # Load the error prompt used when the previous answer could not be parsed
+        retry_prompt = json.load(open("data/prompts.json", "r"))["RETRY_PROMPT"]
+        error_prompt = ChatPromptTemplate(
+            messages=[
+                    HumanMessagePromptTemplate.from_template(retry_prompt)
+                    ],
+            input_variables=["e","history","context","question"],
+            partial_variables={"format_instructions": format_instructions}
+        )
+        return _input, error_prompt
+
+    def get_response(self, history, question):
+        """
+        Function to get the response to the given question.
+
+        Args:
+        question (str): The question.
+
+        Returns:
+        dict: The response to the question.
+        """
+        print(f"Getting the response for the question: {question}")
+        # Resolve the question and get its context
+        question, context = self.resolve_and_retrieve(history, question)
+        print(f"Resolved question: {question}")
+
+        _input, error_prompt = self._answer_prompts(history, context, question)
+        json_kwargs = openai_json_kwargs(_input.to_string())
+
+        def attempt(previous_error):
+            # If the previous output was not in JSON format, regenerate the answer with the error prompt
+            if isinstance(previous_error, ParseError):
+                messages = error_prompt.format_prompt(e=previous_error, history=history, context=context, question=question).to_messages()
+            else:
+                messages = _input.to_messages()
+
+            # Get the response, in JSON mode a single call is enough unless the answer misses a field
+            output = self.chat_model.invoke(messages, **json_kwargs)
+            print(output)
+            return parse_structured(output.content, "RESPONSE_PROMPT")
+
+        answer_start = time.perf_counter()
+        attempts = []
+        try:
+            json_output = CHAT_RETRY_POLICY.run(attempt, name="Chat answer", attempts=attempts)
+            _record_stage("answer", answer_start, attempts=len(attempts))
+        except RetryError as e:
+            # If the answer cannot be generated, return an error message
+            logging.warning(f"Error in getting the response for the question {question}: {e}")
+            return {'answer': CHAT_ERROR_ANSWER,
+                'follow_up_questions': []}
+        finally:
+            retry_stats.record("RESPONSE_PROMPT", "chatgpt", attempts, json_mode=bool(json_kwargs))
+
+        print(f"Response for the question {question}: {json_output}")
+        return json_output
+
+    async def astream_response(self, history, question):
+        """
+        Function to stream the response to the given question. The answer is streamed as the model
+        produces it, then the parsed answer and follow-up questions are sent once the response is complete.
+
+        Args:
+        history (str): The chat history.
+        question (str): The question.
+
+        Yields:
+        tuple: ("token", {"text": ...}) for each piece of the answer, then ("done", response) where
+        response has the same shape as the one returned by get_response. If the streamed response cannot
+        be parsed, ("reset", {}) tells the client to discard the text streamed so far, and the regenerated
+        answer follows as a single "token" event.
+        """
+        question, context = await asyncio.to_thread(self.resolve_and_retrieve, history, question)
+        _input, error_prompt = self._answer_prompts(history, context, question)
+        json_kwargs = openai_json_kwargs(_input.to_string())
+
+        answer_start = time.perf_counter()
+        first_token_ms = None
+        extractor = AnswerStreamExtractor("answer")
+        content = ""
+        async for chunk in self.chat_model.astream(_input.to_messages(), **json_kwargs):
+            content += chunk.content
+            text = extractor.feed(chunk.content)
+            if text:
+                if first_token_ms is None:
+                    first_token_ms = round((time.perf_counter() - answer_start) * 1000, 2)
+                yield "token", {"text": text}
+
+        # The streamed call is the first attempt, the regenerations are numbered after it
+        try:
+            json_output = parse_structured(content, "RESPONSE_PROMPT")
+            attempts = [AttemptRecord(1, time.perf_counter() - answer_start)]
+        except ParseError as first_error:
+            # The streamed answer could not be parsed, regenerate it with the error prompt
+            attempts = [AttemptRecord(1, time.perf_counter() - answer_start, PARSE, first_error)]
+            if first_token_ms is not None:
+                yield "reset", {}
+
+            async def attempt(previous_error):
+                messages = error_prompt.format_prompt(
+                    e=previous_error or first_error, history=history, context=context, question=question
+                ).to_messages()
+                output = await self.chat_model.ainvoke(messages, **json_kwargs)
+                return parse_structured(output.content, "RESPONSE_PROMPT")
 
-        print(output)
-        
-        valid_json = False
-        runs = 0
-        while (valid_json == False):
             try:
-                # Parse the output
-                json_output = output_parser.parse(output.content)
-                valid_json = True
-                print(f"Response for the question {question}: {output.content}")
-
-                # Update the chat history
-                history += f"""\n
-                User: {question}
-                You: {str(json_output['answer'])}"""
-
-            except Exception as e:
-                # If the output is not in JSON format, regenerate the answer for 5 runs
-                logging.warning(f"Error in parsing the response for the question {question}: {e}")
-                runs+=1
-                if runs < 4:
-
-                    # Load the error prompt
-                    retry_prompt = json.load(open("data/prompts.json", "r"))["RETRY_PROMPT"]
-                    error_prompt = ChatPromptTemplate(
-                        messages=[
-                                HumanMessagePromptTemplate.from_template(retry_prompt)
-                                ],
-                        input_variables=["e","history","context","question"],
-                        partial_variables={"format_instructions": format_instructions}
-                    )
-
-                    # Format the error prompt
-                    _error_input = error_prompt.format_prompt(e=e, history=history, context = context, question=question)
-
-                    # Get the response
-                    output = self.chat_model(_error_input.to_messages())
-
-                # If the answer cannot be generated, return an error message
-                else:
-                    return {'answer': f"Something went wrong! Please try again!",
-                        'follow_up_questions': []}
-                    
-        return json_output
\ No newline at end of file
+                json_output = await CHAT_RETRY_POLICY.arun(attempt, name="Chat answer", attempts=attempts)
+            except RetryError as retry_error:
+                logging.warning(f"Error in getting the response for the question {question}: {retry_error}")
+                json_output = {'answer': CHAT_ERROR_ANSWER, 'follow_up_questions': []}
+            # The regeneration is not streamed, its answer replaces the text streamed so far
+            yield "token", {"text": json_output["answer"]}
+
+        retry_stats.record("RESPONSE_PROMPT", "chatgpt", attempts, json_mode=bool(json_kwargs))
+        _record_stage("answer", answer_start, streamed=True, first_token_ms=first_token_ms, attempts=len(attempts))
+        yield "done", json_output
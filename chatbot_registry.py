@@ -0,0 +1,282 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+
+from chatbot import ChatBot
+from index_sync import CONFIG_PATH, course_prefixes, current_location
+
+load_dotenv()
+
+
+# Directory of the in-repo retriever indexes, used for a course until it is synced with index_sync.py
+CHATBOT_DIR = "chatbot"
+
+
+def chatbot_locations(config_path=CONFIG_PATH):
+    """
+    Function to get the in-repo retriever directory of every course in config_list.json.
+
+    Args:
+    config_path (str): The path of config_list.json.
+
+    Returns:
+    dict: The retriever directory for each course app code.
+    """
+    return {
+        course_code: os.path.join(CHATBOT_DIR, prefix).rstrip("/")
+        for course_code, prefix in course_prefixes(config_path).items()
+    }
+
+
+def _estimate_size(location):
+    """
+    Estimate the memory held by a loaded course index from its size on disk.
+
+    Args:
+    location (str): The retriever directory of the course.
+
+    Returns:
+    int: The total size of the index files in bytes.
+    """
+    total = 0
+    for root, _, files in os.walk(location):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                continue
+    return total
+
+
+class ChatBotRegistry:
+    """
+    Process-wide registry of loaded ChatBot instances keyed by course app code.
+
+    Loaded chatbots (and the FAISS/BM25 retrievers they hold) are kept alive across
+    requests and evicted in least-recently-used order once either the number of
+    courses or the estimated index memory goes over its bound. Concurrent requests
+    for a course that is not loaded yet wait on a single load.
+
+    Attributes:
+    max_courses (int): The maximum number of courses kept loaded.
+    max_memory_bytes (int): The maximum estimated index memory kept loaded.
+    locations (dict): The in-repo retriever location for each course app code.
+    """
+    def __init__(self, max_courses=None, max_memory_mb=None, locations=None, factory=ChatBot):
+        """
+        The constructor for the ChatBotRegistry class.
+        """
+        if max_courses is None:
+            max_courses = int(os.environ.get("CHATBOT_REGISTRY_MAX_COURSES", 8))
+        if max_memory_mb is None:
+            max_memory_mb = int(os.environ.get("CHATBOT_REGISTRY_MAX_MEMORY_MB", 2048))
+
+        self.max_courses = max_courses
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.locations = locations if locations is not None else chatbot_locations()
+        self._factory = factory
+
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._load_seconds = {}
+
+    def location(self, course_code):
+        """
+        Function to get the retriever directory of a course, preferring the synced version in use.
+
+        Args:
+        course_code (str): The course app code.
+
+        Returns:
+        str: The retriever directory, or None if the course has no chatbot.
+        """
+        return current_location(course_code) or self.locations.get(course_code)
+
+    def supports(self, course_code):
+        """
+        Function to check whether a course has a chatbot.
+
+        Args:
+        course_code (str): The course app code.
+
+        Returns:
+        bool: True if the course has a synced or in-repo retriever index on disk.
+        """
+        location = self.location(course_code)
+        return location is not None and os.path.isdir(location)
+
+    def get(self, course_code):
+        """
+        Function to get the loaded chatbot for a course, loading it on a miss.
+
+        Args:
+        course_code (str): The course app code.
+
+        Returns:
+        ChatBot: The chatbot for the course.
+        """
+        location = self.location(course_code)
+        with self._lock:
+            entry = self._entries.get(course_code)
+            if entry is not None and entry["location"] == location:
+                self._entries.move_to_end(course_code)
+                self._hits += 1
+                return entry["chatbot"]
+            self._misses += 1
+            load_lock = self._load_locks.setdefault(course_code, threading.Lock())
+
+        # Only one thread loads a given course; the others wait and reuse its result
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(course_code)
+                if entry is not None and entry["location"] == location:
+                    self._entries.move_to_end(course_code)
+                    return entry["chatbot"]
+            return self._load(course_code, location)
+
+    def _load(self, course_code, location):
+        """
+        Function to load the chatbot for a course and register it, replacing a chatbot
+        loaded from a previous index version.
+
+        Args:
+        course_code (str): The course app code.
+        location (str): The retriever directory to load.
+
+        Returns:
+        ChatBot: The loaded chatbot.
+        """
+        start = time.perf_counter()
+        chatbot = self._factory(location)
+        elapsed = time.perf_counter() - start
+        size = _estimate_size(location)
+        logging.info(f"Loaded chatbot for {course_code} from {location} in {elapsed:.2f}s")
+
+        with self._lock:
+            previous = self._entries.pop(course_code, None)
+            if previous is not None:
+                self._memory_bytes -= previous["size"]
+            self._entries[course_code] = {"chatbot": chatbot, "size": size, "location": location}
+            self._memory_bytes += size
+            self._load_seconds[course_code] = elapsed
+            self._evict()
+        return chatbot
+
+    def _evict(self):
+        """
+        Function to evict least recently used chatbots until the registry is within bounds.
+        Must be called with the registry lock held. The most recently loaded course is never evicted.
+        """
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_courses or self._memory_bytes > self.max_memory_bytes
+        ):
+            course_code, entry = self._entries.popitem(last=False)
+            self._memory_bytes -= entry["size"]
+            self._evictions += 1
+            logging.info(f"Evicted chatbot for {course_code}")
+
+    def preload(self, course_codes=None, max_workers=4):
+        """
+        Function to load the chatbots for a set of courses in parallel.
+
+        Args:
+        course_codes (list): The course app codes to load. Defaults to every course with a chatbot.
+        Only the first max_courses courses are loaded.
+        max_workers (int): The number of courses loaded at the same time.
+
+        Returns:
+        dict: The load time in seconds for each course, or None if its load failed.
+        """
+        if course_codes is None:
+            course_codes = list(self.locations.keys())
+        course_codes = [code for code in course_codes if self.supports(code)]
+        # Loading more courses than the registry keeps would only evict the first ones again
+        if len(course_codes) > self.max_courses:
+            logging.warning(
+                f"Preloading the first {self.max_courses} of {len(course_codes)} courses, raise "
+                f"CHATBOT_REGISTRY_MAX_COURSES to preload {', '.join(course_codes[self.max_courses:])}"
+            )
+            course_codes = course_codes[:self.max_courses]
+
+        timings = {}
+        if not course_codes:
+            return timings
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chatbot-preload") as executor:
+            futures = {executor.submit(self._timed_get, code): code for code in course_codes}
+            for future in as_completed(futures):
+                code = futures[future]
+                try:
+                    timings[code] = future.result()
+                    logging.info(f"Preloaded chatbot for {code} in {timings[code]:.2f}s")
+                except Exception as e:
+                    timings[code] = None
+                    logging.error(f"Error in preloading chatbot for {code}: {e}")
+        return timings
+
+    def _timed_get(self, course_code):
+        """
+        Function to get a course chatbot and time how long it took.
+
+        Args:
+        course_code (str): The course app code.
+
+        Returns:
+        float: The time taken in seconds.
+        """
+        start = time.perf_counter()
+        self.get(course_code)
+        return time.perf_counter() - start
+
+    def is_loaded(self, course_code):
+        """
+        Function to check whether a course is currently loaded.
+
+        Args:
+        course_code (str): The course app code.
+
+        Returns:
+        bool: True if the course is loaded.
+        """
+        with self._lock:
+            return course_code in self._entries
+
+    def clear(self):
+        """
+        Function to drop every loaded chatbot.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+
+    def stats(self):
+        """
+        Function to get the registry statistics.
+
+        Returns:
+        dict: The hit, miss, eviction and load time statistics.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "loaded_courses": list(self._entries.keys()),
+                "estimated_memory_mb": round(self._memory_bytes / (1024 * 1024), 2),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "load_seconds": dict(self._load_seconds),
+            }
+
+
+chatbot_registry = ChatBotRegistry()
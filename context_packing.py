@@ -0,0 +1,174 @@
+import os
+import re
+import time
+from dotenv import load_dotenv
+
+from request_metrics import request_metrics
+from tokens import count_tokens
+
+load_dotenv()
+
+# The chunks are split with chunk_overlap=100, overlaps are searched a bit beyond that
+MAX_OVERLAP_CHARS = 400
+# Shorter common text is likely a coincidence, not a split overlap
+MIN_OVERLAP_CHARS = 20
+SEPARATOR = "\n\n"
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+_WORD = re.compile(r"\w+")
+_STOPWORDS = {
+    "the", "and", "for", "are", "was", "were", "what", "which", "who", "whom", "how", "why", "when", "where",
+    "does", "did", "can", "could", "would", "should", "will", "with", "this", "that", "these", "those", "from",
+    "about", "into", "its", "their", "there", "them", "they", "you", "your", "has", "have", "had", "not", "but",
+}
+
+
+def overlap_length(previous, text, min_overlap=MIN_OVERLAP_CHARS, max_overlap=MAX_OVERLAP_CHARS):
+    """
+    Function to find the text repeated at the end of a chunk and the start of the next one.
+
+    Args:
+    previous (str): The chunk coming first in the source.
+    text (str): The chunk that may follow it.
+    min_overlap (int): The shortest overlap considered, in characters.
+    max_overlap (int): The longest overlap considered, in characters.
+
+    Returns:
+    int: The length of the overlap at the start of text, 0 if the chunks do not overlap.
+    """
+    for length in range(min(len(previous), len(text), max_overlap), min_overlap - 1, -1):
+        if previous.endswith(text[:length]):
+            return length
+    return 0
+
+
+def query_terms(query):
+    return {word for word in _WORD.findall(query.lower()) if len(word) > 2 and word not in _STOPWORDS}
+
+
+def relevant_sentences(text, terms, max_tokens=None):
+    """
+    Function to keep the sentences of a chunk that share terms with the query.
+
+    Args:
+    text (str): The chunk.
+    terms (set): The query terms from query_terms.
+    max_tokens (int): The maximum number of tokens kept, the most relevant sentences first.
+
+    Returns:
+    str: The kept sentences in their original order, empty if none is relevant.
+    """
+    sentences = [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+    scored = []
+    for position, sentence in enumerate(sentences):
+        score = len(terms & set(_WORD.findall(sentence.lower())))
+        if score:
+            scored.append((score, position, sentence))
+
+    kept, used = [], 0
+    for score, position, sentence in sorted(scored, key=lambda item: (-item[0], item[1])):
+        tokens = count_tokens(sentence) + 1
+        if max_tokens is not None and used + tokens > max_tokens:
+            continue
+        kept.append((position, sentence))
+        used += tokens
+    return " ".join(sentence for _, sentence in sorted(kept))
+
+
+class ContextPacker:
+    """
+    Assembles the context of a question from the reranked chunks within a token budget. Chunks are taken
+    by decreasing rerank score, a chunk adjacent in the course text to one already taken is joined to it
+    without the text the splitter repeated between them, and chunks can optionally be cut to the sentences
+    sharing terms with the question.
+
+    Attributes:
+    token_budget (int): The maximum number of tokens of the context.
+    min_relevance (float): Chunks with a lower rerank score are left out.
+    trim_sentences (bool): Whether to keep only the sentences relevant to the question.
+    """
+    def __init__(self, token_budget=2000, min_relevance=0.0, trim_sentences=False):
+        """
+        The constructor for the ContextPacker class.
+        """
+        self.token_budget = token_budget
+        self.min_relevance = min_relevance
+        self.trim_sentences = trim_sentences
+
+    @staticmethod
+    def _continuation(packed, text):
+        # Finds a packed passage the chunk continues or precedes in the course text, and the text it adds to it
+        for index, passage in enumerate(packed):
+            length = overlap_length(passage, text)
+            if length:
+                return index, "append", text[length:]
+            length = overlap_length(text, passage)
+            if length:
+                return index, "prepend", text[:len(text) - length]
+        return None, None, text
+
+    def pack(self, documents, query):
+        """
+        Function to build the context from the reranked chunks.
+
+        Args:
+        documents (list): The reranked chunks, with their relevance_score in the metadata.
+        query (str): The question.
+
+        Returns:
+        str: The context.
+        """
+        start = time.perf_counter()
+        ranked = sorted(
+            enumerate(documents),
+            key=lambda item: (-item[1].metadata.get("relevance_score", 0.0), item[0]),
+        )
+        terms = query_terms(query) if self.trim_sentences else set()
+        separator_tokens = count_tokens(SEPARATOR)
+
+        packed, used, merged, trimmed = [], 0, 0, 0
+        for _, document in ranked:
+            text = document.page_content.strip()
+            if not text or document.metadata.get("relevance_score", 0.0) < self.min_relevance:
+                continue
+            index, position, addition = self._continuation(packed, text)
+            if terms:
+                sentences = relevant_sentences(addition, terms)
+                if sentences and sentences != addition.strip():
+                    addition = " " + sentences + " " if index is not None else sentences
+                    trimmed += 1
+            tokens = count_tokens(addition) + (separator_tokens if index is None and packed else 0)
+            if used + tokens > self.token_budget:
+                # Smaller chunks further down may still fit
+                continue
+            if index is None:
+                packed.append(addition)
+            elif position == "append":
+                packed[index] = packed[index] + addition
+                merged += 1
+            else:
+                packed[index] = addition + packed[index]
+                merged += 1
+            used += tokens
+
+        request_metrics.record(
+            "retrieval", stage="packing", latency_ms=round((time.perf_counter() - start) * 1000, 2),
+            documents=len(documents), packed=len(packed), merged=merged, trimmed=trimmed,
+            context_tokens=used, token_budget=self.token_budget,
+        )
+        return SEPARATOR.join(packed)
+
+
+def create_context_packer():
+    """
+    Function to create the context packer configured by CONTEXT_TOKEN_BUDGET, CONTEXT_MIN_RELEVANCE
+    and CONTEXT_TRIM_SENTENCES.
+
+    Returns:
+    ContextPacker: The context packer.
+    """
+    return ContextPacker(
+        token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", 2000)),
+        min_relevance=float(os.environ.get("CONTEXT_MIN_RELEVANCE", 0.0)),
+        trim_sentences=os.environ.get("CONTEXT_TRIM_SENTENCES", "false").lower() == "true",
+    )
@@ -1,162 +1,306 @@
-import io
-import datetime
-import cv2
+import asyncio
+import logging
 from s3_file_manager import S3FileManager
-import json
-from pymongo_client import AtlasClient
+from asset_cache import create_asset_cache
+from certificates import CertificateRenderer
+from pymongo_client import AtlasClient, AsyncAtlasClient
 from bson.objectid import ObjectId
 import base64
-from chatbot import ChatBot
-import numpy as np
+from chatbot_registry import chatbot_registry
+from reference_data import reference_data
+from chat_stream import sse_event
+from chat_sessions import chat_sessions, new_session_id, valid_session_id
+from chatbot import CHAT_ERROR_ANSWER
 
 
-config_list = json.load(open("data/config_list.json", "r"))
 s3 = S3FileManager()
+asset_cache = create_asset_cache(s3)
+certificate_renderer = CertificateRenderer(asset_cache)
 atlas_client = AtlasClient()
+async_atlas_client = AsyncAtlasClient()
 
-def get_course_modules_list(course_id):
-    # get course name from id
-    course = atlas_client.find("courses", {"_id": ObjectId(course_id)})
-    if len(course)==0:
-        return "Course not found"
-    course_id = course[0]["app_code"]
 
-    if course_id not in config_list:
-        return "Course not found"
-    return config_list[course_id]["COURSE_NAMES_VIDEOS"]
+def get_course_app_code(course_id):
+    # get course name from id, served from the reference data cache
+    return reference_data.app_code(course_id)
 
-def get_home_page_introduction(course_id):
-    # get course name from id
-    course = atlas_client.find("courses", {"_id": ObjectId(course_id)})
-    if len(course)==0:
-        return "Course not found"
-    course_id = course[0]["app_code"]
 
-    if course_id not in config_list:
-        return "Course not found"
-    return config_list[course_id]["HOME_PAGE_INTRODUCTION"]
+async def aget_course_app_code(course_id):
+    return await reference_data.aapp_code(course_id)
 
 
-def get_module_video_link(course_id, module_num):
-    # get course name from id
-    course = atlas_client.find("courses", {"_id": ObjectId(course_id)})
-    if len(course)==0:
+def _course_config_value(app_code, key):
+    config = reference_data.course_config(app_code)
+    if config is None:
         return "Course not found"
-    course_id = course[0]["app_code"]
+    return config[key]
 
-    if course_id not in config_list:
+
+def _module_video_link(app_code, module_num):
+    config = reference_data.course_config(app_code)
+    if config is None:
         return "Course not found"
-    video_links = config_list[course_id]["VIDEOS_LINKS"]
+    video_links = config["VIDEOS_LINKS"]
     if module_num>=0 and module_num<len(video_links):
         return video_links[module_num]
     return "Module not found"
 
 
+def _module_slide_key(app_code, module_num):
+    # Returns the S3 key of the slides, or the error message if there is none
+    config = reference_data.course_config(app_code)
+    if config is None:
+        return None, "Course not found"
+    slide_links = config["SLIDES_LINKS"]
+    if module_num>=0 and module_num<len(slide_links):
+        return slide_links[module_num], None
+    return None, "Module not found"
+
+
+def get_course_modules_list(course_id):
+    return _course_config_value(get_course_app_code(course_id), "COURSE_NAMES_VIDEOS")
+
+
+async def aget_course_modules_list(course_id):
+    return _course_config_value(await aget_course_app_code(course_id), "COURSE_NAMES_VIDEOS")
+
+
+def get_home_page_introduction(course_id):
+    return _course_config_value(get_course_app_code(course_id), "HOME_PAGE_INTRODUCTION")
+
+
+async def aget_home_page_introduction(course_id):
+    return _course_config_value(await aget_course_app_code(course_id), "HOME_PAGE_INTRODUCTION")
+
+
+def get_module_video_link(course_id, module_num):
+    return _module_video_link(get_course_app_code(course_id), module_num)
+
+
+async def aget_module_video_link(course_id, module_num):
+    return _module_video_link(await aget_course_app_code(course_id), module_num)
+
+
 def get_module_slide(course_id, module_num):
-    # get course name from id
-    course = atlas_client.find("courses", {"_id": ObjectId(course_id)})
-    if len(course)==0:
-        return "Course not found"
-    course_id = course[0]["app_code"]
+    slide_key, error = _module_slide_key(get_course_app_code(course_id), module_num)
+    if error:
+        return error
+    pdf_content = asset_cache.get(slide_key)
+    pdf_base_64 = base64.b64encode(pdf_content).decode('utf-8')
+    return pdf_base_64
 
-    if course_id not in config_list:
-        return "Course not found"
-    slide_links = config_list[course_id]["SLIDES_LINKS"]
-    if module_num>=0 and module_num<len(slide_links):
-        response = s3.get_object(slide_links[module_num])
-        pdf_content = response
-        pdf_base_64 = base64.b64encode(pdf_content).decode('utf-8')
-        return pdf_base_64
-    return "Module not found"
+
+async def aget_module_slide(course_id, module_num):
+    slide_key, error = _module_slide_key(await aget_course_app_code(course_id), module_num)
+    if error:
+        return error
+    pdf_content = await asset_cache.aget(slide_key)
+    pdf_base_64 = base64.b64encode(pdf_content).decode('utf-8')
+    return pdf_base_64
+
+
+async def aget_module_slide_key(course_id, module_num):
+    """
+    Get the S3 key of the slides of a module, for streaming them
+
+    Args:
+    course_id: str - _id of the course
+    module_num: int - index of the module
+
+    Returns:
+    slide_key: str - key of the slides, or None
+    error: str - error message if there are no slides
+    """
+    return _module_slide_key(await aget_course_app_code(course_id), module_num)
 
 
 def get_module_quiz(course_id):
-    # get course name from id
-    course = atlas_client.find("courses", {"_id": ObjectId(course_id)})
-    if len(course)==0:
-        return "Course not found"
-    course_id = course[0]["app_code"]
+    quiz_links = _course_config_value(get_course_app_code(course_id), "QUESTIONS_FILE")
+    if quiz_links == "Course not found":
+        return quiz_links
+    content = asset_cache.get(quiz_links)
+    return content
 
-    if course_id not in config_list:
-        return "Course not found"
-    quiz_links = config_list[course_id]["QUESTIONS_FILE"]
-    content = s3.get_object(quiz_links)
+
+async def aget_module_quiz(course_id):
+    quiz_links = _course_config_value(await aget_course_app_code(course_id), "QUESTIONS_FILE")
+    if quiz_links == "Course not found":
+        return quiz_links
+    content = await asset_cache.aget(quiz_links)
     return content
 
 
-def get_quiz_certificate(course_id, user_id):
+def _certificate_user_name(user):
+    if len(user)==0:
+        return None
+    return user[0]["name"]
+
+
+def _certificate_response(certificate, raw):
+    if certificate is None:
+        return "Certificate not found"
+    if raw:
+        return certificate
+    # Encode image as base64 to embed in JSON
+    return base64.b64encode(certificate).decode('utf-8')
+
+
+def get_quiz_certificate(course_id, user_id, raw=False):
     # get user name from id
-    user = atlas_client.find("users", {"_id": ObjectId(user_id)})
+    user = atlas_client.find("users", {"_id": ObjectId(user_id)}, projection={"name": 1})
 
-    course=atlas_client.find("courses", {"_id": ObjectId(course_id)})
-    if len(course)==0:
+    app_code = get_course_app_code(course_id)
+    if app_code is None:
         return "Course not found"
-    course_id = course[0]["app_code"]
 
-    if len(user)==0:
+    user_name = _certificate_user_name(user)
+    if user_name is None:
         return "User not found"
-    user_name = user[0]["name"]
-    certificate_image_path = config_list[course_id]["CERTIFICATE_PATH"]
-    image_content = s3.get_object(certificate_image_path)
-
-    image_np = np.frombuffer(image_content, dtype=np.uint8)
-    certificate = cv2.imdecode(image_np, cv2.IMREAD_COLOR)
-
-    # add user name to certificate
-    font = cv2.FONT_HERSHEY_COMPLEX
-    fontScale = 3
-    cv2.putText(certificate, user_name, (
-        145, 800), font, fontScale, (0, 0, 0), thickness=3)
-
-    # add today's date
-    cv2.putText(certificate, 
-                           "Recorded on: " + datetime.datetime.now().strftime("%Y-%m-%d"), 
-                           (1630, 1095), font, 0.7, (0, 0, 0), thickness=1)
-                           
-    
-    # Encode the modified image to send back to client
-    _, buffer = cv2.imencode('.jpg', certificate)
-    io_buf = io.BytesIO(buffer)
+    course_config = reference_data.config()[app_code]
+    certificate = certificate_renderer.prerendered(app_code, course_config, user_id, user_name)
+    if certificate is None:
+        certificate = certificate_renderer.render(course_config["CERTIFICATE_PATH"], user_id, user_name)
+    return _certificate_response(certificate, raw)
 
-    # Encode image as base64 to embed in JSON
-    io_buf.seek(0)
-    base64_data = base64.b64encode(io_buf.read()).decode('utf-8')
 
-    return base64_data
+async def aget_quiz_certificate(course_id, user_id, raw=False):
+    user = await async_atlas_client.find("users", {"_id": ObjectId(user_id)}, projection={"name": 1})
+
+    app_code = await aget_course_app_code(course_id)
+    if app_code is None:
+        return "Course not found"
+
+    user_name = _certificate_user_name(user)
+    if user_name is None:
+        return "User not found"
+    course_config = reference_data.config()[app_code]
+    # reading, fetching the template and drawing are blocking, keep them off the event loop
+    certificate = await asyncio.to_thread(certificate_renderer.prerendered, app_code, course_config, user_id, user_name)
+    if certificate is None:
+        certificate = await asyncio.to_thread(certificate_renderer.render, course_config["CERTIFICATE_PATH"], user_id, user_name)
+    return _certificate_response(certificate, raw)
+
 
+INVALID_SESSION_MESSAGE = "Invalid session_id"
 
 
-def get_chat_response(course_id, history, query):
-    course = atlas_client.find("courses", {"_id": ObjectId(course_id)})
-    if len(course)==0:
+def _invalid_session(session_id):
+    # Only ids issued by the server are accepted, a request without one starts a new session
+    return chat_sessions is not None and session_id is not None and not valid_session_id(session_id)
+
+
+def _answered(response):
+    # Failed answers are not kept in the session history
+    return isinstance(response, dict) and response.get("answer") not in (None, CHAT_ERROR_ANSWER)
+
+
+async def _asession_call(fn, *args):
+    # The SQLite and Mongo session stores block, keep them off the event loop
+    if chat_sessions.backend.blocking:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def get_chat_response(course_id, history, query, session_id=None):
+    if _invalid_session(session_id):
+        return INVALID_SESSION_MESSAGE
+
+    course_id = get_course_app_code(course_id)
+    if course_id is None:
         return "Course not found"
-    course_id = course[0]["app_code"]
-
-    chatbot_locations = {
-        "NIST":"chatbot/qu-nist/test/retriever",
-        "AIRMF":"chatbot/qu-airmf/test/retriever",
-        "AIBDI":"chatbot/qu-aibdi/test/retriever",
-        "AEDT":"chatbot/qu-aedt/test/retriever",
-        "CONSU":"chatbot/qu-consu/test/retriever",
-        "AGIRM":"chatbot/qu-agirm/test/retriever",
-        "SCFACO":"chatbot/qu-scfaco/test/retriever",
-        "SGMRM":"chatbot/qu-sgmrm/test/retriever",
-        "GENPRO":"chatbot/qu-genpro/test/retriever",
-        "SCFACONLP":"chatbot/qu-scfaconlp/test/retriever",
-        "PRMST":"chatbot/qu-prmst/test/retriever",
-        "GSCRRMF":"chatbot/qu-gscrrmf/test/retriever",
-        "SROBOM":"chatbot/qu-srobom/test/retriever",
-    }
-
-    if course_id not in chatbot_locations:
+
+    if not chatbot_registry.supports(course_id):
         return "This course does not support a chatbot yet"
-    
-    chatbot_location = chatbot_locations[course_id]
-    print(chatbot_location)
-    chatbot = ChatBot(chatbot_location)
+
+    # With a session the history is kept server-side and the history sent by the client is ignored,
+    # except for the first question of a new session, whose history seeds the session
+    seed_history = None
+    if chat_sessions is not None:
+        if session_id is None:
+            session_id, seed_history = new_session_id(), history
+        else:
+            history = chat_sessions.history(course_id, session_id)
+
+    chatbot = chatbot_registry.get(course_id)
     response = chatbot.get_response(history, query)
+    if chat_sessions is not None:
+        if _answered(response):
+            chat_sessions.add_turn(course_id, session_id, query, response["answer"], seed_history)
+        response = {**response, "session_id": session_id}
     return response
 
 
+async def aget_chat_response(course_id, history, query, session_id=None):
+    if _invalid_session(session_id):
+        return INVALID_SESSION_MESSAGE
+
+    course_id = await aget_course_app_code(course_id)
+    if course_id is None:
+        return "Course not found"
+
+    if not chatbot_registry.supports(course_id):
+        return "This course does not support a chatbot yet"
+
+    seed_history = None
+    if chat_sessions is not None:
+        if session_id is None:
+            session_id, seed_history = new_session_id(), history
+        else:
+            history = await _asession_call(chat_sessions.history, course_id, session_id)
+
+    # loading the course index and the chatbot pipeline are blocking, run them in a worker thread
+    chatbot = await asyncio.to_thread(chatbot_registry.get, course_id)
+    response = await asyncio.to_thread(chatbot.get_response, history, query)
+    if chat_sessions is not None:
+        if _answered(response):
+            await _asession_call(chat_sessions.add_turn, course_id, session_id, query, response["answer"], seed_history)
+        response = {**response, "session_id": session_id}
+    return response
+
 
-    
\ No newline at end of file
+async def astream_chat_response(course_id, history, query, session_id=None):
+    """
+    Stream the chat response as server-sent events: "token" events with the answer as it is
+    generated ("reset" clears them when a malformed answer is regenerated), then a "done" event
+    with the answer and follow_up_questions, or an "error" event
+
+    Args:
+    course_id: str - _id of the course
+    history: str - the chat history, ignored when session_id is given
+    query: str - the question
+    session_id: str - the server-side chat session issued by a previous response, or None to start one
+
+    Yields:
+    event: str - the next server-sent event
+    """
+    if _invalid_session(session_id):
+        yield sse_event("error", {"message": INVALID_SESSION_MESSAGE})
+        return
+
+    app_code = await aget_course_app_code(course_id)
+    if app_code is None:
+        yield sse_event("error", {"message": "Course not found"})
+        return
+
+    if not chatbot_registry.supports(app_code):
+        yield sse_event("error", {"message": "This course does not support a chatbot yet"})
+        return
+
+    try:
+        seed_history = None
+        if chat_sessions is not None:
+            if session_id is None:
+                session_id, seed_history = new_session_id(), history
+            else:
+                history = await _asession_call(chat_sessions.history, app_code, session_id)
+        chatbot = await asyncio.to_thread(chatbot_registry.get, app_code)
+        async for event, data in chatbot.astream_response(history, query):
+            if event == "done" and chat_sessions is not None:
+                # The turn is saved before the final event so the next question sees it
+                if _answered(data):
+                    await _asession_call(chat_sessions.add_turn, app_code, session_id, query, data["answer"], seed_history)
+                data = {**data, "session_id": session_id}
+            yield sse_event(event, data)
+    except Exception as e:
+        logging.error(f"Error in streaming the chat response: {e}")
+        yield sse_event("error", {"message": CHAT_ERROR_ANSWER})
@@ -0,0 +1,76 @@
+import os
+import json
+import numpy as np
+from langchain_core.documents import Document
+
+
+def write_documents(directory, documents, name="docs"):
+    """
+    Write documents as JSON records one after the other, with an array of record offsets
+
+    Args:
+    directory: str - the directory to write {name}.bin and {name}_offsets.npy to
+    documents: list - langchain Documents
+    name: str - the file name prefix
+    """
+    records = [
+        json.dumps({"page_content": document.page_content, "metadata": document.metadata}).encode("utf-8")
+        for document in documents
+    ]
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    for i, record in enumerate(records):
+        offsets[i + 1] = offsets[i] + len(record)
+    np.save(os.path.join(directory, f"{name}_offsets.npy"), offsets)
+    with open(os.path.join(directory, f"{name}.bin"), "wb") as f:
+        for record in records:
+            f.write(record)
+
+
+class DocumentStore:
+    """
+    Read-only, memory-mapped store of the documents written by write_documents. A document is
+    only decoded when it is read, and the records are shared between processes through the page cache.
+    """
+    def __init__(self, records, offsets):
+        """
+        The constructor for the DocumentStore class, use DocumentStore.load to open a store.
+        """
+        self._records = records
+        self.offsets = offsets
+
+    @classmethod
+    def load(cls, directory, name="docs"):
+        """
+        Function to open a store.
+
+        Args:
+        directory (str): The directory holding {name}.bin and {name}_offsets.npy.
+        name (str): The file name prefix.
+
+        Returns:
+        DocumentStore: The store.
+        """
+        records_path = os.path.join(directory, f"{name}.bin")
+        # numpy cannot map an empty file
+        if os.path.getsize(records_path):
+            records = np.memmap(records_path, dtype=np.uint8, mode="r")
+        else:
+            records = np.zeros(0, dtype=np.uint8)
+        return cls(records, np.load(os.path.join(directory, f"{name}_offsets.npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def document(self, i):
+        """
+        Function to read a document.
+
+        Args:
+        i (int): The position of the document.
+
+        Returns:
+        Document: The langchain document.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        record = json.loads(bytes(self._records[start:end]).decode("utf-8"))
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
@@ -0,0 +1,256 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+from request_metrics import request_metrics
+
+load_dotenv()
+
+
+def normalize_query(text):
+    # Questions differing only in case or spacing get the same embedding
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def make_embedding_key(model, text):
+    """
+    Function to build the key of a query embedding.
+
+    Args:
+    model (str): The embedding model.
+    text (str): The query.
+
+    Returns:
+    str: The cache key.
+    """
+    return hashlib.sha256(f"{model}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+
+class SQLiteEmbeddingStore:
+    """
+    On-disk store of query embeddings, shared by every worker process on the host and kept across restarts.
+
+    Attributes:
+    path (str): The path of the SQLite database.
+    max_entries (int): The maximum number of entries kept, least recently used are evicted first.
+    """
+    def __init__(self, path="data/embedding_cache.sqlite", max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS embedding_cache_accessed_at ON embedding_cache (accessed_at)"
+            )
+
+    def get(self, key):
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT vector FROM embedding_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE embedding_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def set(self, key, vector):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO embedding_cache (key, vector, accessed_at) VALUES (?, ?, ?)",
+                (key, vector.tobytes(), time.time()),
+            )
+            # Trimming scans the table, so it only runs every 100 writes
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._connection.execute(
+                    "DELETE FROM embedding_cache WHERE key IN ("
+                    "SELECT key FROM embedding_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings, optionally backed by an on-disk store.
+    Vectors are kept as float32 arrays, the precision the FAISS indexes search with.
+
+    Attributes:
+    max_entries (int): The maximum number of embeddings kept in memory.
+    store (SQLiteEmbeddingStore): The on-disk store, or None.
+    """
+    def __init__(self, max_entries=10000, store=None):
+        """
+        The constructor for the EmbeddingCache class.
+        """
+        self.max_entries = max_entries
+        self.store = store
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "miss_seconds": 0.0}
+
+    def get(self, key):
+        """
+        Function to get a cached embedding.
+
+        Args:
+        key (str): The key from make_embedding_key.
+
+        Returns:
+        np.ndarray: The embedding, or None on a miss.
+        """
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return vector
+
+        if self.store is not None:
+            try:
+                vector = self.store.get(key)
+            except Exception as e:
+                logging.error(f"Error in reading the embedding cache: {e}")
+                vector = None
+            if vector is not None:
+                self._remember(key, vector)
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                return vector
+        return None
+
+    def set(self, key, vector, seconds=0.0):
+        """
+        Function to cache an embedding.
+
+        Args:
+        key (str): The key from make_embedding_key.
+        vector (list): The embedding.
+        seconds (float): How long computing the embedding took, for the statistics.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        self._remember(key, vector)
+        with self._lock:
+            self._stats["misses"] += 1
+            self._stats["miss_seconds"] += seconds
+        if self.store is not None:
+            try:
+                self.store.set(key, vector)
+            except Exception as e:
+                logging.error(f"Error in writing the embedding cache: {e}")
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Function to get the cache statistics.
+
+        Returns:
+        dict: The hits per tier, misses, hit ratio and the embedding time saved.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        average_miss = stats["miss_seconds"] / stats["misses"] if stats["misses"] else 0.0
+        stats["hit_ratio"] = hits / lookups if lookups else 0.0
+        stats["average_miss_ms"] = round(average_miss * 1000, 2)
+        stats["saved_seconds"] = round(hits * average_miss, 2)
+        stats["miss_seconds"] = round(stats["miss_seconds"], 2)
+        stats["persistent"] = self.store is not None
+        return stats
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Embeddings that serve repeated queries from an EmbeddingCache. Documents are embedded
+    by the wrapped embeddings without caching, they are only embedded when an index is built.
+
+    Attributes:
+    embeddings (Embeddings): The wrapped embeddings.
+    cache (EmbeddingCache): The cache.
+    model (str): The model name the cache keys are scoped to.
+    """
+    def __init__(self, embeddings, cache):
+        """
+        The constructor for the CachedQueryEmbeddings class.
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = make_embedding_key(self.model, text)
+        start = time.perf_counter()
+        vector = self.cache.get(key)
+        if vector is not None:
+            request_metrics.record("embedding", model=self.model, cached=True, latency_ms=round((time.perf_counter() - start) * 1000, 2))
+            return vector.tolist()
+
+        vector = self.embeddings.embed_query(text)
+        elapsed = time.perf_counter() - start
+        self.cache.set(key, vector, elapsed)
+        request_metrics.record("embedding", model=self.model, cached=False, latency_ms=round(elapsed * 1000, 2))
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = make_embedding_key(self.model, text)
+        start = time.perf_counter()
+        vector = self.cache.get(key)
+        if vector is not None:
+            request_metrics.record("embedding", model=self.model, cached=True, latency_ms=round((time.perf_counter() - start) * 1000, 2))
+            return vector.tolist()
+
+        vector = await self.embeddings.aembed_query(text)
+        elapsed = time.perf_counter() - start
+        self.cache.set(key, vector, elapsed)
+        request_metrics.record("embedding", model=self.model, cached=False, latency_ms=round(elapsed * 1000, 2))
+        return vector
+
+
+def create_embedding_cache():
+    """
+    Function to create the query embedding cache configured by EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_CACHE_PATH (an SQLite file to persist the embeddings, or "none") and
+    EMBEDDING_CACHE_DISK_MAX_ENTRIES.
+
+    Returns:
+    EmbeddingCache: The cache.
+    """
+    max_entries = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 10000))
+    path = os.environ.get("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite")
+    store = None
+    if path.lower() != "none":
+        try:
+            store = SQLiteEmbeddingStore(path, int(os.environ.get("EMBEDDING_CACHE_DISK_MAX_ENTRIES", 100000)))
+        except Exception as e:
+            logging.error(f"Error in opening the embedding cache at {path}, keeping it in memory only: {e}")
+    return EmbeddingCache(max_entries, store)
+
+
+embedding_cache = create_embedding_cache()
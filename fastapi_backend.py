@@ -1,9 +1,22 @@
-from fastapi import FastAPI, Response
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+import os
+import logging
+import threading
 
-from utils import update_profile, get_course_outline, generate_cover_letter, get_skill_match_score
-from course_utils import get_course_modules_list, get_home_page_introduction, get_module_video_link, get_module_slide, get_module_quiz, get_quiz_certificate, get_chat_response           
+from utils import aupdate_profile, aget_course_outline, agenerate_cover_letter, aget_skill_match_score
+from course_utils import aget_course_modules_list, aget_home_page_introduction, aget_module_video_link, aget_module_slide, aget_module_quiz, aget_quiz_certificate, aget_chat_response, astream_chat_response, asset_cache, aget_module_slide_key, s3
+from streaming import stream_asset
+from chatbot_registry import chatbot_registry
+from request_metrics import request_metrics, current_request_id, new_request_id
+from llm_cache import llm_cache
+from pymongo_client import pool_metrics, close_clients
+from s3_file_manager import transfer_stats
+from embedding_cache import embedding_cache
+from structured_output import retry_stats
+from chat_sessions import chat_sessions
+from reference_data import reference_data
 
 app = FastAPI()
 
@@ -19,105 +32,276 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
 
+# Tag every request with an id so the metrics recorded while serving it can be queried
+@app.middleware("http")
+async def add_request_id(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    token = current_request_id.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        current_request_id.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+# Warm-up of the course chatbots before the app reports ready
+warmup_done = threading.Event()
+warmup_timings = {}
+
+
+def run_warmup(course_codes):
+    """
+    Preload the chatbots of the given courses and mark the app as ready once done
+
+    Args:
+    course_codes: list - course app codes to preload, or None for every course with a chatbot
+    """
+    try:
+        workers = int(os.environ.get("PRELOAD_WORKERS", 4))
+        warmup_timings.update(chatbot_registry.preload(course_codes, max_workers=workers))
+        logging.info(f"Warm-up finished: {warmup_timings}")
+    except Exception as e:
+        logging.error(f"Error in warm-up: {e}")
+    finally:
+        warmup_done.set()
+
+
+@app.on_event("startup")
+def start_warmup():
+    """
+    Start preloading the courses listed in PRELOAD_COURSES ("all" or comma separated app codes)
+    in the background. Without PRELOAD_COURSES the app is ready right away. At most
+    CHATBOT_REGISTRY_MAX_COURSES courses are preloaded, the others are loaded on their first request.
+    """
+    preload_courses = os.environ.get("PRELOAD_COURSES", "").strip()
+    if preload_courses == "":
+        warmup_done.set()
+        return
+
+    if preload_courses.lower() == "all":
+        course_codes = None
+    else:
+        course_codes = [code.strip() for code in preload_courses.split(",") if code.strip()]
+    threading.Thread(target=run_warmup, args=(course_codes,), name="chatbot-warmup", daemon=True).start()
+
+
+@app.on_event("startup")
+def start_reference_data():
+    # Keep courses, personas and the course config in memory so course routes skip the database
+    reference_data.start()
+
+
+@app.on_event("shutdown")
+def close_mongo_clients():
+    reference_data.stop()
+    close_clients()
+
+
 # test connection
 @app.get("/")
-def read_root():
+async def read_root():
     return {"Hello": "World"}
 
+# readiness check, only ready once the warm-up has finished
+@app.get("/ready")
+async def read_ready(response: Response):
+    if not warmup_done.is_set():
+        response.status_code = 503
+        return {"ready": False}
+    return {"ready": True, "preload_seconds": warmup_timings}
+
 # get profile suggestions
 @app.post("/get_profile_suggestions")
-def get_profile_suggestions(data: dict):
+async def get_profile_suggestions(data: dict):
     """
     Get the profile suggestions for a given profile
     
     Args:
-    data: dict - dictionary containing the linkedin_profile_id
+    data: dict - dictionary containing the linkedin_profile_id and optionally regenerate
     """
-    profile_id = data.get("linkedin_profile_id")
-    return update_profile(profile_id)
+    profile_id, regenerate = data.get("linkedin_profile_id"), bool(data.get("regenerate", False))
+    return await aupdate_profile(profile_id, regenerate=regenerate)
 
 # get course outline
 @app.post("/generate_course_outline")
-def get_course_outline_api(data: dict):
+async def get_course_outline_api(data: dict):
     """
     Get the course outline for a given profile and job
 
     Args:
-    data: dict - dictionary containing the profile_id and job_id
+    data: dict - dictionary containing the profile_id and job_id, and optionally feedback and regenerate
     """
     profile_id, job_id, feedback = data.get("profile_id"), data.get("job_id"), data.get("feedback")
-    return get_course_outline(profile_id, job_id, feedback)
+    return await aget_course_outline(profile_id, job_id, feedback, regenerate=bool(data.get("regenerate", False)))
 
 # generate cover letter
 @app.post("/generate_cover_letter")
-def generate_cover_letter_api(data: dict):
+async def generate_cover_letter_api(data: dict):
     """
     Generate a cover letter for a given profile and job
 
     Args:
-    data: dict - dictionary containing the profile_id and job
+    data: dict - dictionary containing the profile_id and job, and optionally regenerate
     """
     profile_id, job_id = data.get("profile_id"), data.get("job_id")
-    return generate_cover_letter(profile_id=profile_id, job_id=job_id)
+    return await agenerate_cover_letter(profile_id=profile_id, job_id=job_id, regenerate=bool(data.get("regenerate", False)))
 
 # get skill match score
 @app.post("/generate_skill_match_score")
-def get_skill_match_score_api(data: dict):
+async def get_skill_match_score_api(data: dict):
     """
     Get the skill match score between a profile and a job
     
     Args:
-    data: dict - dictionary containing the profile_id and job_id
+    data: dict - dictionary containing the profile_id and job_id, and optionally regenerate
     """
     profile_id, job_id = data.get("profile_id"), data.get("job_id")
-    return get_skill_match_score(profile_id, job_id)
+    return await aget_skill_match_score(profile_id, job_id, regenerate=bool(data.get("regenerate", False)))
 
 
 # course related routes
 
 # get course modules
 @app.get("/courses/{course_id}/modules")
-def get_course_modules_api(course_id: str):
-    return get_course_modules_list(course_id)
+async def get_course_modules_api(course_id: str):
+    return await aget_course_modules_list(course_id)
 
 # get home page
 @app.get("/courses/{course_id}/home_page_introduction")
-def get_home_page_introduction_api(course_id: str):
-    return get_home_page_introduction(course_id)
+async def get_home_page_introduction_api(course_id: str):
+    return await aget_home_page_introduction(course_id)
 
 # get video link for a module in a course
 @app.get("/courses/{course_id}/module/{module_num}/video_link")
-def get_module_video_link_api(course_id: str, module_num: int):
-    return get_module_video_link(course_id, module_num)
+async def get_module_video_link_api(course_id: str, module_num: int):
+    return await aget_module_video_link(course_id, module_num)
 
 # get slide link for a module in a course
 @app.get("/courses/{course_id}/module/{module_num}/slides")
-def get_module_slide_link_api(course_id: str, module_num: int):
-    content = get_module_slide(course_id, module_num)
+async def get_module_slide_link_api(course_id: str, module_num: int):
+    content = await aget_module_slide(course_id, module_num)
     return Response(content, media_type="application/pdf")
 
+# stream the raw slides pdf for a module in a course, with Range support for lazy loading viewers
+@app.get("/courses/{course_id}/module/{module_num}/slides/raw")
+async def get_module_slide_raw_api(course_id: str, module_num: int, request: Request):
+    slide_key, error = await aget_module_slide_key(course_id, module_num)
+    if error:
+        return Response(error, status_code=404)
+    return await stream_asset(s3, asset_cache, slide_key,
+                              range_header=request.headers.get("range"),
+                              if_none_match=request.headers.get("if-none-match"),
+                              media_type="application/pdf")
+
 # get quiz questions for a module in a course
 @app.get("/courses/{course_id}/quiz")
-def get_module_quiz_api(course_id: str):
-    content = get_module_quiz(course_id)
+async def get_module_quiz_api(course_id: str):
+    content = await aget_module_quiz(course_id)
     return Response(content, media_type="application/json")
 
 # get quiz certificate on completion for a user
+# format=jpeg returns the raw image instead of base64 in JSON
 @app.get("/courses/{course_id}/quiz_certificate/{user_id}")
-def get_quiz_certificate_api(course_id: str, user_id: str):
-    return  get_quiz_certificate(course_id, user_id)
+async def get_quiz_certificate_api(course_id: str, user_id: str, format: str = "base64"):
+    if format == "jpeg":
+        certificate = await aget_quiz_certificate(course_id, user_id, raw=True)
+        if isinstance(certificate, str):
+            return Response(certificate, status_code=404)
+        return Response(certificate, media_type="image/jpeg")
+    return  await aget_quiz_certificate(course_id, user_id)
 
 # get chat response
 @app.post("/chat")
-def get_chat_response_api(data: dict):
+async def get_chat_response_api(data: dict):
     """
-    Get the chat response for a given message
-    
+    Get the chat response for a given message. With server-side sessions enabled (CHAT_SESSION_BACKEND)
+    the response carries the session_id to send with the next message, a request without one starts a
+    new session seeded with the history sent by the client, and session ids that were not signed by
+    the server are rejected.
+
     Args:
-    data: dict - dictionary containing the message
+    data: dict - dictionary containing the course_id, query and either history or session_id
     """
     course_id, history, query = data.get("course_id"), data.get("history"), data.get("query")
-    return get_chat_response(course_id, history, query)
\ No newline at end of file
+    return await aget_chat_response(course_id, history, query, data.get("session_id"))
+
+# stream the chat response as server-sent events
+@app.post("/chat/stream")
+async def stream_chat_response_api(data: dict):
+    """
+    Stream the chat response for a given message. "token" events carry the answer as it is
+    generated and the final "done" event carries the same JSON as /chat. If the streamed response
+    is malformed and has to be regenerated, a "reset" event tells the client to clear the answer
+    rendered so far, and the regenerated answer is sent as one "token" event before "done".
+
+    Args:
+    data: dict - dictionary containing the course_id, query and either history or session_id
+    """
+    course_id, history, query = data.get("course_id"), data.get("history"), data.get("query")
+    return StreamingResponse(
+        astream_chat_response(course_id, history, query, data.get("session_id")),
+        media_type="text/event-stream",
+        # Stop proxies from buffering the events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# get the statistics of the loaded course chatbots
+@app.get("/chat/stats")
+async def get_chat_stats_api():
+    return chatbot_registry.stats()
+
+# get the statistics of the server-side chat sessions
+@app.get("/metrics/chat_sessions")
+async def get_chat_session_stats_api():
+    if chat_sessions is None:
+        return {"backend": None}
+    return chat_sessions.stats()
+
+
+# get the LLM calls, token counts and latencies recorded for a request
+@app.get("/metrics/requests/{request_id}")
+async def get_request_metrics_api(request_id: str):
+    return request_metrics.summary(request_id)
+
+
+# get the hit ratio of the LLM result cache
+@app.get("/metrics/llm_cache")
+async def get_llm_cache_stats_api():
+    if llm_cache is None:
+        return {"backend": None}
+    return llm_cache.stats()
+
+
+# get the mongo connection pool metrics
+@app.get("/metrics/mongo")
+async def get_mongo_metrics_api():
+    return pool_metrics()
+
+
+# get the hit ratio of the S3 course asset cache
+@app.get("/metrics/assets")
+async def get_asset_cache_stats_api():
+    return asset_cache.stats()
+
+
+# get the throughput of the S3 transfers
+@app.get("/metrics/s3")
+async def get_s3_transfer_stats_api():
+    return transfer_stats()
+
+
+# get the hit ratio of the query embedding cache
+@app.get("/metrics/embeddings")
+async def get_embedding_cache_stats_api():
+    return embedding_cache.stats()
+
+
+# get the number of attempts needed per prompt to get a well-formed LLM response
+@app.get("/metrics/llm_retries")
+async def get_llm_retry_stats_api():
+    return retry_stats.snapshot()
@@ -0,0 +1,118 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from request_metrics import request_metrics
+
+
+# Shared by every course, each chat request runs one task per leg
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("HYBRID_RETRIEVAL_WORKERS", 16)), thread_name_prefix="hybrid-retrieval"
+)
+
+
+def content_hash(document):
+    """
+    Function to hash the content of a chunk, ignoring whitespace differences.
+
+    Args:
+    document (Document): The chunk.
+
+    Returns:
+    str: The hash of the content.
+    """
+    return hashlib.sha256(re.sub(r"\s+", " ", document.page_content).strip().encode("utf-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(ranked_lists, weights, c=60):
+    """
+    Function to fuse ranked lists of chunks with weighted reciprocal rank fusion. Chunks with the
+    same content are merged, so the fused list holds each passage once.
+
+    Args:
+    ranked_lists (list): The chunks returned by each leg, best first.
+    weights (list): The weight of each leg.
+    c (int): The rank constant, higher values flatten the contribution of the top ranks.
+
+    Returns:
+    list: The fused chunks, best first.
+    """
+    scores = {}
+    documents = {}
+    for documents_of_leg, weight in zip(ranked_lists, weights):
+        seen = set()
+        for rank, document in enumerate(documents_of_leg, start=1):
+            key = content_hash(document)
+            # A duplicate within a leg does not count twice
+            if key in seen:
+                continue
+            seen.add(key)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + weight / (rank + c)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Runs the lexical and vector retrievers of a course concurrently and fuses their results with
+    reciprocal rank fusion, recording the time taken by each leg.
+    """
+    retrievers: List[BaseRetriever]
+    names: List[str]
+    weights: List[float]
+    c: int = 60
+
+    def _timed_leg(self, name, retriever, query):
+        start = time.perf_counter()
+        documents = retriever.invoke(query)
+        elapsed = time.perf_counter() - start
+        request_metrics.record("retrieval", stage=name, latency_ms=round(elapsed * 1000, 2), documents=len(documents))
+        return documents
+
+    def _fuse(self, ranked_lists):
+        start = time.perf_counter()
+        fused = reciprocal_rank_fusion(ranked_lists, self.weights, self.c)
+        request_metrics.record(
+            "retrieval", stage="fusion", latency_ms=round((time.perf_counter() - start) * 1000, 2),
+            documents=len(fused), duplicates=sum(len(documents) for documents in ranked_lists) - len(fused),
+        )
+        return fused
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        # Each task runs in a copy of the caller's context so the metrics keep the request id
+        futures = [
+            _executor.submit(contextvars.copy_context().run, self._timed_leg, name, retriever, query)
+            for name, retriever in zip(self.names, self.retrievers)
+        ]
+        return self._fuse([future.result() for future in futures])
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        ranked_lists = await asyncio.gather(*[
+            asyncio.to_thread(self._timed_leg, name, retriever, query)
+            for name, retriever in zip(self.names, self.retrievers)
+        ])
+        return self._fuse(list(ranked_lists))
+
+
+def hybrid_settings():
+    """
+    Function to get the fusion weights (HYBRID_WEIGHTS, lexical then vector) and rank constant (HYBRID_RRF_K).
+
+    Returns:
+    tuple: The weights and the rank constant.
+    """
+    weights = [float(weight) for weight in os.environ.get("HYBRID_WEIGHTS", "0.5,0.5").split(",")]
+    if len(weights) != 2:
+        logging.warning(f"HYBRID_WEIGHTS needs 2 weights, got {weights}, using 0.5,0.5")
+        weights = [0.5, 0.5]
+    return weights, int(os.environ.get("HYBRID_RRF_K", 60))
@@ -0,0 +1,362 @@
+"""
+This script syncs the chatbot retriever indexes of every course from S3.
+
+Each course is listed with a paginated list_objects_v2, compared against the manifest of the local
+copy by ETag and size, and only the objects that changed are downloaded, in parallel across all
+courses. Unchanged files are hard linked from the current version, the new version is written to
+its own directory and the course's "current" link is swapped to it in a single rename, so a loaded
+or loading chatbot never sees a half-synced index.
+
+Layout of the sync root (INDEX_SYNC_ROOT, data/indexes by default):
+<APPCODE>/versions/<version>/...   the retriever files of each version
+<APPCODE>/current                  link to the version in use
+<APPCODE>/manifest.json            key, etag and size of every file of the current version
+
+Usage:
+python index_sync.py [--courses NIST,AIRMF] [--workers 16] [--keep 2]
+
+Author: Shreyas Nikam
+"""
+
+
+import os
+import json
+import time
+import uuid
+import shutil
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+INDEX_ROOT = os.environ.get("INDEX_SYNC_ROOT", "data/indexes")
+CONFIG_PATH = "data/config_list.json"
+
+
+def course_prefixes(config_path=CONFIG_PATH):
+    """
+    Get the S3 prefix of the retriever index of every course
+
+    Args:
+    config_path: str - path of config_list.json
+
+    Returns:
+    prefixes: dict - retriever prefix for each course app code, ending with a slash so sibling
+    prefixes such as retriever_old/ are not listed with it
+    """
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    return {
+        app_code: f"{course['S3_BUCKET_PREFIX']}/retriever/"
+        for app_code, course in config.items()
+        if course.get("S3_BUCKET_PREFIX")
+    }
+
+
+def current_location(course_code, root=None):
+    """
+    Get the directory of the synced index version in use for a course
+
+    Args:
+    course_code: str - the course app code
+    root: str - the sync root
+
+    Returns:
+    location: str - the version directory, or None if the course was never synced
+    """
+    current = os.path.join(root or INDEX_ROOT, course_code, "current")
+    if not os.path.islink(current):
+        return None
+    # Resolve the link so a load reads a single version even if a sync swaps it meanwhile
+    return os.path.realpath(current)
+
+
+def load_manifest(course_dir):
+    """
+    Load the manifest of the current version of a course
+
+    Args:
+    course_dir: str - the course directory in the sync root
+
+    Returns:
+    manifest: dict - the version and the etag and size of each relative path
+    """
+    try:
+        with open(os.path.join(course_dir, "manifest.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"version": None, "files": {}}
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def plan_course(prefix, objects, manifest):
+    """
+    Diff the objects of a course in S3 against its manifest
+
+    Args:
+    prefix: str - the retriever prefix of the course
+    objects: list - list_files entries under the prefix
+    manifest: dict - the manifest of the current version
+
+    Returns:
+    files: dict - etag, size and key of every remote file by relative path
+    changed: list - relative paths to download
+    removed: list - relative paths no longer in S3
+    """
+    files = {}
+    for item in objects:
+        key = item["Key"]
+        # Skip the zero byte "directory" markers created by the S3 console
+        if key.endswith("/") or not key.startswith(prefix):
+            continue
+        relative_path = key[len(prefix):]
+        files[relative_path] = {"key": key, "etag": item.get("ETag"), "size": item.get("Size")}
+
+    local = manifest.get("files", {})
+    changed = [
+        path for path, remote in files.items()
+        if path not in local or local[path]["etag"] != remote["etag"] or local[path]["size"] != remote["size"]
+    ]
+    removed = [path for path in local if path not in files]
+    return files, changed, removed
+
+
+def _link_or_copy(source, destination):
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _download(s3, key, destination, size):
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if not s3.download_file(key, destination):
+        raise RuntimeError(f"Download of {key} failed")
+    if size is not None and os.path.getsize(destination) != size:
+        raise RuntimeError(f"Download of {key} is {os.path.getsize(destination)} bytes, expected {size}")
+    return key
+
+
+def _swap_current(course_dir, version):
+    # Replace the link with a rename, which is atomic, rather than unlink + symlink
+    current = os.path.join(course_dir, "current")
+    tmp_link = os.path.join(course_dir, f".current-{version}")
+    os.symlink(os.path.join("versions", version), tmp_link)
+    os.replace(tmp_link, current)
+
+
+def _prune_versions(course_dir, keep):
+    versions_dir = os.path.join(course_dir, "versions")
+    current = os.path.basename(os.path.realpath(os.path.join(course_dir, "current")))
+    versions = sorted(name for name in os.listdir(versions_dir) if not name.startswith("."))
+    for name in versions[:-keep] if keep > 0 else versions:
+        if name != current:
+            shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
+    # Leftovers of interrupted syncs
+    for name in os.listdir(versions_dir):
+        if name.startswith(".tmp-"):
+            shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
+
+
+class CourseSync:
+    """
+    Sync of the retriever index of one course into a new version directory.
+
+    Attributes:
+    course_code (str): The course app code.
+    prefix (str): The retriever prefix of the course in S3.
+    course_dir (str): The course directory in the sync root.
+    """
+    def __init__(self, course_code, prefix, root):
+        """
+        The constructor for the CourseSync class.
+        """
+        self.course_code = course_code
+        self.prefix = prefix
+        self.course_dir = os.path.join(root, course_code)
+        self.manifest = load_manifest(self.course_dir)
+        self.files = {}
+        self.changed = []
+        self.removed = []
+        self.version = None
+        self.staging_dir = None
+
+    def plan(self, s3):
+        """
+        Function to list the course in S3 and find the files to download.
+
+        Args:
+        s3 (S3FileManager): The S3 file manager.
+
+        Returns:
+        bool: True if the local copy is out of date.
+        """
+        objects = s3.list_files(self.prefix)
+        if objects is False:
+            raise RuntimeError(f"Listing {self.prefix} failed")
+        self.files, self.changed, self.removed = plan_course(self.prefix, objects, self.manifest)
+        if not self.files:
+            return False
+        current = current_location(self.course_code, os.path.dirname(self.course_dir))
+        return bool(self.changed or self.removed or current is None)
+
+    def stage(self):
+        """
+        Function to create the staging directory of the new version, linking the unchanged files.
+
+        Returns:
+        list: The (key, destination, size) of the files to download.
+        """
+        self.version = time.strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.staging_dir = os.path.join(self.course_dir, "versions", f".tmp-{self.version}")
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+        current = current_location(self.course_code, os.path.dirname(self.course_dir))
+        downloads = []
+        for path, remote in self.files.items():
+            destination = os.path.join(self.staging_dir, path)
+            source = os.path.join(current, path) if current else None
+            if path not in self.changed and source and os.path.exists(source):
+                _link_or_copy(source, destination)
+            else:
+                downloads.append((remote["key"], destination, remote["size"]))
+        return downloads
+
+    def commit(self, keep):
+        """
+        Function to publish the staged version and record its manifest.
+
+        Args:
+        keep (int): The number of versions kept on disk.
+        """
+        version_dir = os.path.join(self.course_dir, "versions", self.version)
+        os.rename(self.staging_dir, version_dir)
+        _swap_current(self.course_dir, self.version)
+        _write_json(os.path.join(self.course_dir, "manifest.json"), {
+            "version": self.version,
+            "prefix": self.prefix,
+            "synced_at": time.time(),
+            "files": {path: {"etag": remote["etag"], "size": remote["size"]} for path, remote in self.files.items()},
+        })
+        _prune_versions(self.course_dir, keep)
+
+    def abort(self):
+        """
+        Function to drop the staged version, leaving the current version in place.
+        """
+        if self.staging_dir:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+def run_index_sync(course_codes=None, root=None, workers=None, keep=None, s3=None):
+    """
+    Sync the retriever indexes of a set of courses from S3
+
+    Args:
+    course_codes: list - the course app codes, defaults to every course in config_list.json
+    root: str - the sync root
+    workers: int - number of files listed and downloaded at the same time
+    keep: int - number of versions kept on disk for each course
+    s3: S3FileManager - S3 file manager to use
+
+    Returns:
+    summary: dict - status, downloaded files and bytes of each course, and the elapsed time
+    """
+    if s3 is None:
+        from s3_file_manager import S3FileManager
+        s3 = S3FileManager()
+    root = root or INDEX_ROOT
+    workers = workers or int(os.environ.get("INDEX_SYNC_WORKERS", 16))
+    keep = keep if keep is not None else int(os.environ.get("INDEX_SYNC_KEEP_VERSIONS", 2))
+
+    prefixes = course_prefixes()
+    if course_codes is not None:
+        prefixes = {code: prefixes[code] for code in course_codes if code in prefixes}
+
+    start = time.time()
+    summary = {}
+    syncs = {}
+    for code, prefix in prefixes.items():
+        os.makedirs(os.path.join(root, code, "versions"), exist_ok=True)
+        syncs[code] = CourseSync(code, prefix, root)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="index-sync") as executor:
+        # List every course in parallel
+        futures = {executor.submit(sync.plan, s3): code for code, sync in syncs.items()}
+        outdated = []
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                if future.result():
+                    outdated.append(code)
+                else:
+                    summary[code] = {"status": "up to date" if syncs[code].files else "no index", "downloaded": 0, "bytes": 0}
+            except Exception as e:
+                logging.error(f"Error in listing the index of {code}: {e}")
+                summary[code] = {"status": "failed", "error": str(e)}
+
+        # Download the changed files of every outdated course through the same bounded pool
+        downloads = {}
+        for code in outdated:
+            for key, destination, size in syncs[code].stage():
+                downloads[executor.submit(_download, s3, key, destination, size)] = (code, size)
+        failed = {}
+        downloaded = {code: [0, 0] for code in outdated}
+        for future in as_completed(downloads):
+            code, size = downloads[future]
+            try:
+                future.result()
+                downloaded[code][0] += 1
+                downloaded[code][1] += size or 0
+            except Exception as e:
+                logging.error(f"Error in syncing the index of {code}: {e}")
+                failed.setdefault(code, str(e))
+
+    for code in outdated:
+        sync = syncs[code]
+        if code in failed:
+            sync.abort()
+            summary[code] = {"status": "failed", "error": failed[code]}
+            continue
+        sync.commit(keep)
+        summary[code] = {
+            "status": "synced",
+            "version": sync.version,
+            "downloaded": downloaded[code][0],
+            "bytes": downloaded[code][1],
+            "removed": len(sync.removed),
+        }
+        logging.info(f"Synced {code} to version {sync.version}: {summary[code]}")
+
+    elapsed = round(time.time() - start, 2)
+    logging.info(f"Synced {len(prefixes)} course indexes in {elapsed}s")
+    return {"courses": summary, "elapsed_seconds": elapsed}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Sync the chatbot retriever indexes from S3")
+    parser.add_argument("--courses", help="comma separated course app codes, defaults to every course")
+    parser.add_argument("--root", help="sync root directory")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--keep", type=int, help="number of versions kept for each course")
+    args = parser.parse_args()
+
+    result = run_index_sync(
+        course_codes=args.courses.split(",") if args.courses else None,
+        root=args.root,
+        workers=args.workers,
+        keep=args.keep,
+    )
+    print(json.dumps(result, indent=2))
@@ -1,10 +1,12 @@
+import time
 import logging
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
-from langchain.chains import LLMChain
 import google.generativeai as gemini
 from dotenv import load_dotenv
 import os
+from request_metrics import request_metrics
+from structured_output import OPENAI_JSON_MODE, GEMINI_JSON_MODE, openai_json_kwargs, gemini_json_kwargs
 load_dotenv()
 
 class LLM:
@@ -16,7 +18,7 @@ class LLM:
     llm: ChatOpenAI object for the LLM
 
     Methods:
-    get_response(prompt) - get the response from the LLM
+    get_response(prompt, inputs, json_mode) - get the response from the LLM
     """
     def __init__(self, llm="chatgpt"):
         self.llm_type = llm
@@ -38,30 +40,126 @@ class LLM:
             gemini.configure(api_key=os.environ.get("GEMINI_API_KEY"))
             self.llm = gemini.GenerativeModel(model_name = "gemini-pro")
         
-    def get_response(self, prompt, inputs=None):
+    @property
+    def model_name(self):
+        # Both ChatOpenAI and gemini.GenerativeModel expose model_name
+        return getattr(self.llm, "model_name", self.llm_type)
+
+    @property
+    def json_mode(self):
+        # Whether the provider is asked for a JSON object when json_mode is requested
+        return OPENAI_JSON_MODE if self.llm_type=="chatgpt" else GEMINI_JSON_MODE
+
+    def _prompt_value(self, prompt, inputs):
+        # Only pass the declared input variables, as LLMChain did
+        selected = {key: inputs[key] for key in prompt.input_variables if key in inputs}
+        return prompt.format_prompt(**selected)
+
+    def _record(self, start, prompt_tokens, completion_tokens, error=None, json_mode=False):
+        return request_metrics.record(
+            "llm",
+            provider=self.llm_type,
+            model=self.model_name,
+            json_mode=json_mode,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency_ms=round((time.perf_counter() - start) * 1000, 1),
+            error=type(error).__name__ if error is not None else None,
+        )
+
+    @staticmethod
+    def _openai_usage(result):
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+    @staticmethod
+    def _gemini_usage(response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return None, None
+        return usage.prompt_token_count, usage.candidates_token_count
+
+    def get_response(self, prompt, inputs=None, json_mode=False):
         """
-        Get the response from the LLM
+        Get the response from the LLM. The provider is called exactly once and the call
+        is recorded in request_metrics with its token counts and latency.
 
         Args:
         prompt: PromptTemplate object for the prompt
         inputs: dict - dictionary containing the inputs for the LLM
+        json_mode: bool - ask the provider for a JSON object, when it supports it
 
         Returns:
         response: str - response from the LLM
         """
-        
-        if self.llm_type=="chatgpt":
-            chain = LLMChain(llm=self.llm, prompt=prompt)
-            logging.info("Prompt", prompt)
-            logging.info("Chain", chain)
-            response = chain.invoke(input=inputs)['text']
-            logging.info("Invocation", chain.invoke(input=inputs))
-            logging.info("Response", response)
-            return response
-        elif self.llm_type=="gemini":
-            if inputs is None:
-                inputs = {}
-            response = self.llm.generate_content(
-                prompt.invoke(inputs).to_string(),
-            )
-            return response.text
+        if inputs is None:
+            inputs = {}
+
+        start = time.perf_counter()
+        json_kwargs = {}
+        try:
+            if self.llm_type=="chatgpt":
+                prompt_value = self._prompt_value(prompt, inputs)
+                if json_mode:
+                    json_kwargs = openai_json_kwargs(prompt_value.to_string())
+                result = self.llm.generate_prompt([prompt_value], **json_kwargs)
+                response = result.generations[0][0].text
+                usage = self._openai_usage(result)
+            elif self.llm_type=="gemini":
+                if json_mode:
+                    json_kwargs = gemini_json_kwargs()
+                gemini_response = self.llm.generate_content(
+                    prompt.invoke(inputs).to_string(),
+                    **json_kwargs,
+                )
+                response = gemini_response.text
+                usage = self._gemini_usage(gemini_response)
+        except Exception as e:
+            self._record(start, None, None, error=e, json_mode=bool(json_kwargs))
+            raise
+
+        self._record(start, *usage, json_mode=bool(json_kwargs))
+        logging.debug(f"Response: {response}")
+        return response
+
+    async def aget_response(self, prompt, inputs=None, json_mode=False):
+        """
+        Get the response from the LLM without blocking the event loop
+
+        Args:
+        prompt: PromptTemplate object for the prompt
+        inputs: dict - dictionary containing the inputs for the LLM
+        json_mode: bool - ask the provider for a JSON object, when it supports it
+
+        Returns:
+        response: str - response from the LLM
+        """
+        if inputs is None:
+            inputs = {}
+
+        start = time.perf_counter()
+        json_kwargs = {}
+        try:
+            if self.llm_type=="chatgpt":
+                prompt_value = self._prompt_value(prompt, inputs)
+                if json_mode:
+                    json_kwargs = openai_json_kwargs(prompt_value.to_string())
+                result = await self.llm.agenerate_prompt([prompt_value], **json_kwargs)
+                response = result.generations[0][0].text
+                usage = self._openai_usage(result)
+            elif self.llm_type=="gemini":
+                if json_mode:
+                    json_kwargs = gemini_json_kwargs()
+                gemini_response = await self.llm.generate_content_async(
+                    prompt.invoke(inputs).to_string(),
+                    **json_kwargs,
+                )
+                response = gemini_response.text
+                usage = self._gemini_usage(gemini_response)
+        except Exception as e:
+            self._record(start, None, None, error=e, json_mode=bool(json_kwargs))
+            raise
+
+        self._record(start, *usage, json_mode=bool(json_kwargs))
+        logging.debug(f"Response: {response}")
+        return response
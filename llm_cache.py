@@ -0,0 +1,292 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _normalize(value):
+    # Collapse whitespace in strings so formatting-only differences hit the same entry
+    if isinstance(value, str):
+        return re.sub(r"\s+", " ", value).strip()
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def make_cache_key(prompt_name, template, inputs, provider):
+    """
+    Function to build the content-addressed key of an LLM result.
+
+    Args:
+    prompt_name (str): The name of the prompt in data/prompts.json.
+    template (str): The prompt template, hashed so template edits invalidate old entries.
+    inputs (dict): The prompt inputs.
+    provider (str): The LLM provider, e.g. "chatgpt".
+
+    Returns:
+    str: The cache key.
+    """
+    template_hash = hashlib.sha256(template.encode("utf-8")).hexdigest()
+    payload = json.dumps(
+        {"prompt": prompt_name, "template": template_hash, "inputs": _normalize(inputs), "provider": provider},
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """
+    In-process LRU backend.
+
+    Attributes:
+    max_entries (int): The maximum number of entries kept.
+    """
+    blocking = False
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCacheBackend:
+    """
+    On-disk SQLite backend, shared by every worker process on the host.
+
+    Attributes:
+    path (str): The path of the SQLite database.
+    max_entries (int): The maximum number of entries kept, least recently used are evicted first.
+    """
+    blocking = True
+
+    def __init__(self, path="data/llm_cache.sqlite", max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, default=str), now + ttl, now),
+            )
+            self._connection.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+            self._connection.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM llm_cache")
+
+
+class MongoCacheBackend:
+    """
+    Mongo backend, shared by every instance of the API. Expired entries are removed by
+    a TTL index on expires_at.
+
+    Attributes:
+    collection: The pymongo collection holding the entries.
+    max_entries (int): The maximum number of entries kept, least recently used are evicted first.
+    """
+    blocking = True
+
+    def __init__(self, collection_name="llmcaches", max_entries=10000):
+        from pymongo_client import AtlasClient
+
+        self.collection = AtlasClient().get_collection(collection_name)
+        self.max_entries = max_entries
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+        self.collection.create_index("accessed_at")
+
+    def get(self, key):
+        now = datetime.datetime.utcnow()
+        entry = self.collection.find_one_and_update(
+            {"_id": key, "expires_at": {"$gt": now}}, {"$set": {"accessed_at": now}}
+        )
+        if entry is None:
+            return None
+        return entry["value"]
+
+    def set(self, key, value, ttl):
+        now = datetime.datetime.utcnow()
+        self.collection.replace_one(
+            {"_id": key},
+            {"value": value, "expires_at": now + datetime.timedelta(seconds=ttl), "accessed_at": now},
+            upsert=True,
+        )
+        overflow = self.collection.estimated_document_count() - self.max_entries
+        if overflow > 0:
+            oldest = self.collection.find({}, {"_id": 1}).sort("accessed_at", 1).limit(overflow)
+            self.collection.delete_many({"_id": {"$in": [entry["_id"] for entry in oldest]}})
+
+    def delete(self, key):
+        self.collection.delete_one({"_id": key})
+
+    def clear(self):
+        self.collection.delete_many({})
+
+
+class LLMCache:
+    """
+    Cache of LLM results for the deterministic generation endpoints.
+
+    Attributes:
+    backend: The storage backend (MemoryCacheBackend, SQLiteCacheBackend or MongoCacheBackend).
+    ttl (int): The time to live of an entry in seconds.
+    """
+    def __init__(self, backend, ttl=7 * 24 * 3600):
+        """
+        The constructor for the LLMCache class.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """
+        Function to get a cached result.
+
+        Args:
+        key (str): The cache key from make_cache_key.
+
+        Returns:
+        The cached result, or None on a miss.
+        """
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logging.error(f"Error in reading the LLM cache: {e}")
+            value = None
+        with self._lock:
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Function to cache a result.
+
+        Args:
+        key (str): The cache key from make_cache_key.
+        value: The JSON serializable result.
+        """
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            logging.error(f"Error in writing the LLM cache: {e}")
+
+    def stats(self):
+        """
+        Function to get the cache statistics.
+
+        Returns:
+        dict: The backend, hits, misses and hit ratio.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+            }
+
+
+def create_llm_cache():
+    """
+    Function to create the LLM cache configured by LLM_CACHE_BACKEND
+    ("memory", "sqlite", "mongo" or "none"), LLM_CACHE_TTL_SECONDS and LLM_CACHE_MAX_ENTRIES.
+
+    Returns:
+    LLMCache: The cache, or None if caching is disabled.
+    """
+    backend_name = os.environ.get("LLM_CACHE_BACKEND", "memory").lower()
+    ttl = int(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+    max_entries = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 1000))
+
+    if backend_name == "none":
+        return None
+    try:
+        if backend_name == "sqlite":
+            backend = SQLiteCacheBackend(os.environ.get("LLM_CACHE_PATH", "data/llm_cache.sqlite"), max_entries)
+        elif backend_name == "mongo":
+            backend = MongoCacheBackend(max_entries=max_entries)
+        else:
+            backend = MemoryCacheBackend(max_entries)
+    except Exception as e:
+        logging.error(f"Error in creating the {backend_name} LLM cache, falling back to memory: {e}")
+        backend = MemoryCacheBackend(max_entries)
+    return LLMCache(backend, ttl)
+
+
+llm_cache = create_llm_cache()
@@ -0,0 +1,111 @@
+from typing import NamedTuple, Optional
+from bson.objectid import ObjectId
+
+from pymongo_client import AtlasClient, AsyncAtlasClient
+
+
+# Fields of a jobsvisiteds document and of a jobs document used by the generation endpoints
+VISIT_FIELDS = ["job", "skill_delta", "skills_in_profile", "skills_in_job", "skill_match_score"]
+JOB_FIELDS = ["title", "description"]
+
+
+class ProfileJobBundle(NamedTuple):
+    """
+    Profile, visited job and job loaded together for a generation endpoint.
+    Each part is None if the document does not exist.
+    """
+    profile: Optional[dict]
+    visit: Optional[dict]
+    job: Optional[dict]
+
+
+def _projection(fields):
+    return {field: 1 for field in fields}
+
+
+def profile_job_pipeline(profile_id, job_id, profile_fields):
+    """
+    Build the aggregation that loads a visited job with its job and the user profile.
+
+    Args:
+    profile_id: str - _id of the user
+    job_id: str - _id of the jobsvisiteds document
+    profile_fields: list - profile fields to return
+
+    Returns:
+    pipeline: list - the aggregation pipeline to run on jobsvisiteds
+    """
+    return [
+        {"$match": {"_id": ObjectId(job_id)}},
+        {"$project": _projection(VISIT_FIELDS)},
+        {"$lookup": {
+            "from": "jobs",
+            "let": {"job_id": "$job"},
+            # job is stored either as an ObjectId or as its string form. A malformed or missing job
+            # converts to null and matches no job, rather than failing the whole aggregation
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", {"$convert": {
+                    "input": "$$job_id", "to": "objectId", "onError": None, "onNull": None,
+                }}]}}},
+                {"$project": _projection(JOB_FIELDS)},
+            ],
+            "as": "jobs",
+        }},
+        {"$lookup": {
+            "from": "users",
+            "pipeline": [
+                {"$match": {"_id": ObjectId(profile_id)}},
+                {"$project": _projection(profile_fields)},
+            ],
+            "as": "profiles",
+        }},
+    ]
+
+
+def _bundle(items):
+    if len(items) == 0:
+        return ProfileJobBundle(None, None, None)
+    visit = items[0]
+    jobs = visit.pop("jobs")
+    profiles = visit.pop("profiles")
+    return ProfileJobBundle(
+        profile=profiles[0] if profiles else None,
+        visit=visit,
+        job=jobs[0] if jobs else None,
+    )
+
+
+def load_profile_job_bundle(profile_id, job_id, profile_fields, atlas_client=None):
+    """
+    Load the profile, visited job and job in a single round trip
+
+    Args:
+    profile_id: str - _id of the user
+    job_id: str - _id of the jobsvisiteds document
+    profile_fields: list - profile fields to return
+    atlas_client: AtlasClient - client to use
+
+    Returns:
+    bundle: ProfileJobBundle - the profile, visit and job
+    """
+    atlas_client = atlas_client or AtlasClient()
+    items = atlas_client.aggregate("jobsvisiteds", profile_job_pipeline(profile_id, job_id, profile_fields))
+    return _bundle(items)
+
+
+async def aload_profile_job_bundle(profile_id, job_id, profile_fields, atlas_client=None):
+    """
+    Async version of load_profile_job_bundle
+
+    Args:
+    profile_id: str - _id of the user
+    job_id: str - _id of the jobsvisiteds document
+    profile_fields: list - profile fields to return
+    atlas_client: AsyncAtlasClient - client to use
+
+    Returns:
+    bundle: ProfileJobBundle - the profile, visit and job
+    """
+    atlas_client = atlas_client or AsyncAtlasClient()
+    items = await atlas_client.aggregate("jobsvisiteds", profile_job_pipeline(profile_id, job_id, profile_fields))
+    return _bundle(items)
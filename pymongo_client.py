@@ -1,15 +1,154 @@
 import pymongo
-from pymongo import MongoClient
+import logging
+import threading
+from pymongo import MongoClient, monitoring
+from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
 
+def client_options():
+    """
+    Connection pool, timeout and read preference options shared by every client,
+    configured through MONGO_* environment variables
+    """
+    return {
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", 50)),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 300000)),
+        "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000)),
+        "socketTimeoutMS": int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 30000)),
+        "waitQueueTimeoutMS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)),
+        "readPreference": os.environ.get("MONGO_READ_PREFERENCE", "primary"),
+    }
+
+
+class PoolMetricsListener (monitoring.ConnectionPoolListener):
+   """
+   Counts connection pool events so pool usage can be reported
+   """
+
+   def __init__ (self):
+       self._lock = threading.Lock()
+       self.counts = {
+           "connections_created": 0,
+           "connections_closed": 0,
+           "checked_out": 0,
+           "checkout_failed": 0,
+           "pool_cleared": 0,
+       }
+       self.in_use = 0
+       self.max_in_use = 0
+
+   def _increment(self, key):
+       with self._lock:
+           self.counts[key] += 1
+
+   def pool_created(self, event):
+       pass
+
+   def pool_ready(self, event):
+       pass
+
+   def pool_cleared(self, event):
+       self._increment("pool_cleared")
+
+   def pool_closed(self, event):
+       pass
+
+   def connection_created(self, event):
+       self._increment("connections_created")
+
+   def connection_ready(self, event):
+       pass
+
+   def connection_closed(self, event):
+       self._increment("connections_closed")
+
+   def connection_check_out_started(self, event):
+       pass
+
+   def connection_check_out_failed(self, event):
+       self._increment("checkout_failed")
+
+   def connection_checked_out(self, event):
+       with self._lock:
+           self.counts["checked_out"] += 1
+           self.in_use += 1
+           self.max_in_use = max(self.max_in_use, self.in_use)
+
+   def connection_checked_in(self, event):
+       with self._lock:
+           self.in_use -= 1
+
+   def snapshot(self):
+       with self._lock:
+           return {
+               **self.counts,
+               "open_connections": self.counts["connections_created"] - self.counts["connections_closed"],
+               "in_use": self.in_use,
+               "max_in_use": self.max_in_use,
+           }
+
+
+# Process-wide clients keyed by (kind, uri); each MongoClient owns a connection pool and
+# monitoring threads, so they are created once and shared by every AtlasClient
+_clients = {}
+_listeners = {}
+_clients_lock = threading.Lock()
+
+
+def _shared_client(kind, altas_uri):
+    key = (kind, altas_uri)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            listener = PoolMetricsListener()
+            client_class = MongoClient if kind == "sync" else AsyncIOMotorClient
+            client = client_class(altas_uri, event_listeners=[listener], **client_options())
+            _clients[key] = client
+            _listeners[key] = listener
+        return client
+
+
+def pool_metrics():
+    """
+    Get the connection pool metrics of every shared client
+
+    Returns:
+    metrics: dict - pool event counts and connections in use, by client kind
+    """
+    with _clients_lock:
+        listeners = dict(_listeners)
+    metrics = {}
+    for (kind, _), listener in listeners.items():
+        metrics.setdefault(kind, []).append(listener.snapshot())
+    return {"options": client_options(), "clients": metrics}
+
+
+def close_clients():
+    """
+    Close every shared client, e.g. on application shutdown
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _listeners.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            logging.error(f"Error in closing the mongo client: {e}")
+
+
 class AtlasClient ():
 
    def __init__ (self, altas_uri=os.environ.get("ATLAS_URI"), dbname='test'):
-       self.mongodb_client = MongoClient(altas_uri)
+       # Uses the process-wide pooled client, do not close it per instance
+       self.mongodb_client = _shared_client("sync", altas_uri)
        self.database = self.mongodb_client[dbname]
 
    def ping(self):
@@ -19,9 +158,14 @@ class AtlasClient ():
        collection = self.database[collection_name]
        return collection
 
-   def find(self, collection_name, filter = {}, limit=0):
+   def find(self, collection_name, filter = {}, limit=0, projection=None):
+       collection = self.database[collection_name]
+       items = list(collection.find(filter=filter, projection=projection, limit=limit))
+       return items
+
+   def aggregate(self, collection_name, pipeline):
        collection = self.database[collection_name]
-       items = list(collection.find(filter=filter, limit=limit))
+       items = list(collection.aggregate(pipeline))
        return items
    
    def update(self, collection_name, filter, update):
@@ -33,3 +177,41 @@ class AtlasClient ():
        collection = self.database[collection_name]
        id = collection.insert_one(data).inserted_id
        return id
+
+
+
+class AsyncAtlasClient ():
+   """
+   asyncio counterpart of AtlasClient for the async request path, backed by motor
+   """
+
+   def __init__ (self, altas_uri=os.environ.get("ATLAS_URI"), dbname='test'):
+       self.mongodb_client = _shared_client("async", altas_uri)
+       self.database = self.mongodb_client[dbname]
+
+   async def ping(self):
+       await self.mongodb_client.admin.command('ping')
+
+   def get_collection(self, collection_name):
+       collection = self.database[collection_name]
+       return collection
+
+   async def find(self, collection_name, filter = {}, limit=0, projection=None):
+       collection = self.database[collection_name]
+       items = await collection.find(filter=filter, projection=projection, limit=limit).to_list(length=None)
+       return items
+
+   async def aggregate(self, collection_name, pipeline):
+       collection = self.database[collection_name]
+       items = await collection.aggregate(pipeline).to_list(length=None)
+       return items
+
+   async def update(self, collection_name, filter, update):
+       collection = self.database[collection_name]
+       await collection.update_one(filter, update)
+       return True
+
+   async def insert(self, collection_name, data):
+       collection = self.database[collection_name]
+       result = await collection.insert_one(data)
+       return result.inserted_id
@@ -0,0 +1,235 @@
+import os
+import json
+import logging
+import threading
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+
+from pymongo_client import AtlasClient, AsyncAtlasClient
+
+load_dotenv()
+
+
+class ReferenceData:
+    """
+    In-memory copy of the slowly changing reference data: course _id -> app_code,
+    app_code -> config_list.json entry and persona name -> _id.
+
+    Courses and personas are reloaded every refresh_seconds by a background thread, and
+    right away on Mongo change-stream events when watch_changes is enabled.
+    data/config_list.json is reloaded whenever its modification time changes.
+
+    Attributes:
+    config_path (str): The path of the course config list.
+    refresh_seconds (int): The interval between two reloads of courses and personas.
+    watch_changes (bool): Whether to reload on change-stream events.
+    """
+    def __init__(self, config_path="data/config_list.json", refresh_seconds=None, watch_changes=None):
+        """
+        The constructor for the ReferenceData class.
+        """
+        if refresh_seconds is None:
+            refresh_seconds = int(os.environ.get("REFERENCE_DATA_REFRESH_SECONDS", 300))
+        if watch_changes is None:
+            watch_changes = os.environ.get("REFERENCE_DATA_CHANGE_STREAMS", "false").lower() in ("1", "true", "yes")
+
+        self.config_path = config_path
+        self.refresh_seconds = refresh_seconds
+        self.watch_changes = watch_changes
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._config_list = {}
+        self._config_mtime = None
+        self._course_codes = {}
+        self._personas = {}
+        self._loaded = False
+
+    def config(self):
+        """
+        Function to get the course config list, reloading it if the file changed.
+
+        Returns:
+        dict: The config entry of each course app code.
+        """
+        try:
+            mtime = os.path.getmtime(self.config_path)
+        except OSError as e:
+            logging.error(f"Error in reading {self.config_path}: {e}")
+            return self._config_list
+
+        if mtime != self._config_mtime:
+            with self._lock:
+                if mtime != self._config_mtime:
+                    try:
+                        with open(self.config_path, "r") as f:
+                            self._config_list = json.load(f)
+                        self._config_mtime = mtime
+                        logging.info(f"Loaded {len(self._config_list)} course configs from {self.config_path}")
+                    except ValueError as e:
+                        # Keep serving the previous config while the file is being rewritten
+                        logging.error(f"Error in parsing {self.config_path}: {e}")
+        return self._config_list
+
+    def refresh(self):
+        """
+        Function to reload the courses and personas from Mongo.
+        """
+        atlas_client = AtlasClient()
+        courses = atlas_client.find("courses")
+        personas = atlas_client.find("personas")
+        self._set(courses, personas)
+
+    async def arefresh(self):
+        """
+        Async version of refresh.
+        """
+        atlas_client = AsyncAtlasClient()
+        courses = await atlas_client.find("courses")
+        personas = await atlas_client.find("personas")
+        self._set(courses, personas)
+
+    def _set(self, courses, personas):
+        course_codes = {str(course["_id"]): course["app_code"] for course in courses if "app_code" in course}
+        personas = {persona["name"]: persona["_id"] for persona in personas}
+        with self._lock:
+            self._course_codes = course_codes
+            self._personas = personas
+            self._loaded = True
+        logging.info(f"Loaded {len(course_codes)} courses and {len(personas)} personas")
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.refresh()
+
+    async def _aensure_loaded(self):
+        if not self._loaded:
+            await self.arefresh()
+
+    def app_code(self, course_id):
+        """
+        Function to get the app code of a course.
+
+        Args:
+        course_id (str): The course _id.
+
+        Returns:
+        str: The app code, or None if the course does not exist.
+        """
+        course_id = str(ObjectId(course_id))
+        self._ensure_loaded()
+        app_code = self._course_codes.get(course_id)
+        if app_code is not None:
+            return app_code
+
+        # The course may have been added since the last refresh
+        course = AtlasClient().find("courses", {"_id": ObjectId(course_id)})
+        return self._remember_course(course_id, course)
+
+    async def aapp_code(self, course_id):
+        """
+        Async version of app_code.
+
+        Args:
+        course_id (str): The course _id.
+
+        Returns:
+        str: The app code, or None if the course does not exist.
+        """
+        course_id = str(ObjectId(course_id))
+        await self._aensure_loaded()
+        app_code = self._course_codes.get(course_id)
+        if app_code is not None:
+            return app_code
+
+        course = await AsyncAtlasClient().find("courses", {"_id": ObjectId(course_id)})
+        return self._remember_course(course_id, course)
+
+    def _remember_course(self, course_id, course):
+        if len(course) == 0 or "app_code" not in course[0]:
+            return None
+        app_code = course[0]["app_code"]
+        with self._lock:
+            self._course_codes[course_id] = app_code
+        return app_code
+
+    def course_config(self, app_code):
+        """
+        Function to get the config entry of a course.
+
+        Args:
+        app_code (str): The course app code.
+
+        Returns:
+        dict: The config entry, or None if the course has no config.
+        """
+        if app_code is None:
+            return None
+        return self.config().get(app_code)
+
+    def personas(self):
+        """
+        Function to get the persona ids.
+
+        Returns:
+        dict: The _id of each persona name.
+        """
+        self._ensure_loaded()
+        return self._personas
+
+    async def apersonas(self):
+        """
+        Async version of personas.
+
+        Returns:
+        dict: The _id of each persona name.
+        """
+        await self._aensure_loaded()
+        return self._personas
+
+    def start(self):
+        """
+        Function to start the background refresh (and change-stream) threads.
+        """
+        self._stop.clear()
+        threads = [threading.Thread(target=self._refresh_loop, name="reference-data-refresh", daemon=True)]
+        if self.watch_changes:
+            for collection_name in ("courses", "personas"):
+                threads.append(threading.Thread(target=self._watch_loop, args=(collection_name,),
+                                                name=f"reference-data-watch-{collection_name}", daemon=True))
+        for thread in threads:
+            thread.start()
+        self._threads = threads
+
+    def stop(self):
+        """
+        Function to stop the background threads.
+        """
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+                self.config()
+            except Exception as e:
+                logging.error(f"Error in refreshing the reference data: {e}")
+            self._stop.wait(self.refresh_seconds)
+
+    def _watch_loop(self, collection_name):
+        # Change streams need a replica set (Atlas clusters are); the periodic refresh still runs if this fails
+        while not self._stop.is_set():
+            try:
+                collection = AtlasClient().get_collection(collection_name)
+                with collection.watch(max_await_time_ms=1000) as stream:
+                    while not self._stop.is_set():
+                        if stream.try_next() is not None:
+                            logging.info(f"Change in {collection_name}, refreshing the reference data")
+                            self.refresh()
+            except Exception as e:
+                logging.error(f"Error in watching {collection_name}: {e}")
+                self._stop.wait(self.refresh_seconds)
+
+
+reference_data = ReferenceData()
@@ -0,0 +1,310 @@
+"""
+This script pre-renders the certificates of a course for a cohort of users, so the API can serve
+them without drawing them on the request path.
+
+Certificates are rendered in parallel in a process pool with the same drawing logic as
+get_quiz_certificate, and stored either in the local certificates directory (data/certificates,
+not committed) or in S3 under the course prefix. The run then writes the manifest of the course,
+mapping each user to the name and date drawn on their certificate; CertificateRenderer.prerendered
+only serves certificates listed in it whose name is still the name of the user, and needs
+CERTIFICATE_PRERENDERED_STORE set to the same output. Finished users are appended to a progress
+file, so an interrupted run picks up where it stopped.
+
+Usage:
+python render_certificates.py --course AIBDI --users 66aa9eafd221d572880a58a1,...
+python render_certificates.py --course <course _id> --query '{"courses": "<course _id>"}' --output s3
+
+Author: Shreyas Nikam
+"""
+
+
+import os
+import json
+import time
+import logging
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from bson.objectid import ObjectId
+
+from certificates import (decode_template, render_certificate, prerendered_path, prerendered_key, manifest_path,
+                          manifest_key, PRERENDERED_DIR)
+from pymongo_client import AtlasClient
+from reference_data import reference_data
+from s3_file_manager import S3FileManager
+
+
+logging.basicConfig(level=logging.INFO)
+
+# State of each worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(template_content, output, course_config, app_code, directory):
+    # Decode the template once per worker instead of once per certificate
+    _worker["template"] = decode_template(template_content)
+    _worker["output"] = output
+    _worker["course_config"] = course_config
+    _worker["app_code"] = app_code
+    _worker["directory"] = directory
+    _worker["s3"] = S3FileManager() if output == "s3" else None
+
+
+def _write_local(path, certificate):
+    # Write to a temporary file and rename it so the API never serves a partial file
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(certificate)
+    os.replace(tmp_path, path)
+
+
+def render_and_store(user_id, user_name, recorded_on):
+    """
+    Render the certificate of a user and store it, runs in a worker process
+
+    Args:
+    user_id: str - _id of the user
+    user_name: str - name drawn on the certificate
+    recorded_on: str - the completion date, formatted as %Y-%m-%d
+
+    Returns:
+    user_id: str - _id of the user
+
+    Raises:
+    RuntimeError: if the certificate could not be uploaded
+    """
+    certificate = render_certificate(_worker["template"], user_name, recorded_on)
+    if _worker["output"] == "s3":
+        key = prerendered_key(_worker["course_config"], user_id, recorded_on)
+        if not _worker["s3"].upload_file_from_bytes(certificate, key):
+            raise RuntimeError(f"Upload of {key} failed")
+    else:
+        _write_local(prerendered_path(_worker["app_code"], user_id, recorded_on, _worker["directory"]), certificate)
+    return user_id
+
+
+def resolve_course(course, reference_data):
+    """
+    Resolve a course given by _id or by app code
+
+    Args:
+    course: str - _id or app code of the course
+    reference_data: ReferenceData - the course reference data
+
+    Returns:
+    app_code: str - the app code of the course, or None
+    course_config: dict - the config_list.json entry of the course, or None
+    """
+    config = reference_data.config()
+    if course in config:
+        return course, config[course]
+    app_code = reference_data.app_code(course)
+    if app_code is None or app_code not in config:
+        return None, None
+    return app_code, config[app_code]
+
+
+def fetch_users(atlas_client, user_ids=None, query=None):
+    """
+    Fetch the _id and name of the users to render certificates for
+
+    Args:
+    atlas_client: AtlasClient - client to use
+    user_ids: list - _ids of the users
+    query: dict - filter on the users collection, used when user_ids is not given
+
+    Returns:
+    users: list - (user_id, name) tuples
+    """
+    if user_ids:
+        query = {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}}
+    users = atlas_client.find("users", query or {}, projection={"name": 1})
+    return [(str(user["_id"]), user["name"]) for user in users if user.get("name")]
+
+
+def load_progress(progress_path):
+    """
+    Load the users already rendered by previous runs
+
+    Args:
+    progress_path: str - path of the progress file
+
+    Returns:
+    done: dict - the last record (user_id, name, recorded_on) of each rendered user, by _id
+    """
+    done = {}
+    if not os.path.exists(progress_path):
+        return done
+    with open(progress_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                done[record["user_id"]] = record
+            except (ValueError, KeyError):
+                # A line cut short by an interrupted run
+                continue
+    return done
+
+
+def write_manifest(app_code, course_config, records, output, directory):
+    """
+    Add the rendered users to the manifest of the course, which the API checks before looking
+    for a pre-rendered certificate
+
+    Args:
+    app_code: str - the app code of the course
+    course_config: dict - the config_list.json entry of the course
+    records: dict - the progress records of the rendered users, by _id
+    output: str - "local" or "s3"
+    directory: str - the local certificates directory
+
+    Returns:
+    entries: int - number of users in the manifest
+    """
+    if output == "s3":
+        s3 = S3FileManager()
+        key = manifest_key(course_config)
+        content = s3.get_object(key)
+        manifest = json.loads(content) if content else {}
+    else:
+        path = manifest_path(app_code, directory)
+        manifest = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                manifest = json.load(f)
+
+    for user_id, record in records.items():
+        # Records written before the manifest existed do not have the name
+        if record.get("name") is not None:
+            manifest[user_id] = {"name": record["name"], "recorded_on": record["recorded_on"]}
+
+    content = json.dumps(manifest).encode("utf-8")
+    if output == "s3":
+        if not s3.upload_file_from_bytes(content, key):
+            raise RuntimeError(f"Upload of {key} failed")
+    else:
+        _write_local(path, content)
+    return len(manifest)
+
+
+def run_render_certificates(course, user_ids=None, query=None, output="local", workers=None, max_in_flight=None,
+                            recorded_on=None, directory=None, progress_path=None, force=False):
+    """
+    Render and store the certificates of a course for a cohort of users
+
+    Args:
+    course: str - _id or app code of the course
+    user_ids: list - _ids of the users
+    query: dict - filter on the users collection, used when user_ids is not given
+    output: str - "local" or "s3"
+    workers: int - number of worker processes, defaults to the number of CPUs
+    max_in_flight: int - maximum number of certificates queued at once
+    recorded_on: str - the completion date, defaults to today
+    directory: str - the local certificates directory
+    progress_path: str - path of the progress file
+    force: bool - render again users finished by a previous run
+
+    Returns:
+    summary: dict - number of rendered, skipped and failed users and the elapsed time
+    """
+    app_code, course_config = resolve_course(course, reference_data)
+    if app_code is None:
+        raise ValueError(f"Course {course} not found")
+
+    directory = directory or PRERENDERED_DIR
+    os.makedirs(os.path.join(directory, app_code), exist_ok=True)
+    progress_path = progress_path or os.path.join(directory, f".progress_{app_code}_{output}.jsonl")
+    recorded_on = recorded_on or datetime.datetime.now().strftime("%Y-%m-%d")
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 4
+
+    users = fetch_users(AtlasClient(), user_ids, query)
+    done = {} if force else load_progress(progress_path)
+    # Users renamed since their certificate was rendered are rendered again
+    pending = [(user_id, name) for user_id, name in users if done.get(user_id, {}).get("name") != name]
+    logging.info(f"{len(users)} users for {app_code}, {len(users) - len(pending)} already rendered")
+
+    # Fetch the template once in the parent, each worker decodes it in its initializer
+    template_content = S3FileManager().get_object(course_config["CERTIFICATE_PATH"])
+    if not template_content:
+        raise RuntimeError(f"Certificate template {course_config['CERTIFICATE_PATH']} not found")
+
+    start = time.time()
+    rendered, failed = 0, []
+    with open(progress_path, "a") as progress, ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(template_content, output, course_config, app_code, directory),
+    ) as executor:
+        in_flight = {}
+        queue = iter(pending)
+
+        def submit_next():
+            for user_id, name in queue:
+                in_flight[executor.submit(render_and_store, user_id, name, recorded_on)] = (user_id, name)
+                return True
+            return False
+
+        # Keep at most max_in_flight certificates queued so memory stays bounded for large cohorts
+        while len(in_flight) < max_in_flight and submit_next():
+            pass
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                user_id, name = in_flight.pop(future)
+                try:
+                    future.result()
+                    progress.write(json.dumps({"user_id": user_id, "name": name, "recorded_on": recorded_on}) + "\n")
+                    rendered += 1
+                except Exception as e:
+                    logging.error(f"Error in rendering the certificate of {user_id}: {e}")
+                    failed.append(user_id)
+                submit_next()
+            progress.flush()
+            if rendered and rendered % 100 == 0:
+                logging.info(f"Rendered {rendered}/{len(pending)} certificates")
+
+    # Built from the progress file, so users rendered by an interrupted run are listed as well
+    entries = write_manifest(app_code, course_config, load_progress(progress_path), output, directory)
+
+    summary = {
+        "app_code": app_code,
+        "rendered": rendered,
+        "manifest_entries": entries,
+        "skipped": len(users) - len(pending),
+        "failed": failed,
+        "elapsed_seconds": round(time.time() - start, 2),
+    }
+    logging.info(f"Finished rendering certificates: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render the certificates of a course")
+    parser.add_argument("--course", required=True, help="_id or app code of the course")
+    parser.add_argument("--users", help="comma separated _ids of the users")
+    parser.add_argument("--query", help="JSON filter on the users collection")
+    parser.add_argument("--output", choices=["local", "s3"], default="local")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--max-in-flight", type=int)
+    parser.add_argument("--recorded-on", help="completion date, formatted as %%Y-%%m-%%d")
+    parser.add_argument("--directory", help="local certificates directory")
+    parser.add_argument("--progress", help="path of the progress file")
+    parser.add_argument("--force", action="store_true", help="render users finished by a previous run again")
+    args = parser.parse_args()
+
+    if not args.users and not args.query:
+        parser.error("one of --users or --query is required")
+
+    run_render_certificates(
+        args.course,
+        user_ids=args.users.split(",") if args.users else None,
+        query=json.loads(args.query) if args.query else None,
+        output=args.output,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        recorded_on=args.recorded_on,
+        directory=args.directory,
+        progress_path=args.progress,
+        force=args.force,
+    )
@@ -0,0 +1,101 @@
+import uuid
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+
+
+# Id of the HTTP request being served, set by the request id middleware
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+
+
+class RequestMetrics:
+    """
+    Bounded in-memory store of the metric events recorded while serving each request.
+
+    Events are plain dictionaries (for example one per LLM call with its provider, token
+    counts and latency) so recording them is cheap. Only the most recent max_requests
+    requests are kept.
+
+    Attributes:
+    max_requests (int): The number of requests kept.
+    """
+    def __init__(self, max_requests=1000):
+        """
+        The constructor for the RequestMetrics class.
+        """
+        self.max_requests = max_requests
+        self._lock = threading.Lock()
+        self._events = OrderedDict()
+
+    def record(self, kind, request_id=None, **fields):
+        """
+        Function to record a metric event for the current request.
+
+        Args:
+        kind (str): The kind of event, e.g. "llm".
+        request_id (str): The request id. Defaults to the request being served.
+        fields: The event fields.
+
+        Returns:
+        dict: The recorded event.
+        """
+        event = {"kind": kind, **fields}
+        request_id = request_id or current_request_id.get()
+        logging.debug(f"Metric for request {request_id}: {event}")
+        if request_id is None:
+            return event
+
+        with self._lock:
+            events = self._events.get(request_id)
+            if events is None:
+                events = self._events[request_id] = []
+                while len(self._events) > self.max_requests:
+                    self._events.popitem(last=False)
+            events.append(event)
+        return event
+
+    def get(self, request_id, kind=None):
+        """
+        Function to get the events recorded for a request.
+
+        Args:
+        request_id (str): The request id.
+        kind (str): Only return events of this kind.
+
+        Returns:
+        list: The recorded events.
+        """
+        with self._lock:
+            events = list(self._events.get(request_id, []))
+        if kind is not None:
+            events = [event for event in events if event["kind"] == kind]
+        return events
+
+    def summary(self, request_id):
+        """
+        Function to summarize the LLM usage of a request.
+
+        Args:
+        request_id (str): The request id.
+
+        Returns:
+        dict: The number of LLM calls, total tokens and total latency, and every event.
+        """
+        events = self.get(request_id)
+        llm_events = [event for event in events if event["kind"] == "llm"]
+        return {
+            "request_id": request_id,
+            "llm_calls": len(llm_events),
+            "prompt_tokens": sum(event.get("prompt_tokens") or 0 for event in llm_events),
+            "completion_tokens": sum(event.get("completion_tokens") or 0 for event in llm_events),
+            "llm_latency_ms": round(sum(event.get("latency_ms") or 0 for event in llm_events), 1),
+            "events": events,
+        }
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+request_metrics = RequestMetrics()
@@ -2,13 +2,19 @@
 from langchain_community.vectorstores import FAISS
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from langchain_community.document_loaders import TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.retrievers.document_compressors import CohereRerank
 from langchain.retrievers import ContextualCompressionRetriever
 import pickle
 import os
+from bm25_index import BM25IndexRetriever, index_path
+from vector_index import load_vector_store, quantize_vector_store
+from embedding_cache import CachedQueryEmbeddings, embedding_cache
+from hybrid_retrieval import HybridRetriever, hybrid_settings
+from context_packing import create_context_packer
+from request_metrics import request_metrics
+import time
 from dotenv import load_dotenv
 
 # Create the logger object
@@ -20,6 +26,8 @@ load_dotenv()
 # Laod the secrets
 OPENAI_KEY = os.environ.get("OPENAI_KEY")
 COHERE_API_KEY = os.environ.get("COHERE_API_KEY")
+# Chunks kept by the re-ranker, the context packer then fits them in its token budget
+RERANK_TOP_N = int(os.environ.get("RERANK_TOP_N", 3))
 
 
 class Retriever:
@@ -32,6 +40,7 @@ class Retriever:
     faiss_retriever: The FAISS retriever.
     embeddings: The OpenAI embeddings.
     re_ranker: The Cohere re-ranker.
+    context_packer: Builds the context from the reranked chunks within a token budget.
     params_loaded: Whether the parameters are loaded or not.
     """
     def __init__(self, db_path):
@@ -41,20 +50,22 @@ class Retriever:
         self.bm25_retriever = None
         self.vector_store = None
         self.faiss_retriever = None
-        self.embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_KEY)
-        self.re_ranker = CohereRerank(cohere_api_key=COHERE_API_KEY)
+        self.embeddings = CachedQueryEmbeddings(OpenAIEmbeddings(openai_api_key=OPENAI_KEY), embedding_cache)
+        self.re_ranker = CohereRerank(cohere_api_key=COHERE_API_KEY, top_n=RERANK_TOP_N)
+        self.context_packer = create_context_packer()
         self.params_loaded = False
         self.compression_retriever = None
         self.retriever_db_path = db_path
         self.hybrid_db_path = f"{db_path}/hybrid_db"
 
         
-    def create_vector_store(self, file_name="sample.txt"):
+    def create_vector_store(self, file_name="sample.txt", quantization=None):
         """
         The function to create the vector store.
 
         Args:
         file_name (str): The name of the file to create the vector store.
+        quantization (str): "sq8" or "pq" to also write a quantized index, loaded in place of the flat one.
         """
 
         # Load the documents
@@ -69,7 +80,9 @@ class Retriever:
         self.vector_store = FAISS.from_documents(docs, self.embeddings)
 
         # Save the vector store
-        self.vector_store.save_local(self.db_path)
+        self.vector_store.save_local(self.hybrid_db_path)
+        if quantization:
+            quantize_vector_store(self.hybrid_db_path, quantization)
 
         # Create the retriever
         self.bm25_retriever = BM25Retriever.from_documents(docs)
@@ -94,25 +107,35 @@ class Retriever:
         """
 
         # Load the embeddings, retrievers and vector store which were saved earlier
-        self.embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_KEY)
-        self.vector_store = FAISS.load_local(self.hybrid_db_path, self.embeddings)
-        self.re_ranker = CohereRerank(cohere_api_key=COHERE_API_KEY)
-
-        with open(f"{self.retriever_db_path}/bm25_retriever.pkl", "rb") as f:
-            self.bm25_retriever = pickle.load(f)
+        # Query embeddings are cached, repeated questions skip the embeddings API call
+        self.embeddings = CachedQueryEmbeddings(OpenAIEmbeddings(openai_api_key=OPENAI_KEY), embedding_cache)
+        # Memory-mapped (or quantized) when the index was converted with vector_index.py
+        self.vector_store = load_vector_store(self.hybrid_db_path, self.embeddings)
+        self.re_ranker = CohereRerank(cohere_api_key=COHERE_API_KEY, top_n=RERANK_TOP_N)
+
+        # Prefer the memory-mapped BM25 index written by bm25_index.py over the pickled retriever
+        if os.path.isdir(index_path(self.retriever_db_path)):
+            self.bm25_retriever = BM25IndexRetriever.from_path(index_path(self.retriever_db_path))
+        else:
+            with open(f"{self.retriever_db_path}/bm25_retriever.pkl", "rb") as f:
+                self.bm25_retriever = pickle.load(f)
         with open(f"{self.retriever_db_path}/faiss_retriever.pkl", "rb") as f:
             self.faiss_retriever = pickle.load(f)
 
-        # Load the retrievers for use
+        # Load the retrievers for use, the lexical and vector legs run concurrently and are fused
+        # with reciprocal rank fusion, duplicate passages are merged before reranking
         faiss_retriever = self.vector_store.as_retriever(search_kwargs={"k": 5})
-        ensemble_retriever = EnsembleRetriever(
-            retrievers=[self.bm25_retriever, faiss_retriever], 
-            weights=[0.5, 0.5]
+        weights, rrf_k = hybrid_settings()
+        self.hybrid_retriever = HybridRetriever(
+            retrievers=[self.bm25_retriever, faiss_retriever],
+            names=["bm25", "faiss"],
+            weights=weights,
+            c=rrf_k,
         )
 
         self.compression_retriever = ContextualCompressionRetriever(
             base_compressor=self.re_ranker, 
-            base_retriever=ensemble_retriever
+            base_retriever=self.hybrid_retriever
         )
         
         self.params_loaded = True
@@ -137,7 +160,10 @@ class Retriever:
         if self.compression_retriever is None:
             self._load_params()
 
-        response = self.compression_retriever.invoke(query)
+        documents = self.hybrid_retriever.invoke(query)
+        start = time.perf_counter()
+        response = self.re_ranker.compress_documents(documents, query)
+        request_metrics.record("retrieval", stage="rerank", latency_ms=round((time.perf_counter() - start) * 1000, 2), documents=len(response))
         return response
     
     def parse_response_with_rerank(self, query):
@@ -154,7 +180,7 @@ class Retriever:
         response = self._retrieve_with_rerank(query)
         logging.debug(f"Response for query {query}: {response}")
         
-        # Parse and return the response
-        return '\n\n'.join([r.page_content for r in response])
+        # Pack the chunks by rerank score within the token budget of the context
+        return self.context_packer.pack(response, query)
     
 
@@ -0,0 +1,226 @@
+import time
+import random
+import asyncio
+import logging
+
+
+# Error kinds used to decide whether and how long to wait before the next attempt
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+PARSE = "parse"
+FATAL = "fatal"
+
+# Provider exception class names (openai, google.api_core, httpx) by kind, matched by name
+# so the classification works without importing every provider SDK
+RATE_LIMIT_ERRORS = {"RateLimitError", "ResourceExhausted", "TooManyRequests"}
+TRANSIENT_ERRORS = {"APITimeoutError", "APIConnectionError", "InternalServerError", "ServiceUnavailable",
+                    "DeadlineExceeded", "InternalServerErrorException", "ServerError", "TimeoutException",
+                    "ConnectError", "ReadTimeout", "TimeoutError", "ConnectionError"}
+FATAL_ERRORS = {"AuthenticationError", "PermissionDeniedError", "PermissionDenied", "BadRequestError",
+                "NotFoundError", "InvalidArgument", "Unauthenticated"}
+
+
+class ParseError(ValueError):
+    """
+    Raised when the LLM answered but the output could not be parsed.
+    """
+
+
+class RetryError(Exception):
+    """
+    Raised when every attempt allowed by a RetryPolicy failed.
+
+    Attributes:
+    attempts (list): The AttemptRecord of every attempt made.
+    """
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+class AttemptRecord:
+    """
+    Timing and outcome of a single attempt.
+
+    Attributes:
+    number (int): The attempt number, starting at 1.
+    duration (float): The time spent in the attempt in seconds.
+    error_kind (str): The kind of error raised, or None if the attempt succeeded.
+    error (Exception): The error raised, or None if the attempt succeeded.
+    delay (float): The time slept after the attempt in seconds.
+    """
+    def __init__(self, number, duration, error_kind=None, error=None, delay=0.0):
+        self.number = number
+        self.duration = duration
+        self.error_kind = error_kind
+        self.error = error
+        self.delay = delay
+
+    def to_dict(self):
+        return {
+            "attempt": self.number,
+            "duration": round(self.duration, 3),
+            "error_kind": self.error_kind,
+            "error": str(self.error) if self.error is not None else None,
+            "delay": round(self.delay, 3),
+        }
+
+
+def classify_error(error):
+    """
+    Function to classify an error raised by an LLM call.
+
+    Args:
+    error (Exception): The error raised.
+
+    Returns:
+    str: One of RATE_LIMIT, TRANSIENT, PARSE or FATAL.
+    """
+    names = {cls.__name__ for cls in type(error).__mro__}
+    status_code = getattr(error, "status_code", None) or getattr(error, "code", None)
+
+    if names & RATE_LIMIT_ERRORS or status_code == 429:
+        return RATE_LIMIT
+    if names & FATAL_ERRORS:
+        return FATAL
+    if names & TRANSIENT_ERRORS or (isinstance(status_code, int) and status_code >= 500):
+        return TRANSIENT
+    if isinstance(error, (ParseError, ValueError, KeyError, TypeError)):
+        return PARSE
+    # Unknown errors are retried with backoff, as the LLM helpers always did
+    return TRANSIENT
+
+
+class RetryPolicy:
+    """
+    Retry policy for LLM calls.
+
+    Nothing is slept before the first attempt. Parse errors are retried right away since
+    a new sample is likely to parse, rate-limit and transient errors are retried after an
+    exponential backoff with full jitter, and fatal errors are not retried. Retries stop
+    once max_attempts or max_total_time is reached.
+
+    Attributes:
+    max_attempts (int): The maximum number of attempts.
+    base_delay (float): The backoff base for transient errors in seconds.
+    rate_limit_delay (float): The backoff base for rate-limit errors in seconds.
+    max_delay (float): The maximum single backoff in seconds.
+    max_total_time (float): The maximum total time spent, including backoff, in seconds.
+    """
+    def __init__(self, max_attempts=5, base_delay=1.0, rate_limit_delay=4.0, max_delay=20.0, max_total_time=90.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.rate_limit_delay = rate_limit_delay
+        self.max_delay = max_delay
+        self.max_total_time = max_total_time
+
+    def backoff(self, error_kind, retry_number):
+        """
+        Function to get the delay before the next attempt.
+
+        Args:
+        error_kind (str): The kind of error of the failed attempt.
+        retry_number (int): The number of failed attempts so far.
+
+        Returns:
+        float: The delay in seconds.
+        """
+        if error_kind == PARSE:
+            return 0.0
+        base = self.rate_limit_delay if error_kind == RATE_LIMIT else self.base_delay
+        return random.uniform(0, min(self.max_delay, base * 2 ** (retry_number - 1)))
+
+    def _next_delay(self, record, started):
+        # Returns the delay before the next attempt, or None to stop retrying
+        if record.error_kind == FATAL or record.number >= self.max_attempts:
+            return None
+        delay = self.backoff(record.error_kind, record.number)
+        if time.monotonic() - started + delay > self.max_total_time:
+            return None
+        return delay
+
+    def _log(self, name, record):
+        if record.error is None:
+            logging.info(f"{name} attempt {record.number} succeeded in {record.duration:.2f}s")
+        else:
+            logging.warning(f"{name} attempt {record.number} failed in {record.duration:.2f}s "
+                            f"({record.error_kind}): {record.error}")
+
+    def run(self, fn, name="LLM call", attempts=None):
+        """
+        Function to call fn until it succeeds or the policy gives up.
+
+        Args:
+        fn (callable): Called with the error of the previous attempt (None on the first attempt).
+        name (str): The name used when logging the attempts.
+        attempts (list): Optional list the AttemptRecord of every attempt is appended to.
+
+        Returns:
+        The value returned by fn.
+        """
+        attempts = attempts if attempts is not None else []
+        started = time.monotonic()
+        previous_error = None
+        while True:
+            attempt_start = time.perf_counter()
+            try:
+                result = fn(previous_error)
+                record = AttemptRecord(len(attempts) + 1, time.perf_counter() - attempt_start)
+                attempts.append(record)
+                self._log(name, record)
+                return result
+            except Exception as e:
+                record = AttemptRecord(len(attempts) + 1, time.perf_counter() - attempt_start, classify_error(e), e)
+                attempts.append(record)
+                self._log(name, record)
+                previous_error = e
+
+            delay = self._next_delay(record, started)
+            if delay is None:
+                raise RetryError(f"{name} failed after {len(attempts)} attempts: {previous_error}", attempts)
+            record.delay = delay
+            if delay > 0:
+                time.sleep(delay)
+
+    async def arun(self, fn, name="LLM call", attempts=None):
+        """
+        Async version of run, fn must return an awaitable.
+
+        Args:
+        fn (callable): Called with the error of the previous attempt (None on the first attempt).
+        name (str): The name used when logging the attempts.
+        attempts (list): Optional list the AttemptRecord of every attempt is appended to.
+
+        Returns:
+        The value awaited from fn.
+        """
+        attempts = attempts if attempts is not None else []
+        started = time.monotonic()
+        previous_error = None
+        while True:
+            attempt_start = time.perf_counter()
+            try:
+                result = await fn(previous_error)
+                record = AttemptRecord(len(attempts) + 1, time.perf_counter() - attempt_start)
+                attempts.append(record)
+                self._log(name, record)
+                return result
+            except Exception as e:
+                record = AttemptRecord(len(attempts) + 1, time.perf_counter() - attempt_start, classify_error(e), e)
+                attempts.append(record)
+                self._log(name, record)
+                previous_error = e
+
+            delay = self._next_delay(record, started)
+            if delay is None:
+                raise RetryError(f"{name} failed after {len(attempts)} attempts: {previous_error}", attempts)
+            record.delay = delay
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+# Policy for the generation helpers in utils.py
+LLM_RETRY_POLICY = RetryPolicy(max_attempts=5)
+
+# Policy for the chatbot answers, a failed parse is retried with the retry prompt
+CHAT_RETRY_POLICY = RetryPolicy(max_attempts=4, max_total_time=60.0)
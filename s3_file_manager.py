@@ -1,26 +1,188 @@
+import io
 import os
+import time
+import asyncio
+import threading
 import boto3
-import tempfile
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, ClientError
 import logging
-from pathlib import Path
-import tempfile
+from collections import deque
 from dotenv import load_dotenv
-import os
+
+from request_metrics import request_metrics
 
 load_dotenv()
 
-class S3FileManager:
+
+def transfer_config():
+    """
+    Multipart threshold, chunk size and concurrency of uploads and downloads,
+    configured through S3_* environment variables
+    """
+    mb = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=int(float(os.environ.get("S3_MULTIPART_THRESHOLD_MB", 8)) * mb),
+        multipart_chunksize=int(float(os.environ.get("S3_MULTIPART_CHUNK_MB", 8)) * mb),
+        max_concurrency=int(os.environ.get("S3_MAX_CONCURRENCY", 10)),
+        use_threads=True,
+    )
+
+
+def client_config():
+    """
+    Connection pool and retry options of the shared S3 client. The pool is sized so every
+    thread of a multipart transfer, plus the request handlers, gets its own connection.
+    """
+    max_concurrency = int(os.environ.get("S3_MAX_CONCURRENCY", 10))
+    return Config(
+        max_pool_connections=max(int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 50)), max_concurrency),
+        retries={"max_attempts": int(os.environ.get("S3_MAX_ATTEMPTS", 5)), "mode": "standard"},
+        connect_timeout=int(os.environ.get("S3_CONNECT_TIMEOUT", 5)),
+        read_timeout=int(os.environ.get("S3_READ_TIMEOUT", 60)),
+    )
+
+
+class TransferStats:
+    """
+    Totals per direction and the most recent transfers with their throughput
+    """
+
+    def __init__(self, max_recent=100):
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._recent = deque(maxlen=max_recent)
+
+    def record(self, direction, key, size, seconds, ok):
+        transfer = {
+            "direction": direction,
+            "key": key,
+            "bytes": size,
+            "seconds": round(seconds, 4),
+            "mb_per_second": round(size / (1024 * 1024) / seconds, 2) if seconds > 0 else None,
+            "ok": ok,
+        }
+        with self._lock:
+            totals = self._totals.setdefault(direction, {"transfers": 0, "failed": 0, "bytes": 0, "seconds": 0.0})
+            totals["transfers"] += 1
+            totals["failed"] += 0 if ok else 1
+            totals["bytes"] += size
+            totals["seconds"] += seconds
+            self._recent.append(transfer)
+        request_metrics.record("s3", **transfer)
+        return transfer
+
+    def snapshot(self):
+        with self._lock:
+            totals = {}
+            for direction, total in self._totals.items():
+                seconds = total["seconds"]
+                totals[direction] = {
+                    **total,
+                    "seconds": round(seconds, 2),
+                    "mb_per_second": round(total["bytes"] / (1024 * 1024) / seconds, 2) if seconds > 0 else None,
+                }
+            return {"totals": totals, "recent": list(self._recent)}
+
+
+# boto3 clients are thread safe and each owns a connection pool, so one tuned client is
+# created per set of credentials and shared by every S3FileManager
+_clients = {}
+_clients_lock = threading.Lock()
+_transfer_stats = TransferStats()
+
+
+def _reset_after_fork():
+    # A forked process (e.g. a ProcessPoolExecutor worker) must not reuse the parent's client,
+    # its pooled sockets would be shared by both processes, nor a lock held at the time of the fork
+    global _clients, _clients_lock, _transfer_stats
+    _clients = {}
+    _clients_lock = threading.Lock()
+    _transfer_stats = TransferStats()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _shared_client(aws_access_key_id, aws_secret_access_key):
+    key = (aws_access_key_id, aws_secret_access_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = boto3.client(
+                's3',
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                config=client_config(),
+            )
+            _clients[key] = client
+        return client
+
+
+def transfer_stats():
+    """
+    Get the throughput of the transfers made by every S3FileManager
+    """
+    return _transfer_stats.snapshot()
+
+
+class _IterableReader(io.RawIOBase):
+    # Read-only file object over an iterable of byte chunks, so generators can be uploaded
+    # with upload_fileobj without being joined in memory first
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+class _Progress:
+    # Thread safe byte counter passed as the Callback of managed transfers
+
     def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes = 0
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.bytes += bytes_amount
+
+
+class S3FileManager:
+    def __init__(self, s3_client=None, bucket_name=None, config=None):
         # Initialize AWS credentials and S3 client
+        # s3_client and bucket_name can be given to use another endpoint, e.g. a local S3 stand-in
         self.aws_access_key_id = os.environ.get("AWS_ACCESS_KEY")
         self.aws_secret_access_key = os.environ.get("AWS_SECRET_KEY")
-        self.bucket_name = os.environ.get("AWS_BUCKET_NAME")
-        self.s3_client = boto3.client(
-            's3',
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key
-        )
+        self.bucket_name = bucket_name or os.environ.get("AWS_BUCKET_NAME")
+        self.s3_client = s3_client or _shared_client(self.aws_access_key_id, self.aws_secret_access_key)
+        self.config = config or transfer_config()
+
+    def _transfer(self, direction, key, transfer):
+        # Run a managed transfer, recording its size and throughput
+        progress = _Progress()
+        start = time.perf_counter()
+        ok = False
+        try:
+            transfer(progress)
+            ok = True
+        finally:
+            _transfer_stats.record(direction, key, progress.bytes, time.perf_counter() - start, ok)
 
     def upload_file(self, file_path, key):
         """
@@ -31,7 +193,8 @@ class S3FileManager:
         key: str - key to be used in the S3 bucket
         """
         try:
-            self.s3_client.upload_file(file_path, self.bucket_name, key)
+            self._transfer("upload", key, lambda progress: self.s3_client.upload_file(
+                file_path, self.bucket_name, key, Config=self.config, Callback=progress))
             return True
         except FileNotFoundError:
             logging.error("The file was not found")
@@ -42,32 +205,47 @@ class S3FileManager:
         except ClientError as e:
             logging.error(e)
             return False
-    
-    def list_files(self, key):
+
+    def upload_fileobj(self, fileobj, key):
         """
-        List all files in the S3 bucket with the given key
+        Upload a file object to S3, in parallel parts once it is larger than the multipart threshold
+
+        Args:
+        fileobj: file-like object - readable binary file object
+        key: str - key to be used in the S3 bucket
         """
         try:
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=key)
-            return response.get("Contents")
+            self._transfer("upload", key, lambda progress: self.s3_client.upload_fileobj(
+                fileobj, self.bucket_name, key, Config=self.config, Callback=progress))
+            return True
         except NoCredentialsError:
             logging.error("Credentials not available")
             return False
         except ClientError as e:
             logging.error(e)
             return False
-        
-    def download_file(self, key, download_path):
+
+    def upload_stream(self, chunks, key):
         """
-        Download a file from S3
+        Upload an iterable of byte chunks (e.g. a generator) to S3 without holding the whole object in memory
 
         Args:
-        key: str - key of the file in the S3 bucket
-        download_path: str - path to download the file
+        chunks: iterable - byte chunks of the object
+        key: str - key to be used in the S3 bucket
+        """
+        return self.upload_fileobj(io.BufferedReader(_IterableReader(chunks)), key)
+
+    def download_fileobj(self, key, fileobj):
+        """
+        Download an object from S3 into a file object, in parallel ranged parts for large objects
+
+        Args:
+        key: str - key of the object in the S3 bucket
+        fileobj: file-like object - writable binary file object
         """
         try:
-            with open(download_path, 'wb') as f:
-                self.s3_client.download_fileobj(self.bucket_name, key, f)
+            self._transfer("download", key, lambda progress: self.s3_client.download_fileobj(
+                self.bucket_name, key, fileobj, Config=self.config, Callback=progress))
             return True
         except NoCredentialsError:
             logging.error("Credentials not available")
@@ -75,7 +253,42 @@ class S3FileManager:
         except ClientError as e:
             logging.error(e)
             return False
-    
+
+    def list_files(self, key):
+        """
+        List all files in the S3 bucket with the given key
+
+        Args:
+        key: str - prefix of the keys to list
+
+        Returns:
+        files: list - Key, ETag, Size and LastModified of every object, across all result pages
+        """
+        try:
+            files = []
+            # list_objects_v2 returns at most 1000 keys per call
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=key):
+                files.extend(page.get("Contents", []))
+            return files
+        except NoCredentialsError:
+            logging.error("Credentials not available")
+            return False
+        except ClientError as e:
+            logging.error(e)
+            return False
+        
+    def download_file(self, key, download_path):
+        """
+        Download a file from S3
+
+        Args:
+        key: str - key of the file in the S3 bucket
+        download_path: str - path to download the file
+        """
+        with open(download_path, 'wb') as f:
+            return self.download_fileobj(key, f)
+
     def delete_file(self, key):
         """
         Delete a file from S3
@@ -95,62 +308,125 @@ class S3FileManager:
         
     def upload_file_from_bytes(self, data, key):
         """
-        Upload a file to S3 from bytes
+        Upload a file to S3 from bytes, without writing them to disk
 
         Args:
         data: bytes - data to be uploaded
         key: str - key to be used in the S3 bucket
         """
+        return self.upload_fileobj(io.BytesIO(data), key)
+
+    def download_file_to_bytes(self, key):
+        """
+        Download a file from S3 to bytes, without writing them to disk
+
+        Args:
+        key: str - key of the file in the S3 bucket
+        """
+        buffer = io.BytesIO()
+        if not self.download_fileobj(key, buffer):
+            return False
+        return buffer.getvalue()
+
+    def get_object(self, key):
+        """
+        Get an object from S3
+
+        Args:
+        key: str - key of the object in the S3 bucket
+        """
         try:
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(data)
-                temp_file.close()
-                self.upload_file(temp_file.name, key)
-                os.unlink(temp_file.name)
-            return True
+            start = time.perf_counter()
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+            content = response['Body'].read()
+            _transfer_stats.record("download", key, len(content), time.perf_counter() - start, True)
+            return content
         except NoCredentialsError:
             logging.error("Credentials not available")
             return False
         except ClientError as e:
             logging.error(e)
             return False
-        
-    def download_file_to_bytes(self, key):
+
+    def get_object_if_modified(self, key, etag=None):
         """
-        Download a file from S3 to bytes
+        Get an object from S3 unless it still has the given ETag
 
         Args:
-        key: str - key of the file in the S3 bucket
+        key: str - key of the object in the S3 bucket
+        etag: str - ETag of the copy held by the caller
+
+        Returns:
+        result: dict - content (None if not modified), etag and not_modified, or False on error
         """
         try:
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.close()
-                self.download_file(key, temp_file.name)
-                with open(temp_file.name, 'rb') as f:
-                    data = f.read()
-                os.unlink(temp_file.name)
-            return data
+            kwargs = {"Bucket": self.bucket_name, "Key": key}
+            if etag:
+                kwargs["IfNoneMatch"] = etag
+            start = time.perf_counter()
+            response = self.s3_client.get_object(**kwargs)
+            content = response['Body'].read()
+            _transfer_stats.record("download", key, len(content), time.perf_counter() - start, True)
+            return {"content": content, "etag": response.get("ETag"), "not_modified": False}
         except NoCredentialsError:
             logging.error("Credentials not available")
             return False
         except ClientError as e:
+            # S3 answers a matching If-None-Match with 304 Not Modified
+            if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                return {"content": None, "etag": etag, "not_modified": True}
             logging.error(e)
             return False
-    
-    def get_object(self, key):
+
+    def head_object(self, key):
         """
-        Get an object from S3
+        Get the size and ETag of an object in S3
 
         Args:
         key: str - key of the object in the S3 bucket
+
+        Returns:
+        metadata: dict - size, etag and content_type of the object, or False on error
         """
         try:
-            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
-            content = response['Body'].read()
-            return content
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+            return {"size": response["ContentLength"], "etag": response.get("ETag"), "content_type": response.get("ContentType")}
         except NoCredentialsError:
             logging.error("Credentials not available")
             return False
         except ClientError as e:
             logging.error(e)
-            return False
\ No newline at end of file
+            return False
+
+    def iter_object(self, key, start=None, end=None, chunk_size=64 * 1024):
+        """
+        Stream an object, or a byte range of it, from S3 in chunks
+
+        Args:
+        key: str - key of the object in the S3 bucket
+        start: int - first byte to return
+        end: int - last byte to return (inclusive)
+        chunk_size: int - size of the chunks yielded
+
+        Yields:
+        chunk: bytes - the next chunk of the object
+        """
+        kwargs = {"Bucket": self.bucket_name, "Key": key}
+        if start is not None:
+            kwargs["Range"] = f"bytes={start}-{end if end is not None else ''}"
+        body = self.s3_client.get_object(**kwargs)["Body"]
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    async def aget_object(self, key):
+        """
+        Get an object from S3 without blocking the event loop. boto3 is blocking,
+        so the download runs in the default executor.
+
+        Args:
+        key: str - key of the object in the S3 bucket
+        """
+        return await asyncio.to_thread(self.get_object, key)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(range_header, size):
+    """
+    Parse a single byte range of a Range header
+
+    Args:
+    range_header: str - value of the Range header, e.g. "bytes=0-1023"
+    size: int - size of the resource
+
+    Returns:
+    byte_range: tuple - (start, end) inclusive, or None to send the whole resource
+
+    Raises:
+    ValueError: if the range cannot be satisfied
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    ranges = range_header[len("bytes="):].split(",")
+    if len(ranges) != 1:
+        # Multipart ranges are not supported, the whole resource is sent instead
+        return None
+
+    start, _, end = ranges[0].strip().partition("-")
+    try:
+        if start == "":
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end != "" else size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range {range_header}")
+
+    if start >= size or start > end:
+        raise ValueError(f"Range {range_header} not satisfiable for size {size}")
+    return start, min(end, size - 1)
+
+
+def iter_file(path, start, end, chunk_size=CHUNK_SIZE):
+    """
+    Stream a byte range of a local file in chunks
+
+    Args:
+    path: str - path of the file
+    start: int - first byte
+    end: int - last byte (inclusive)
+    chunk_size: int - size of the chunks yielded
+    """
+    remaining = end - start + 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _resolve_source(s3, asset_cache, key):
+    # Prefer a recently validated local copy, otherwise ask S3 for the current size and ETag
+    local = asset_cache.local_copy(key) if asset_cache is not None else None
+    if local is not None:
+        return local
+    metadata = s3.head_object(key)
+    if metadata is False:
+        return None
+    if asset_cache is not None:
+        local = asset_cache.local_copy(key, etag=metadata["etag"])
+        if local is not None:
+            return local
+    return {"path": None, "etag": metadata["etag"], "size": metadata["size"]}
+
+
+async def stream_asset(s3, asset_cache, key, range_header=None, if_none_match=None, media_type="application/octet-stream"):
+    """
+    Build a streaming response for an S3 asset, honoring Range and If-None-Match.
+    The body is streamed from the local asset cache when it holds a current copy and
+    from S3 otherwise, so memory use does not grow with the size of the asset.
+
+    Args:
+    s3: S3FileManager - S3 file manager
+    asset_cache: AssetCache - cache holding local copies, or None
+    key: str - key of the asset in the S3 bucket
+    range_header: str - value of the Range request header
+    if_none_match: str - value of the If-None-Match request header
+    media_type: str - content type of the asset
+
+    Returns:
+    response: Response - 200, 206, 304, 404 or 416 response
+    """
+    source = await asyncio.to_thread(_resolve_source, s3, asset_cache, key)
+    if source is None:
+        return Response("File not found", status_code=404)
+
+    size, etag = source["size"], source["etag"]
+    headers = {"Accept-Ranges": "bytes", "Content-Disposition": "inline"}
+    if etag:
+        headers["ETag"] = etag
+    if etag and if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError as e:
+        logging.warning(str(e))
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    if source["path"] is not None:
+        body = iter_file(source["path"], start, end)
+    elif byte_range is not None:
+        body = s3.iter_object(key, start, end, chunk_size=CHUNK_SIZE)
+    else:
+        body = s3.iter_object(key, chunk_size=CHUNK_SIZE)
+    # Starlette iterates synchronous generators in its threadpool
+    return StreamingResponse(body, status_code=status_code, headers=headers, media_type=media_type)
@@ -0,0 +1,271 @@
+import os
+import ast
+import json
+import threading
+from typing import List
+from pydantic import BaseModel, ConfigDict, ValidationError
+from dotenv import load_dotenv
+
+from retry_policy import ParseError, PARSE
+from request_metrics import request_metrics
+
+load_dotenv()
+
+# Provider-native JSON output. gemini-pro rejects response_mime_type (only the 1.5 models support it)
+# so it is off by default for Gemini
+OPENAI_JSON_MODE = os.environ.get("OPENAI_JSON_MODE", "true").lower() == "true"
+GEMINI_JSON_MODE = os.environ.get("GEMINI_JSON_MODE", "false").lower() == "true"
+
+# Candidate objects tried before giving up on a response
+MAX_CANDIDATES = 20
+
+
+class ProfileSuggestions(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    skills: List[str]
+    preferred_jobs: List[str]
+    preferred_locations: List[str]
+    persona: str
+
+
+class SkillMatch(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    PROFILE_SKILLS: List[str]
+    JOB_DESCRIPTION_REQUIRED_SKILLS: List[str]
+    OVERLAPPED_SKILLS: List[str]
+    SKILLS_TO_BE_LEARNED: List[str]
+
+
+class ChatAnswer(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    answer: str
+    follow_up_questions: List[str] = []
+
+
+# Schema of the JSON returned for each prompt, by prompt name
+SCHEMAS = {
+    "GET_PROFILE_SUGGESTIONS_PROMPT": ProfileSuggestions,
+    "SKILL_MATCH_SCORE_PROMPT": SkillMatch,
+    "RESPONSE_PROMPT": ChatAnswer,
+}
+
+
+def openai_json_kwargs(prompt_text):
+    """
+    Function to get the call arguments enabling the OpenAI JSON mode.
+
+    Args:
+    prompt_text (str): The formatted prompt, OpenAI rejects the JSON mode unless the messages mention JSON.
+
+    Returns:
+    dict: The arguments, empty when the JSON mode is off or cannot be used.
+    """
+    if not OPENAI_JSON_MODE or "json" not in prompt_text.lower():
+        return {}
+    return {"response_format": {"type": "json_object"}}
+
+
+def gemini_json_kwargs():
+    """
+    Function to get the call arguments enabling the Gemini JSON mode.
+
+    Returns:
+    dict: The arguments, empty when the JSON mode is off.
+    """
+    if not GEMINI_JSON_MODE:
+        return {}
+    return {"generation_config": {"response_mime_type": "application/json"}}
+
+
+class JSONObjectScanner:
+    """
+    Finds the end of the first JSON object in a response while it is being streamed, skipping any
+    text or code fences before it. Nested objects, arrays and braces inside strings are handled,
+    and single-quoted strings are accepted since some prompts show Python literals as examples.
+
+    Attributes:
+    done (bool): Whether the object is complete.
+    """
+    def __init__(self):
+        """
+        The constructor for the JSONObjectScanner class.
+        """
+        self.done = False
+        self._parts = []
+        self._depth = 0
+        self._quote = None
+        self._escaped = False
+
+    def feed(self, chunk):
+        """
+        Function to feed the next chunk of the response.
+
+        Args:
+        chunk (str): The chunk.
+
+        Returns:
+        str: The text of the object once it is complete, otherwise None.
+        """
+        if self.done:
+            return None
+        start = 0
+        if self._depth == 0:
+            start = chunk.find("{")
+            if start < 0:
+                return None
+
+        for i in range(start, len(chunk)):
+            char = chunk[i]
+            if self._quote is not None:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == self._quote:
+                    self._quote = None
+            elif char in "\"'":
+                self._quote = char
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._parts.append(chunk[start:i + 1])
+                    self.done = True
+                    return "".join(self._parts)
+        self._parts.append(chunk[start:])
+        return None
+
+
+def _load_object(text):
+    try:
+        value = json.loads(text)
+    except ValueError:
+        # Python literals, e.g. single-quoted keys
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            return None
+    return value if isinstance(value, dict) else None
+
+
+def extract_json(text):
+    """
+    Function to extract the first JSON object of an LLM response.
+
+    Args:
+    text (str): The response, possibly with text or code fences around the object.
+
+    Returns:
+    dict: The object.
+    """
+    stripped = text.strip()
+    if stripped.startswith("{"):
+        # Fast path for the responses of the JSON modes
+        value = _load_object(stripped)
+        if value is not None:
+            return value
+
+    start = text.find("{")
+    for _ in range(MAX_CANDIDATES):
+        if start < 0:
+            break
+        scanner = JSONObjectScanner()
+        candidate = scanner.feed(text[start:])
+        # A stray brace before the object never closes, the object starts at a later brace
+        value = _load_object(candidate) if candidate is not None else None
+        if value is not None:
+            return value
+        start = text.find("{", start + 1)
+    raise ParseError("Could not find a JSON object in the response")
+
+
+def _validation_message(error):
+    fields = []
+    for detail in error.errors():
+        location = ".".join(str(part) for part in detail["loc"]) or "response"
+        fields.append(f"{location}: {detail['msg']}")
+    return "; ".join(fields)
+
+
+def parse_structured(text, schema_name=None):
+    """
+    Function to parse an LLM response and validate it against the schema of its prompt.
+
+    Args:
+    text (str): The response.
+    schema_name (str): The prompt name in SCHEMAS, responses of prompts without a schema are only parsed.
+
+    Returns:
+    dict: The parsed response.
+    """
+    value = extract_json(text)
+    schema = SCHEMAS.get(schema_name)
+    if schema is None:
+        return value
+    try:
+        return schema.model_validate(value).model_dump()
+    except ValidationError as e:
+        raise ParseError(f"The response does not match the expected format: {_validation_message(e)}") from e
+
+
+class RetryStats:
+    """
+    Number of attempts needed per prompt to get a well-formed response, totals since the process started.
+    """
+    def __init__(self):
+        """
+        The constructor for the RetryStats class.
+        """
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, prompt, provider, attempts, json_mode=False):
+        """
+        Function to record the attempts of one generation.
+
+        Args:
+        prompt (str): The prompt name.
+        provider (str): The LLM provider.
+        attempts (list): The AttemptRecord of every attempt made.
+        json_mode (bool): Whether the provider JSON mode was used.
+
+        Returns:
+        dict: The recorded event.
+        """
+        parse_failures = sum(1 for attempt in attempts if attempt.error_kind == PARSE)
+        ok = bool(attempts) and attempts[-1].error is None
+        with self._lock:
+            totals = self._totals.setdefault(f"{prompt}/{provider}", {
+                "prompt": prompt, "provider": provider, "generations": 0, "attempts": 0,
+                "parse_failures": 0, "first_attempt_ok": 0, "failed": 0,
+            })
+            totals["generations"] += 1
+            totals["attempts"] += len(attempts)
+            totals["parse_failures"] += parse_failures
+            totals["first_attempt_ok"] += 1 if len(attempts) == 1 and ok else 0
+            totals["failed"] += 0 if ok else 1
+        return request_metrics.record(
+            "llm_retry", prompt=prompt, provider=provider, json_mode=json_mode, attempts=len(attempts),
+            retries=max(len(attempts) - 1, 0), parse_failures=parse_failures, ok=ok,
+        )
+
+    def snapshot(self):
+        """
+        Function to get the totals per prompt and provider.
+
+        Returns:
+        list: The totals, with the average attempts and the share of generations needing a single round trip.
+        """
+        with self._lock:
+            totals = [dict(total) for total in self._totals.values()]
+        for total in totals:
+            total["average_attempts"] = round(total["attempts"] / total["generations"], 3)
+            total["first_attempt_ratio"] = round(total["first_attempt_ok"] / total["generations"], 3)
+        return totals
+
+
+retry_stats = RetryStats()
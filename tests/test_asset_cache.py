@@ -0,0 +1,143 @@
+"""
+Tests of the tiered asset cache against moto, a local S3 stand-in.
+
+Requires moto and pytest (pip install "moto[s3]" pytest), run from the repository root with:
+python -m pytest tests
+
+Author: Shreyas Nikam
+"""
+
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from asset_cache import AssetCache
+from s3_file_manager import S3FileManager
+
+
+BUCKET = "asset-cache-test"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield S3FileManager(s3_client=client, bucket_name=BUCKET)
+
+
+def put(s3, key, content):
+    s3.s3_client.put_object(Bucket=BUCKET, Key=key, Body=content)
+
+
+def count_requests(s3, delay=0.0):
+    # Counts the S3 requests made by the cache, optionally slowing them down to overlap concurrent misses
+    calls = []
+    get_object_if_modified = s3.get_object_if_modified
+
+    def counted(key, etag=None):
+        calls.append((key, etag))
+        time.sleep(delay)
+        return get_object_if_modified(key, etag)
+
+    s3.get_object_if_modified = counted
+    return calls
+
+
+def test_memory_hit(s3, tmp_path):
+    put(s3, "slides/m1.pdf", b"slides of module 1")
+    cache = AssetCache(s3, disk_dir=str(tmp_path))
+    calls = count_requests(s3)
+
+    assert cache.get("slides/m1.pdf") == b"slides of module 1"
+    assert cache.get("slides/m1.pdf") == b"slides of module 1"
+
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert stats["downloads"] == 1
+    assert stats["memory_hits"] == 1
+
+
+def test_disk_hit(s3, tmp_path):
+    put(s3, "slides/m1.pdf", b"slides of module 1")
+    AssetCache(s3, disk_dir=str(tmp_path)).get("slides/m1.pdf")
+
+    # A new process starts with an empty memory tier and reads the disk tier
+    cache = AssetCache(s3, disk_dir=str(tmp_path))
+    calls = count_requests(s3)
+
+    assert cache.get("slides/m1.pdf") == b"slides of module 1"
+    assert calls == []
+    assert cache.stats()["disk_hits"] == 1
+    assert cache.stats()["downloads"] == 0
+
+
+def test_revalidation_not_modified(s3, tmp_path):
+    put(s3, "quiz/m1.json", b'{"questions": []}')
+    cache = AssetCache(s3, disk_dir=str(tmp_path), revalidate_seconds=0)
+    calls = count_requests(s3)
+
+    first = cache.get("quiz/m1.json")
+    second = cache.get("quiz/m1.json")
+
+    assert first == second == b'{"questions": []}'
+    # The second lookup is a conditional GET with the ETag of the cached copy, answered with 304
+    assert calls[0][1] is None
+    assert calls[1][1] is not None
+    stats = cache.stats()
+    assert stats["downloads"] == 1
+    assert stats["not_modified"] == 1
+
+    put(s3, "quiz/m1.json", b'{"questions": [1]}')
+    assert cache.get("quiz/m1.json") == b'{"questions": [1]}'
+    assert cache.stats()["downloads"] == 2
+
+
+def test_single_flight(s3, tmp_path):
+    put(s3, "templates/certificate.jpg", b"template")
+    cache = AssetCache(s3, disk_dir=str(tmp_path))
+    calls = count_requests(s3, delay=0.2)
+
+    workers = 8
+    barrier = threading.Barrier(workers)
+
+    def get():
+        barrier.wait()
+        return cache.get("templates/certificate.jpg")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda _: get(), range(workers)))
+
+    assert results == [b"template"] * workers
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == workers - 1
+
+
+def test_disk_size_cap_eviction(s3, tmp_path):
+    content = b"x" * 400
+    for name in ("a", "b", "c"):
+        put(s3, f"assets/{name}", content)
+    # Room for two assets on disk
+    cache = AssetCache(s3, memory_max_mb=0, disk_dir=str(tmp_path), disk_max_mb=1000 / (1024 * 1024))
+
+    for name in ("a", "b", "c"):
+        assert cache.get(f"assets/{name}") == content
+        # Distinct modification times order the eviction
+        time.sleep(0.01)
+
+    assert cache.local_copy("assets/a") is None
+    assert cache.local_copy("assets/b") is not None
+    assert cache.local_copy("assets/c") is not None
+    cached_files = [name for name in os.listdir(tmp_path) if not name.endswith(".json") and not name.startswith(".")]
+    assert len(cached_files) == 2
+    assert cache.stats()["disk_mb"] * 1024 * 1024 <= 1000
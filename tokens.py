@@ -0,0 +1,86 @@
+import os
+import logging
+import threading
+import tiktoken
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Used for models tiktoken does not know, e.g. gemini-pro
+DEFAULT_ENCODING = "cl100k_base"
+# Characters per token assumed when no encoding can be loaded
+CHARS_PER_TOKEN = 4
+
+_lock = threading.Lock()
+_encodings = {}
+
+
+def get_encoding(model=None):
+    """
+    Function to get the tiktoken encoding of a model. The encoding files are downloaded on first use
+    (or read from TIKTOKEN_CACHE_DIR), if that fails token counts are estimated from the length instead.
+
+    Args:
+    model (str): The model name, defaults to OPENAI_MODEL.
+
+    Returns:
+    tiktoken.Encoding: The encoding, or None if it could not be loaded.
+    """
+    model = model or os.environ.get("OPENAI_MODEL") or ""
+    with _lock:
+        if model in _encodings:
+            return _encodings[model]
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+        except Exception as e:
+            logging.warning(f"Error in loading the tokenizer of {model or 'the default model'}, estimating token counts: {e}")
+            encoding = None
+        _encodings[model] = encoding
+        return encoding
+
+
+def count_tokens(text, model=None):
+    """
+    Function to count the tokens of a text.
+
+    Args:
+    text (str): The text.
+    model (str): The model name, defaults to OPENAI_MODEL.
+
+    Returns:
+    int: The number of tokens.
+    """
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens, model=None, keep_end=False):
+    """
+    Function to cut a text to at most max_tokens tokens.
+
+    Args:
+    text (str): The text.
+    max_tokens (int): The maximum number of tokens.
+    model (str): The model name, defaults to OPENAI_MODEL.
+    keep_end (bool): Whether to keep the end of the text rather than its beginning.
+
+    Returns:
+    str: The text, cut at a token boundary if it was too long.
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        return text[-max_chars:] if keep_end else text[:max_chars]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[-max_tokens:] if keep_end else tokens[:max_tokens])
@@ -1,39 +1,180 @@
 from bson.objectid import ObjectId
-import time
 import json
+import asyncio
 from langchain_core.prompts import PromptTemplate
 
 from llm import LLM
-import random
+from retry_policy import LLM_RETRY_POLICY, RetryError, ParseError
+from structured_output import parse_structured, retry_stats
+from llm_cache import llm_cache, make_cache_key
+from request_metrics import request_metrics
 
 from urllib.parse import urlencode
 from jobspy import scrape_jobs
 import ast
 import logging
 
-from pymongo_client import AtlasClient
+from pymongo_client import AtlasClient, AsyncAtlasClient
+from reference_data import reference_data
+from profile_data import load_profile_job_bundle, aload_profile_job_bundle
 
 
+# LLMs tried in order for every generation
+FALLBACK_LLMS = ["chatgpt", "gemini"]
 
-def get_response_from_llm(llm, prompt, inputs, output_type="json"):
-    trials = 5
-    for _ in range(trials):
-        try:
-            time.sleep(random.randint(1, 3))
-            response = llm.get_response(prompt, inputs=inputs)
-            if response == 'Please update profile or resume to get a better recommendation.':
-                return response
-            else:
-                logging.info(f"Processed response: {response}")
-                if output_type == "json":
-                    return json.loads(response[response.index("{"):response.index("}")+1])
-                else:
-                    return response
-        except Exception as e:
-            logging.error(f"Error in getting response: {e}")
-            continue
+NO_RECOMMENDATION_RESPONSE = 'Please update profile or resume to get a better recommendation.'
+GENERIC_ERROR_RESPONSE = "Something went wrong. Please try again later."
+
+# Profile fields sent to the LLM for each prompt
+PROFILE_SUGGESTION_FIELDS = ["summary", "name", "headline", "location_name", "education", "experience",
+                             "courses_taken", "publications", "projects", "certifications", "patents", "awards"]
+PROFILE_JOB_FIELDS = ["summary", "name", "linkedin_profile_id", "headline", "location_name", "education", "experience",
+                      "courses_taken", "publications", "projects", "certifications", "patents", "awards", "skills"]
+SKILL_MATCH_PROFILE_FIELDS = ["summary", "name", "headline", "location_name", "education", "experience",
+                              "courses_taken", "publications", "projects", "certifications", "patents", "awards", "skills"]
+
+EMPTY_SKILL_MATCH = {
+    "profile_skills": [],
+    "job_description_required_skills": [],
+    "overlapped_skills": [],
+    "skills_to_be_learned": [],
+    "match_score": 0
+}
+
+
+def _parse_llm_response(response, output_type, prompt_name=None):
+    if response == NO_RECOMMENDATION_RESPONSE:
+        return response
+    logging.info(f"Processed response: {response}")
+    if output_type == "json":
+        # Raises ParseError, so the policy samples again, if there is no object or it does not match the prompt schema
+        return parse_structured(response, prompt_name)
+    return response
+
+
+def _validate_llm_response(response, validate):
+    # Responses the caller cannot use are sampled again and never cached
+    if validate is None:
+        return response
+    try:
+        validate(response)
+    except Exception as e:
+        raise ParseError(f"The response was rejected: {type(e).__name__}: {e}") from e
+    return response
+
+
+def _llm_cache_key(llm, prompt, inputs, prompt_name):
+    if llm_cache is None or prompt_name is None:
+        return None
+    return make_cache_key(prompt_name, prompt.template, inputs, llm.llm_type)
+
+
+def _usable_cached(cached, validate, prompt_name):
+    # Entries cached before the caller validated its results may still be unusable
+    if cached is None:
+        return None
+    try:
+        return _validate_llm_response(cached, validate)
+    except ParseError as e:
+        logging.warning(f"Ignoring the cached {prompt_name} response: {e}")
+        return None
+
+
+def get_response_from_llm(llm, prompt, inputs, output_type="json", policy=LLM_RETRY_POLICY, prompt_name=None, regenerate=False, validate=None):
+    # Results are cached by prompt, template, inputs and provider unless the user asked to regenerate.
+    # validate is called with the parsed response and raises if the caller cannot use it, only responses
+    # passing it are returned and cached
+    cache_key = _llm_cache_key(llm, prompt, inputs, prompt_name)
+    if cache_key is not None and not regenerate:
+        cached = _usable_cached(llm_cache.get(cache_key), validate, prompt_name)
+        request_metrics.record("llm_cache", prompt=prompt_name, provider=llm.llm_type, hit=cached is not None)
+        if cached is not None:
+            return cached
+
+    json_mode = output_type == "json"
+
+    def attempt(previous_error):
+        response = llm.get_response(prompt, inputs=inputs, json_mode=json_mode)
+        return _validate_llm_response(_parse_llm_response(response, output_type, prompt_name), validate)
+
+    attempts = []
+    try:
+        response = policy.run(attempt, name=f"{llm.llm_type} generation", attempts=attempts)
+    except RetryError as e:
+        logging.error(f"Error in getting response: {e}")
+        raise Exception("Something went wrong. Please try again later.") from e
+    finally:
+        retry_stats.record(prompt_name, llm.llm_type, attempts, json_mode=json_mode and llm.json_mode)
+
+    if cache_key is not None:
+        llm_cache.set(cache_key, response)
+    return response
+
+
+async def aget_response_from_llm(llm, prompt, inputs, output_type="json", policy=LLM_RETRY_POLICY, prompt_name=None, regenerate=False, validate=None):
+    cache_key = _llm_cache_key(llm, prompt, inputs, prompt_name)
+    blocking_cache = llm_cache is not None and llm_cache.backend.blocking
+    if cache_key is not None and not regenerate:
+        if blocking_cache:
+            cached = await asyncio.to_thread(llm_cache.get, cache_key)
+        else:
+            cached = llm_cache.get(cache_key)
+        cached = _usable_cached(cached, validate, prompt_name)
+        request_metrics.record("llm_cache", prompt=prompt_name, provider=llm.llm_type, hit=cached is not None)
+        if cached is not None:
+            return cached
+
+    json_mode = output_type == "json"
+
+    async def attempt(previous_error):
+        response = await llm.aget_response(prompt, inputs=inputs, json_mode=json_mode)
+        return _validate_llm_response(_parse_llm_response(response, output_type, prompt_name), validate)
+
+    attempts = []
+    try:
+        response = await policy.arun(attempt, name=f"{llm.llm_type} generation", attempts=attempts)
+    except RetryError as e:
+        logging.error(f"Error in getting response: {e}")
+        raise Exception("Something went wrong. Please try again later.") from e
+    finally:
+        retry_stats.record(prompt_name, llm.llm_type, attempts, json_mode=json_mode and llm.json_mode)
 
-    raise Exception("Something went wrong. Please try again later.")
+    if cache_key is not None:
+        if blocking_cache:
+            await asyncio.to_thread(llm_cache.set, cache_key, response)
+        else:
+            llm_cache.set(cache_key, response)
+    return response
+
+
+def load_prompt(prompt_name, input_variables, extra=""):
+    """
+    Load a prompt from data/prompts.json
+
+    Args:
+    prompt_name: str - key of the prompt in data/prompts.json
+    input_variables: list - input variables of the prompt
+    extra: str - text appended to the prompt template
+
+    Returns:
+    prompt: PromptTemplate - the prompt
+    """
+    template = json.load(open("data/prompts.json", "r"))[prompt_name] + extra
+    return PromptTemplate(template=template, input_variables=input_variables)
+
+
+def select_profile_fields(profile, fields):
+    """
+    Keep only the given fields of a user profile and format them for a prompt
+
+    Args:
+    profile: dict - user document
+    fields: list - fields to keep
+
+    Returns:
+    profile: str - the selected fields as a string
+    """
+    return str({field: profile[field] for field in fields})
 
 
 def get_jobs(role):
@@ -60,299 +201,235 @@ def get_jobs(role):
     return jobs
 
 
-def update_profile(profile_id):
+def _profile_suggestions_update(response, personas):
+    # Raises if the response does not have the expected fields or persona
+    skills = response["skills"]
+    preferred_jobs = response["preferred_jobs"]
+    preferred_locations = response["preferred_locations"]
+    persona = response["persona"]
+
+    # get the id of the persona
+    persona_id = personas[persona]
+    return {"$set": {"skills": skills, "preferred_jobs": preferred_jobs, "preferred_locations": preferred_locations, "persona": persona_id}}
 
-    # Try with chatgpt
-    llm = LLM("chatgpt")
-    suggestions_prompt = json.load(open("data/prompts.json", "r"))["GET_PROFILE_SUGGESTIONS_PROMPT"]
-    prompt = PromptTemplate(
-            template=suggestions_prompt,
-            input_variables=["PROFILE"]
-        )
+
+def update_profile(profile_id, regenerate=False):
+    prompt = load_prompt("GET_PROFILE_SUGGESTIONS_PROMPT", ["PROFILE"])
 
     atlas_client = AtlasClient()
-    profile = atlas_client.find("users", filter={"_id": ObjectId(profile_id)})
+    profile = atlas_client.find("users", filter={"_id": ObjectId(profile_id)}, projection=PROFILE_SUGGESTION_FIELDS)
 
     if len(profile) == 0:
         return {}
-    
-    # get the list of personas from the db
-    personas = atlas_client.find("personas")
-    # convert it to a dictionary of names and their ids
-    personas = {persona["name"]: persona["_id"] for persona in personas}
-
-
-    profile = profile[0]
-    profile = {
-        "summary": profile["summary"],
-        "name": profile["name"],
-        "headline": profile["headline"],
-        "location_name": profile["location_name"],
-        "education": profile["education"],
-        "experience": profile["experience"],
-        "courses_taken": profile["courses_taken"],
-        "publications": profile["publications"],
-        "projects": profile["projects"],
-        "certifications": profile["certifications"],
-        "patents": profile["patents"],
-        "awards": profile["awards"],
-    }
-    profile = str(profile)
 
-    try:
-        response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile}, output_type="json")
-    except Exception as e:
-        logging.error(f"Error in getting profile suggestions: {e}")
-        response = None
-    
-    try:
-        skills = response["skills"]
-        preferred_jobs = response["preferred_jobs"]
-        preferred_locations = response["preferred_locations"]
-        persona = response["persona"]
-
-        # get the id of the persona
-        persona_id = personas[persona]
-        
-        # update the db
-        atlas_client.update("users", filter={"linkedin_profile_id": profile_id}, update={"$set": {"skills": skills, "preferred_jobs": preferred_jobs, "preferred_locations": preferred_locations, "persona": persona_id}})
-        return response
-    except Exception as e:
-        logging.error(f"Error in updating profile: {e}")
-        pass
+    # get the persona names and their ids
+    personas = reference_data.personas()
 
-    logging.info("Retrying to get profile suggestions with gemini")
-    llm.change_llm_type("gemini")
+    profile = select_profile_fields(profile[0], PROFILE_SUGGESTION_FIELDS)
 
-    try:
-        response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile}, output_type="json")
-    except Exception as e:
-        logging.error(f"Error in getting profile suggestions: {e}")
-        response = None
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to get profile suggestions with {llm_type}")
+            llm.change_llm_type(llm_type)
 
-    try:
-        skills = response["skills"]
-        preferred_jobs = response["preferred_jobs"]
-        preferred_locations = response["preferred_locations"]
-        persona = response["persona"]
-        # get the id of the persona
-        persona_id = personas[persona]
-        
-        # update the db
-        atlas_client.update("users", filter={"linkedin_profile_id": profile_id}, update={"$set": {"skills": skills, "preferred_jobs": preferred_jobs, "preferred_locations": preferred_locations, "persona": persona_id}})
-        return response
-    except Exception as e:
-        logging.error(f"Error in updating profile: {e}")
-        pass
+        try:
+            response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile}, output_type="json", prompt_name="GET_PROFILE_SUGGESTIONS_PROMPT", regenerate=regenerate,
+                                             validate=lambda response: _profile_suggestions_update(response, personas))
+        except Exception as e:
+            logging.error(f"Error in getting profile suggestions: {e}")
+            response = None
+
+        try:
+            update = _profile_suggestions_update(response, personas)
+            # update the db
+            atlas_client.update("users", filter={"linkedin_profile_id": profile_id}, update=update)
+            return response
+        except Exception as e:
+            logging.error(f"Error in updating profile: {e}")
 
     return {}
 
 
-def get_course_outline(profile_id, job_id, feedback=''):
-    # try with chatgpt
-    llm = LLM("chatgpt")
+async def aupdate_profile(profile_id, regenerate=False):
+    prompt = load_prompt("GET_PROFILE_SUGGESTIONS_PROMPT", ["PROFILE"])
+
+    atlas_client = AsyncAtlasClient()
+    profile = await atlas_client.find("users", filter={"_id": ObjectId(profile_id)}, projection=PROFILE_SUGGESTION_FIELDS)
+
+    if len(profile) == 0:
+        return {}
+
+    personas = await reference_data.apersonas()
+
+    profile = select_profile_fields(profile[0], PROFILE_SUGGESTION_FIELDS)
+
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to get profile suggestions with {llm_type}")
+            llm.change_llm_type(llm_type)
 
-    # get the course outline prompt
-    course_outline_prompt = json.load(open("data/prompts.json", "r"))["GET_COURSE_OUTLINE_PROMPT"]
-    
+        try:
+            response = await aget_response_from_llm(llm, prompt, inputs={"PROFILE": profile}, output_type="json", prompt_name="GET_PROFILE_SUGGESTIONS_PROMPT", regenerate=regenerate,
+                                                    validate=lambda response: _profile_suggestions_update(response, personas))
+        except Exception as e:
+            logging.error(f"Error in getting profile suggestions: {e}")
+            response = None
+
+        try:
+            update = _profile_suggestions_update(response, personas)
+            await atlas_client.update("users", filter={"linkedin_profile_id": profile_id}, update=update)
+            return response
+        except Exception as e:
+            logging.error(f"Error in updating profile: {e}")
+
+    return {}
+
+
+def _course_outline_prompt(feedback):
     # if feedback is provided, add it to the prompt
+    extra = ""
     if feedback and feedback!="":
-        course_outline_prompt += f"The user has provided some feedback which needs to be incorporated into the course outline. The feedback is as follows: {feedback}."
+        extra = f"The user has provided some feedback which needs to be incorporated into the course outline. The feedback is as follows: {feedback}."
+    return load_prompt("GET_COURSE_OUTLINE_PROMPT", ["SKILLS", "PROFILE", "POSITION", "DESCRIPTION", "FEEDBACK"], extra)
+
+
+def get_course_outline(profile_id, job_id, feedback='', regenerate=False):
+    prompt = _course_outline_prompt(feedback)
+    # feedback means the user wants a new outline
+    regenerate = regenerate or bool(feedback)
 
-    prompt = PromptTemplate(
-            template=course_outline_prompt,
-            input_variables=["SKILLS", "PROFILE", "POSITION", "DESCRIPTION", "FEEDBACK"]
-        )
-    
     atlas_client = AtlasClient()
-    profile = atlas_client.find("users", filter={"_id": ObjectId(profile_id)})
-    original_job = atlas_client.find("jobsvisiteds", filter={"_id": ObjectId(job_id)})
-
-    if len(original_job) == 0:
-        return "Something went wrong. Please try again later."
-    
-    original_job_id = original_job[0]["job"]
-    job = atlas_client.find("jobs", filter={"_id": ObjectId(original_job_id)})
-
-    if len(profile) == 0 or len(job) == 0:
-        return "Something went wrong. Please try again later."
-    
-    profile = profile[0]
-    job = job[0]
-
-    profile = {
-        "summary": profile["summary"],
-        "name": profile["name"],
-        "linkedin_profile_id": profile["linkedin_profile_id"],
-        "headline": profile["headline"],
-        "location_name": profile["location_name"],
-        "education": profile["education"],
-        "experience": profile["experience"],
-        "courses_taken": profile["courses_taken"],
-        "publications": profile["publications"],
-        "projects": profile["projects"],
-        "certifications": profile["certifications"],
-        "patents": profile["patents"],
-        "awards": profile["awards"],
-        "skills": profile["skills"]
-    }
+    bundle = load_profile_job_bundle(profile_id, job_id, PROFILE_JOB_FIELDS, atlas_client)
 
-    skills = original_job[0]["skill_delta"]
-    job_position = job["title"]
-    job_description = job["description"]
-    profile = str(profile)
+    if bundle.visit is None or bundle.profile is None or bundle.job is None:
+        return GENERIC_ERROR_RESPONSE
 
+    job = bundle.job
+    profile = select_profile_fields(bundle.profile, PROFILE_JOB_FIELDS)
+    inputs = {"SKILLS": bundle.visit["skill_delta"], "PROFILE": profile, "POSITION": job["title"], "DESCRIPTION": job["description"]}
 
-    inputs = {"SKILLS": skills, "PROFILE": profile, "POSITION": job_position, "DESCRIPTION": job_description}
-    output_type = "string"
-    
-    try:
-        response = get_response_from_llm(llm, prompt, inputs, output_type)
-        
-        if response == 'Please update profile or resume to get a better recommendation.':
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to get course outline with {llm_type}")
+            llm.change_llm_type(llm_type)
+
+        try:
+            response = get_response_from_llm(llm, prompt, inputs, output_type="string", prompt_name="GET_COURSE_OUTLINE_PROMPT", regenerate=regenerate)
+
+            if response == NO_RECOMMENDATION_RESPONSE:
+                return response
+
+            atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"course_outline": response}})
             return response
-    
-        atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"course_outline": response}})
-        return response
-    except Exception as e:
-        logging.error(f"Error in getting course outline: {e}")
-        response = None
+        except Exception as e:
+            logging.error(f"Error in getting course outline: {e}")
 
-    
-    logging.info("Retrying to get course outline with gemini")
-    llm.change_llm_type("gemini")
+    return GENERIC_ERROR_RESPONSE
 
-    try:
-        response = get_response_from_llm(llm, prompt, inputs, output_type)
-        
-        if response == 'Please update profile or resume to get a better recommendation.':
+
+async def aget_course_outline(profile_id, job_id, feedback='', regenerate=False):
+    prompt = _course_outline_prompt(feedback)
+    regenerate = regenerate or bool(feedback)
+
+    atlas_client = AsyncAtlasClient()
+    bundle = await aload_profile_job_bundle(profile_id, job_id, PROFILE_JOB_FIELDS, atlas_client)
+
+    if bundle.visit is None or bundle.profile is None or bundle.job is None:
+        return GENERIC_ERROR_RESPONSE
+
+    job = bundle.job
+    profile = select_profile_fields(bundle.profile, PROFILE_JOB_FIELDS)
+    inputs = {"SKILLS": bundle.visit["skill_delta"], "PROFILE": profile, "POSITION": job["title"], "DESCRIPTION": job["description"]}
+
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to get course outline with {llm_type}")
+            llm.change_llm_type(llm_type)
+
+        try:
+            response = await aget_response_from_llm(llm, prompt, inputs, output_type="string", prompt_name="GET_COURSE_OUTLINE_PROMPT", regenerate=regenerate)
+
+            if response == NO_RECOMMENDATION_RESPONSE:
+                return response
+
+            await atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"course_outline": response}})
             return response
-        
-        atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"course_outline": response}})
-        return response
-    except Exception as e:
-        logging.error(f"Error in getting course outline: {e}")
-        response = None
-    
-    return "Something went wrong. Please try again later."
-    
-
-def generate_cover_letter(profile_id, job_id):
-    llm = LLM("chatgpt")
-    cover_letter_prompt = json.load(open("data/prompts.json", "r"))["GENERATE_COVER_LETTER_PROMPT"]
-    prompt = PromptTemplate(
-            template=cover_letter_prompt,
-            input_variables=["PROFILE", "JOB_DESCRIPTION"]
-        )
-    
+        except Exception as e:
+            logging.error(f"Error in getting course outline: {e}")
+
+    return GENERIC_ERROR_RESPONSE
+
+
+def generate_cover_letter(profile_id, job_id, regenerate=False):
+    prompt = load_prompt("GENERATE_COVER_LETTER_PROMPT", ["PROFILE", "JOB_DESCRIPTION"])
+
     atlas_client = AtlasClient()
-    
-    profile = atlas_client.find("users", filter={"_id": ObjectId(profile_id)})
-    original_job = atlas_client.find("jobsvisiteds", filter={"_id": ObjectId(job_id)})
-
-    
-    if len(original_job) == 0:
-        return "Something went wrong. Please try again later."
-    
-    original_job_id = original_job[0]["job"]
-    job = atlas_client.find("jobs", filter={"_id": ObjectId(original_job_id)})
-    
-
-    if len(profile) == 0 or len(job) == 0:
-        return "Something went wrong. Please try again later."
-    
-    profile = profile[0]
-    job = job[0]
-
-    profile = {
-        "summary": profile["summary"],
-        "name": profile["name"],
-        "linkedin_profile_id": profile["linkedin_profile_id"],
-        "headline": profile["headline"],
-        "location_name": profile["location_name"],
-        "education": profile["education"],
-        "experience": profile["experience"],
-        "courses_taken": profile["courses_taken"],
-        "publications": profile["publications"],
-        "projects": profile["projects"],
-        "certifications": profile["certifications"],
-        "patents": profile["patents"],
-        "awards": profile["awards"],
-        "skills": profile["skills"]
-    }
+    bundle = load_profile_job_bundle(profile_id, job_id, PROFILE_JOB_FIELDS, atlas_client)
 
-    job_position = job["title"]
-    profile = str(profile)
-    job_description = job_position+"\n\n"+job["description"]
+    if bundle.visit is None or bundle.profile is None or bundle.job is None:
+        return GENERIC_ERROR_RESPONSE
 
-    try:
-        response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="string")
-        if response == 'Please update profile or resume to get a better recommendation.':
-            return response
-        
-        # update the cover letter in the jobsvisited
-        atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"cover_letter": response}})
-        return response
-    except Exception as e:
-        logging.error(f"Error in generating cover letter: {e}")
-        response = None
+    job = bundle.job
+    profile = select_profile_fields(bundle.profile, PROFILE_JOB_FIELDS)
+    job_description = job["title"]+"\n\n"+job["description"]
 
-   
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to generate cover letter with {llm_type}")
+            llm.change_llm_type(llm_type)
 
-    logging.info("Retrying to generate cover letter with gemini")
-    llm.change_llm_type("gemini")
-    
-    
-    try:
-        response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="string")
+        try:
+            response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="string", prompt_name="GENERATE_COVER_LETTER_PROMPT", regenerate=regenerate)
+            if response == NO_RECOMMENDATION_RESPONSE:
+                return response
 
-        if response == 'Please update profile or resume to get a better recommendation.':
-            return response   
+            # update the cover letter in the jobsvisited
+            atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"cover_letter": response}})
+            return response
+        except Exception as e:
+            logging.error(f"Error in generating cover letter: {e}")
 
-        # update the cover letter in the jobsvisited
-        atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"cover_letter": response}})
-        return response
-    
-    except Exception as e:
-        logging.error(f"Error in generating cover letter: {e}")
-        response = None
+    return GENERIC_ERROR_RESPONSE
 
-    
-    return "Something went wrong. Please try again later."
 
+async def agenerate_cover_letter(profile_id, job_id, regenerate=False):
+    prompt = load_prompt("GENERATE_COVER_LETTER_PROMPT", ["PROFILE", "JOB_DESCRIPTION"])
 
-def get_skill_match_score(profile_id, job_id):
-    llm = LLM("chatgpt")
-    skill_match_prompt = json.load(open("data/prompts.json", "r"))["SKILL_MATCH_SCORE_PROMPT"]
-    prompt = PromptTemplate(
-            template=skill_match_prompt,
-            input_variables=["PROFILE", "JOB_DESCRIPTION"]
-        )
-    
-    print(profile_id, job_id)
-    
+    atlas_client = AsyncAtlasClient()
+    bundle = await aload_profile_job_bundle(profile_id, job_id, PROFILE_JOB_FIELDS, atlas_client)
 
-    atlas_client = AtlasClient()
-    profile = atlas_client.find("users", filter={"_id": ObjectId(profile_id)})
-    job = atlas_client.find("jobsvisiteds", filter={"_id": ObjectId(job_id)})
+    if bundle.visit is None or bundle.profile is None or bundle.job is None:
+        return GENERIC_ERROR_RESPONSE
 
+    job = bundle.job
+    profile = select_profile_fields(bundle.profile, PROFILE_JOB_FIELDS)
+    job_description = job["title"]+"\n\n"+job["description"]
 
-    
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to generate cover letter with {llm_type}")
+            llm.change_llm_type(llm_type)
 
+        try:
+            response = await aget_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="string", prompt_name="GENERATE_COVER_LETTER_PROMPT", regenerate=regenerate)
+            if response == NO_RECOMMENDATION_RESPONSE:
+                return response
 
-    if len(profile) == 0 or len(job) == 0:
-        return {
-            "profile_skills": [],
-            "job_description_required_skills": [],
-            "overlapped_skills": [],
-            "skills_to_be_learned": [],
-            "match_score": 0
-        }
-    
-    profile = profile[0]
-    job = job[0]
+            await atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update={"$set": {"cover_letter": response}})
+            return response
+        except Exception as e:
+            logging.error(f"Error in generating cover letter: {e}")
+
+    return GENERIC_ERROR_RESPONSE
 
 
+def _stored_skill_match(job):
     # if job is already present in user's visited jobs collection, return the skill match score
     if "skills_in_profile" in job and "skills_in_job" in job and "skill_delta" in job and "skill_match_score" in job and job["skills_in_profile"]!=[] and job["skills_in_job"]!=[] and job["skill_delta"]!=[] and job["skill_match_score"]!=0:
         return {
@@ -362,120 +439,118 @@ def get_skill_match_score(profile_id, job_id):
             "skills_to_be_learned": job["skill_delta"],
             "match_score": job["skill_match_score"]
         }
+    return None
+
+
+def _skill_match_result(response):
+    # Raises if the response does not have the expected fields
+    profile_skills = response['PROFILE_SKILLS']
+    job_description_required_skills = response['JOB_DESCRIPTION_REQUIRED_SKILLS']
+    overlapped_skills = response['OVERLAPPED_SKILLS']
+    skills_to_be_learned = response['SKILLS_TO_BE_LEARNED']
 
-    profile = {
-        "summary": profile["summary"],
-        "name": profile["name"],
-        "headline": profile["headline"],
-        "location_name": profile["location_name"],
-        "education": profile["education"],
-        "experience": profile["experience"],
-        "courses_taken": profile["courses_taken"],
-        "publications": profile["publications"],
-        "projects": profile["projects"],
-        "certifications": profile["certifications"],
-        "patents": profile["patents"],
-        "awards": profile["awards"],
-        "skills": profile["skills"]
+    total_skills = len(job_description_required_skills)
+    matched_skills = len(overlapped_skills)
+    try:
+        match_score = matched_skills / total_skills * 100
+    except ZeroDivisionError:
+        pass
+
+    update = {"$set": {"skills_in_profile": profile_skills, "skills_in_job": job_description_required_skills, "skill_delta": skills_to_be_learned, "skill_match_score": match_score}}
+    result = {
+        "profile_skills": profile_skills,
+        "job_description_required_skills": job_description_required_skills,
+        "overlapped_skills": overlapped_skills,
+        "skills_to_be_learned": skills_to_be_learned,
+        "match_score": match_score
     }
+    return update, result
 
-    # fill in the job
-    original_job_id  = job["job"]
-    job = atlas_client.find("jobs", filter={"_id": ObjectId(original_job_id)})
-    job = job[0]
 
-    
+def get_skill_match_score(profile_id, job_id, regenerate=False):
+    prompt = load_prompt("SKILL_MATCH_SCORE_PROMPT", ["PROFILE", "JOB_DESCRIPTION"])
 
-    job_position = job["title"]
-    job_description = job_position+"\n\n"+job["description"]
-    profile = str(profile)
+    atlas_client = AtlasClient()
+    bundle = load_profile_job_bundle(profile_id, job_id, SKILL_MATCH_PROFILE_FIELDS, atlas_client)
 
-    try:
-        response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="json")
-    except Exception as e:
-        logging.error(f"Error in getting skill match score: {e}")
-        response = None
+    if bundle.profile is None or bundle.visit is None:
+        return dict(EMPTY_SKILL_MATCH)
 
+    stored = _stored_skill_match(bundle.visit)
+    if stored is not None and not regenerate:
+        return stored
 
-    try:
-        profile_skills = response['PROFILE_SKILLS']
-        job_description_required_skills = response['JOB_DESCRIPTION_REQUIRED_SKILLS']
-        overlapped_skills = response['OVERLAPPED_SKILLS']
-        skills_to_be_learned = response['SKILLS_TO_BE_LEARNED']
+    if bundle.job is None:
+        return dict(EMPTY_SKILL_MATCH)
+
+    profile = select_profile_fields(bundle.profile, SKILL_MATCH_PROFILE_FIELDS)
+
+    job = bundle.job
+    job_description = job["title"]+"\n\n"+job["description"]
+
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to get skill match score with {llm_type}")
+            llm.change_llm_type(llm_type)
 
-        total_skills = len(job_description_required_skills)
-        matched_skills = len(overlapped_skills)
         try:
-            match_score = matched_skills / total_skills * 100
-        except ZeroDivisionError:
-            pass
-
-
-        # update the jobs visited
-        atlas_client.update("jobsvisiteds", 
-                            filter={"_id": ObjectId(job_id)},
-                            update={"$set": {"skills_in_profile": profile_skills, "skills_in_job": job_description_required_skills, "skill_delta": skills_to_be_learned, "skill_match_score": match_score}})
-                            
-
-        response = {
-            "profile_skills": profile_skills,
-            "job_description_required_skills": job_description_required_skills,
-            "overlapped_skills": overlapped_skills,
-            "skills_to_be_learned": skills_to_be_learned,
-            "match_score": match_score
-        }
+            response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="json", prompt_name="SKILL_MATCH_SCORE_PROMPT", regenerate=regenerate,
+                                             validate=_skill_match_result)
+        except Exception as e:
+            logging.error(f"Error in getting skill match score: {e}")
+            response = None
 
-        return response
-    except Exception as e:
-        logging.error(f"Error in getting skill match score: {e}")
-        pass
+        try:
+            update, result = _skill_match_result(response)
+            # update the jobs visited
+            atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update=update)
+            return result
+        except Exception as e:
+            logging.error(f"Error in getting skill match score: {e}")
 
+    return dict(EMPTY_SKILL_MATCH)
 
-    logging.info("Retrying to get skill match score with gemini")
-    llm.change_llm_type("gemini")
-    
-    try:
-        response = get_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="json")
-    except Exception as e:
-        logging.error(f"Error in getting skill match score: {e}")
-        response = None
 
-    try:
-        profile_skills = response['PROFILE_SKILLS']
-        job_description_required_skills = response['JOB_DESCRIPTION_REQUIRED_SKILLS']
-        overlapped_skills = response['OVERLAPPED_SKILLS']
-        skills_to_be_learned = response['SKILLS_TO_BE_LEARNED']
+async def aget_skill_match_score(profile_id, job_id, regenerate=False):
+    prompt = load_prompt("SKILL_MATCH_SCORE_PROMPT", ["PROFILE", "JOB_DESCRIPTION"])
+
+    atlas_client = AsyncAtlasClient()
+    bundle = await aload_profile_job_bundle(profile_id, job_id, SKILL_MATCH_PROFILE_FIELDS, atlas_client)
+
+    if bundle.profile is None or bundle.visit is None:
+        return dict(EMPTY_SKILL_MATCH)
+
+    stored = _stored_skill_match(bundle.visit)
+    if stored is not None and not regenerate:
+        return stored
+
+    if bundle.job is None:
+        return dict(EMPTY_SKILL_MATCH)
+
+    profile = select_profile_fields(bundle.profile, SKILL_MATCH_PROFILE_FIELDS)
+
+    job = bundle.job
+    job_description = job["title"]+"\n\n"+job["description"]
+
+    llm = LLM(FALLBACK_LLMS[0])
+    for llm_type in FALLBACK_LLMS:
+        if llm_type != llm.llm_type:
+            logging.info(f"Retrying to get skill match score with {llm_type}")
+            llm.change_llm_type(llm_type)
 
-        total_skills = len(job_description_required_skills)
-        matched_skills = len(overlapped_skills)
         try:
-            match_score = matched_skills / total_skills * 100
-        except ZeroDivisionError:
-            pass
-
-        # update the jobs visiteds collections with the new entry
-        atlas_client.update("jobsvisiteds", 
-                            filter={"_id": ObjectId(job_id)},
-                            update={"$set": {"skills_in_profile": profile_skills, "skills_in_job": job_description_required_skills, "skill_delta": skills_to_be_learned, "skill_match_score": match_score}})
-        
-        
-        response = {
-            "profile_skills": profile_skills,
-            "job_description_required_skills": job_description_required_skills,
-            "overlapped_skills": overlapped_skills,
-            "skills_to_be_learned": skills_to_be_learned,
-            "match_score": match_score
-        }
+            response = await aget_response_from_llm(llm, prompt, inputs={"PROFILE": profile, "JOB_DESCRIPTION": job_description}, output_type="json", prompt_name="SKILL_MATCH_SCORE_PROMPT", regenerate=regenerate,
+                                                    validate=_skill_match_result)
+        except Exception as e:
+            logging.error(f"Error in getting skill match score: {e}")
+            response = None
 
-        return response
-    except Exception as e:
-        logging.error(f"Error in getting skill match score: {e}")
-        pass
+        try:
+            update, result = _skill_match_result(response)
+            await atlas_client.update("jobsvisiteds", filter={"_id": ObjectId(job_id)}, update=update)
+            return result
+        except Exception as e:
+            logging.error(f"Error in getting skill match score: {e}")
 
-    return {
-        "profile_skills": [],
-        "job_description_required_skills": [],
-        "overlapped_skills": [],
-        "skills_to_be_learned": [],
-        "match_score": 0
-    }
\ No newline at end of file
+    return dict(EMPTY_SKILL_MATCH)
@@ -0,0 +1,452 @@
+"""
+This script converts the FAISS vector stores of the course indexes into a memory-mappable layout.
+
+FAISS.load_local reads index.faiss and unpickles index.pkl into the private memory of every worker
+process. The converted layout (mmap/ inside hybrid_db) keeps the vectors of flat indexes in a .npy
+file and the documents in a compact record file, both memory-mapped read-only at load time, so all
+the workers of a host share the same page cache pages. Other index types are written as index.faiss
+and opened with the FAISS mmap flags when the index type supports them.
+
+With --quantize the flat index is replaced by a scalar quantized (sq8, 4x smaller) or product quantized
+(pq) index in the same layout, and a recall@k, latency and memory comparison with the flat index is
+printed. load_vector_store loads whichever layout is on disk.
+
+Files of a converted index directory:
+meta.json           kind ("flat" or "faiss"), quantization, metric, number and dimension of the vectors
+vectors.npy         the vectors of a flat index
+norms.npy           the squared L2 norm of each vector of a flat index
+index.faiss         the index, for other index types
+docs.bin            the documents in index order, see document_store.py
+docs_offsets.npy    start of each record in docs.bin
+
+Usage:
+python vector_index.py [hybrid_db directories...]
+python vector_index.py --quantize sq8 [hybrid_db directories...]
+
+Author: Shreyas Nikam
+"""
+
+
+import os
+import json
+import time
+import pickle
+import shutil
+import logging
+import argparse
+import numpy as np
+from dotenv import load_dotenv
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from document_store import DocumentStore, write_documents
+
+load_dotenv()
+
+
+MMAP_DIR_NAME = "mmap"
+FORMAT_VERSION = 1
+# "mmap" loads the converted layout when it exists, "memory" always uses FAISS.load_local
+FAISS_LOAD_MODE = os.environ.get("FAISS_LOAD_MODE", "mmap").lower()
+
+
+class MmapFlatIndex:
+    """
+    Exact nearest neighbour search over memory-mapped vectors, returning the same distances as
+    faiss IndexFlatL2 (squared L2, ascending) or IndexFlatIP (inner product, descending).
+    Implements the part of the faiss index interface used by the langchain FAISS vector store.
+
+    Attributes:
+    vectors (np.ndarray): The memory-mapped vectors.
+    norms (np.ndarray): The squared L2 norm of each vector.
+    metric (str): "l2" or "ip".
+    """
+    def __init__(self, vectors, norms, metric):
+        """
+        The constructor for the MmapFlatIndex class.
+        """
+        self.vectors = vectors
+        self.norms = norms
+        self.metric = metric
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, x, k):
+        """
+        Function to search the k nearest vectors of each query.
+
+        Args:
+        x (np.ndarray): The query vectors, shape (n, d).
+        k (int): The number of neighbours.
+
+        Returns:
+        tuple: The distances and ids, shape (n, k), padded with -1 ids as in faiss.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        n = x.shape[0]
+        distances = np.full((n, k), np.inf if self.metric == "l2" else -np.inf, dtype=np.float32)
+        ids = np.full((n, k), -1, dtype=np.int64)
+        found = min(k, self.ntotal)
+        if found == 0:
+            return distances, ids
+
+        products = x @ self.vectors.T
+        if self.metric == "l2":
+            scores = (x * x).sum(axis=1)[:, None] - 2 * products + self.norms[None, :]
+        else:
+            # Negate so the best neighbours sort first in both metrics
+            scores = -products
+
+        if found < self.ntotal:
+            candidates = np.argpartition(scores, found - 1, axis=1)[:, :found]
+        else:
+            candidates = np.tile(np.arange(self.ntotal), (n, 1))
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(candidate_scores, axis=1, kind="stable")
+        ids[:, :found] = np.take_along_axis(candidates, order, axis=1)
+        best = np.take_along_axis(candidate_scores, order, axis=1)
+        distances[:, :found] = best if self.metric == "l2" else -best
+        return distances, ids
+
+    def reconstruct(self, i):
+        """
+        Function to get a stored vector.
+
+        Args:
+        i (int): The vector id.
+
+        Returns:
+        np.ndarray: The vector.
+        """
+        return np.array(self.vectors[i], dtype=np.float32)
+
+
+class MmapDocstore(Docstore):
+    """
+    Langchain docstore over a memory-mapped DocumentStore, the document ids are the index positions.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def search(self, search):
+        try:
+            return self.store.document(int(search))
+        except (ValueError, IndexError):
+            return f"ID {search} not found."
+
+
+class PositionIds:
+    """
+    Mapping of index position to docstore id for an MmapDocstore, without storing a dictionary.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise KeyError(i)
+        return int(i)
+
+    def __len__(self):
+        return self.size
+
+    def values(self):
+        return range(self.size)
+
+
+def mmap_path(hybrid_db_path):
+    """
+    Get the converted index directory of a vector store directory
+
+    Args:
+    hybrid_db_path: str - the vector store directory
+
+    Returns:
+    path: str - the converted index directory
+    """
+    return os.path.join(hybrid_db_path, MMAP_DIR_NAME)
+
+
+def read_faiss_index(path):
+    """
+    Read a faiss index memory-mapped and read-only, or fully if the index type cannot be mapped
+
+    Args:
+    path: str - path of the index file
+
+    Returns:
+    index: faiss.Index - the index
+    """
+    import faiss
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        logging.info(f"Index {path} cannot be memory-mapped, reading it fully: {e}")
+        return faiss.read_index(path)
+
+
+def load_mmap_vector_store(path, embeddings):
+    """
+    Load a converted index as a langchain FAISS vector store
+
+    Args:
+    path: str - the converted index directory
+    embeddings: Embeddings - the embeddings of the queries
+
+    Returns:
+    vector_store: FAISS - the vector store
+    """
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported vector index format {meta.get('format_version')} in {path}")
+
+    if meta["kind"] == "flat":
+        index = MmapFlatIndex(
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "norms.npy"), mmap_mode="r"),
+            meta["metric"],
+        )
+    else:
+        index = read_faiss_index(os.path.join(path, "index.faiss"))
+
+    store = DocumentStore.load(path)
+    distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE if meta["metric"] == "l2" else DistanceStrategy.MAX_INNER_PRODUCT
+    return FAISS(embeddings, index, MmapDocstore(store), PositionIds(len(store)), distance_strategy=distance_strategy)
+
+
+def load_vector_store(hybrid_db_path, embeddings, mode=None):
+    """
+    Load the vector store of a course, memory-mapped when it was converted
+
+    Args:
+    hybrid_db_path: str - the vector store directory
+    embeddings: Embeddings - the embeddings of the queries
+    mode: str - "mmap" or "memory", defaults to FAISS_LOAD_MODE
+
+    Returns:
+    vector_store: FAISS - the vector store
+    """
+    mode = mode or FAISS_LOAD_MODE
+    if mode == "mmap" and os.path.isdir(mmap_path(hybrid_db_path)):
+        return load_mmap_vector_store(mmap_path(hybrid_db_path), embeddings)
+    return FAISS.load_local(hybrid_db_path, embeddings)
+
+
+def _metric(index):
+    import faiss
+    return "l2" if index.metric_type == faiss.METRIC_L2 else "ip"
+
+
+def _read_saved(hybrid_db_path):
+    # Read a vector store saved by FAISS.save_local, with its documents in index order
+    import faiss
+    start = time.perf_counter()
+    index = faiss.read_index(os.path.join(hybrid_db_path, "index.faiss"))
+    with open(os.path.join(hybrid_db_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    load_seconds = time.perf_counter() - start
+
+    # Store the documents in index order so a search result position is the document position
+    documents = [docstore.search(index_to_docstore_id[i]) for i in range(index.ntotal)]
+    return index, documents, load_seconds
+
+
+def _write_converted(hybrid_db_path, index, documents, quantization=None):
+    # Write the converted layout into a temporary directory and rename it, so a loading process
+    # never sees a partial index
+    import faiss
+    path = mmap_path(hybrid_db_path)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    flat = isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+    if flat:
+        vectors = index.reconstruct_n(0, index.ntotal).astype(np.float32)
+        np.save(os.path.join(tmp_path, "vectors.npy"), vectors)
+        np.save(os.path.join(tmp_path, "norms.npy"), (vectors * vectors).sum(axis=1))
+    else:
+        faiss.write_index(index, os.path.join(tmp_path, "index.faiss"))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "format_version": FORMAT_VERSION,
+            "kind": "flat" if flat else "faiss",
+            "quantization": quantization,
+            "metric": _metric(index),
+            "ntotal": index.ntotal,
+            "d": index.d,
+        }, f)
+    write_documents(tmp_path, documents)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return path, "flat" if flat else "faiss"
+
+
+def convert_vector_store(hybrid_db_path):
+    """
+    Convert a saved langchain FAISS vector store into the memory-mappable layout
+
+    Args:
+    hybrid_db_path: str - the vector store directory holding index.faiss and index.pkl
+
+    Returns:
+    report: dict - number of vectors, kind and load times of both layouts
+    """
+    index, documents, load_seconds = _read_saved(hybrid_db_path)
+    path, kind = _write_converted(hybrid_db_path, index, documents)
+
+    start = time.perf_counter()
+    load_mmap_vector_store(path, None)
+    mmap_seconds = time.perf_counter() - start
+
+    report = {
+        "path": path,
+        "kind": kind,
+        "vectors": index.ntotal,
+        "load_local_seconds": round(load_seconds, 4),
+        "mmap_load_seconds": round(mmap_seconds, 4),
+    }
+    logging.info(f"Converted {hybrid_db_path}: {report}")
+    return report
+
+
+def build_quantized_index(vectors, metric, quantization="sq8", pq_m=None):
+    """
+    Build a scalar (SQ8) or product (PQ) quantized index of a set of vectors
+
+    Args:
+    vectors: np.ndarray - the vectors, shape (n, d)
+    metric: str - "l2" or "ip"
+    quantization: str - "sq8" or "pq"
+    pq_m: int - number of PQ sub-quantizers, must divide d, defaults to d / 16
+
+    Returns:
+    index: faiss.Index - the trained index holding the vectors
+    """
+    import faiss
+    n, d = vectors.shape
+    faiss_metric = faiss.METRIC_L2 if metric == "l2" else faiss.METRIC_INNER_PRODUCT
+    if quantization == "sq8":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss_metric)
+    elif quantization == "pq":
+        pq_m = pq_m or max(d // 16, 1)
+        if d % pq_m:
+            raise ValueError(f"pq_m {pq_m} must divide the dimension {d}")
+        # Each sub-quantizer needs at least 2 ** nbits training vectors, course corpora can be small
+        nbits = max(1, min(8, int(np.log2(max(n, 2)))))
+        index = faiss.IndexPQ(d, pq_m, nbits, faiss_metric)
+    else:
+        raise ValueError(f"Unknown quantization {quantization}")
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def _search_latency_ms(index, queries, k):
+    start = time.perf_counter()
+    for i in range(len(queries)):
+        index.search(queries[i:i + 1], k)
+    return (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+
+def quantization_report(flat_index, quantized_index, queries, k=5):
+    """
+    Compare a quantized index with the flat index it was built from
+
+    Args:
+    flat_index: faiss.Index - the flat index, the exact results
+    quantized_index: faiss.Index - the quantized index
+    queries: np.ndarray - query vectors, shape (n, d)
+    k: int - the number of neighbours
+
+    Returns:
+    report: dict - recall@k, mean search latency and index memory of both indexes
+    """
+    import faiss
+    _, exact = flat_index.search(queries, k)
+    _, approximate = quantized_index.search(queries, k)
+    hits = sum(len(set(exact[i]) & set(approximate[i])) for i in range(len(queries)))
+
+    def index_bytes(index):
+        # Serialized size, which is the memory held by the codes of the index
+        return int(faiss.serialize_index(index).size)
+
+    flat_bytes, quantized_bytes = index_bytes(flat_index), index_bytes(quantized_index)
+    return {
+        f"recall@{k}": round(hits / (len(queries) * k), 4) if len(queries) else None,
+        "flat_latency_ms": round(_search_latency_ms(flat_index, queries, k), 4),
+        "quantized_latency_ms": round(_search_latency_ms(quantized_index, queries, k), 4),
+        "flat_mb": round(flat_bytes / (1024 * 1024), 3),
+        "quantized_mb": round(quantized_bytes / (1024 * 1024), 3),
+        "compression": round(flat_bytes / quantized_bytes, 2) if quantized_bytes else None,
+    }
+
+
+def quantize_vector_store(hybrid_db_path, quantization="sq8", pq_m=None, k=5, n_queries=100):
+    """
+    Convert a saved langchain FAISS vector store into a quantized index in the converted layout,
+    which load_vector_store then loads in place of the flat index
+
+    Args:
+    hybrid_db_path: str - the vector store directory holding index.faiss and index.pkl
+    quantization: str - "sq8" or "pq"
+    pq_m: int - number of PQ sub-quantizers
+    k: int - the number of neighbours of the recall report
+    n_queries: int - the number of queries of the recall report
+
+    Returns:
+    report: dict - the quantization report
+    """
+    flat_index, documents, _ = _read_saved(hybrid_db_path)
+    vectors = flat_index.reconstruct_n(0, flat_index.ntotal).astype(np.float32)
+    quantized_index = build_quantized_index(vectors, _metric(flat_index), quantization, pq_m)
+
+    # Queries near the stored vectors, like questions about the course content
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.integers(0, len(vectors), size=min(n_queries, len(vectors)))]
+    noise = rng.standard_normal(sample.shape).astype(np.float32) * sample.std() * 0.5
+    report = quantization_report(flat_index, quantized_index, sample + noise, k)
+
+    path, _ = _write_converted(hybrid_db_path, quantized_index, documents, quantization=quantization)
+    report.update({"path": path, "quantization": quantization, "vectors": flat_index.ntotal})
+    logging.info(f"Quantized {hybrid_db_path}: {report}")
+    return report
+
+
+def find_vector_store_dirs(roots=("chatbot", "data/indexes")):
+    """
+    Find the saved langchain FAISS vector stores
+
+    Args:
+    roots: tuple - directories to search
+
+    Returns:
+    paths: list - the vector store directories
+    """
+    paths = []
+    for root in roots:
+        for directory, _, files in os.walk(root):
+            if "index.faiss" in files and "index.pkl" in files:
+                paths.append(directory)
+    return sorted(paths)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convert the course vector indexes")
+    parser.add_argument("paths", nargs="*", help="hybrid_db directories, defaults to every course index")
+    parser.add_argument("--quantize", choices=["sq8", "pq"], help="write a quantized index instead of the flat vectors")
+    parser.add_argument("--pq-m", type=int, help="number of PQ sub-quantizers")
+    args = parser.parse_args()
+
+    for vector_store_dir in args.paths or find_vector_store_dirs():
+        try:
+            if args.quantize:
+                print(json.dumps(quantize_vector_store(vector_store_dir, args.quantize, args.pq_m)))
+            else:
+                print(json.dumps(convert_vector_store(vector_store_dir)))
+        except Exception as e:
+            logging.error(f"Error in converting {vector_store_dir}: {e}")